@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Measures how long BatchFilesDB.select() takes to load the queue.
+#
+# Usage: uv run queue_select.py [--directory DIR] [--latency-ms MS]
+#
+# Pass a directory on the network filesystem used in production
+# (e.g. somewhere under /srv/data) to see the effect of its latency,
+# by default a local temporary directory is used. --latency-ms adds a
+# simulated delay to each record read to approximate a network mount
+# when running on a local disk.
+
+import argparse
+import sys
+import tempfile
+import time
+
+from transcribe_core import batchfilesdb
+from transcribe_core.batchfilesdb import BatchFilesDB
+
+SIZES = [100, 1_000, 10_000]
+REPEATS = 3
+
+
+def _create_records(directory, size):
+    db = BatchFilesDB(directory, backend="files")
+    for idx in range(0, size):
+        db.create(
+            f"/srv/data/files/{idx}",
+            f"user{idx % 50}@softcatala.org",
+            "medium",
+            f"recording-{idx}.mp3",
+        )
+
+
+def _time_select(directory, backend):
+    best = None
+    for _ in range(0, REPEATS):
+        db = BatchFilesDB(directory, backend=backend)
+        start_time = time.perf_counter()
+        records = db.select()
+        _time = time.perf_counter() - start_time
+        best = _time if best is None else min(best, _time)
+
+    return best, len(records)
+
+
+def _time_serial(directory):
+    parallel_read_min = batchfilesdb.PARALLEL_READ_MIN
+    batchfilesdb.PARALLEL_READ_MIN = sys.maxsize
+    try:
+        return _time_select(directory, "files")
+    finally:
+        batchfilesdb.PARALLEL_READ_MIN = parallel_read_min
+
+
+def _add_latency(latency):
+    read_first_line = batchfilesdb._read_first_line
+
+    def _read_first_line(filename):
+        time.sleep(latency)
+        return read_first_line(filename)
+
+    batchfilesdb._read_first_line = _read_first_line
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    if args.latency_ms:
+        _add_latency(args.latency_ms / 1000)
+
+    print("Benchmark BatchFilesDB.select()")
+    print(f"Read threads: {batchfilesdb.READ_THREADS}")
+    print(f"Simulated latency per read: {args.latency_ms} ms")
+    print(
+        f"{'records':>8} {'serial':>10} {'parallel':>10} {'speedup':>8} {'sqlite':>10}"
+    )
+
+    for size in SIZES:
+        with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+            _create_records(directory, size)
+
+            serial, found = _time_serial(directory)
+            parallel, _ = _time_select(directory, "files")
+            indexed, _ = _time_select(directory, "sqlite")
+            assert found == size
+
+            print(
+                f"{size:>8} {serial:>9.3f}s {parallel:>9.3f}s {serial / parallel:>7.1f}x {indexed:>9.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
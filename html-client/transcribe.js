@@ -40,5 +40,7 @@ function sendFile()
         var formData = new FormData(document.getElementById('form-id'));
         url = URL + `/file/transcribe`;
         xmlHttp.open("post", url);
+        // Sending the email in a header lets the server reject the upload before the file is sent
+        xmlHttp.setRequestHeader("X-Email", formData.get('email'));
         xmlHttp.send(formData); 
 }
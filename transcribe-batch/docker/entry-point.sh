@@ -4,4 +4,10 @@ if [ ! -z "$LOGDIR" ]
 then
     mkdir -p $LOGDIR
 fi
-uv run --no-sync src/transcribe_batch/main.py
+
+if [ "$SUPERVISOR" = "true" ]
+then
+    uv run --no-sync src/transcribe_batch/supervisor.py
+else
+    uv run --no-sync src/transcribe_batch/main.py
+fi
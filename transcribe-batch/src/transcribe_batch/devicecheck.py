@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import importlib.metadata
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from transcribe_batch.execution import _get_compute_type, _get_device_index
+
+# A new version of any of them may change what works on the device
+ENGINE_PACKAGES = ["ctranslate2", "faster-whisper", "whisper-ctranslate2"]
+
+
+def get_versions() -> str:
+    """Return the versions of the inference packages installed."""
+    versions = []
+    for package in ENGINE_PACKAGES:
+        try:
+            version = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            version = "none"
+
+        versions.append(f"{package}={version}")
+
+    return ",".join(versions)
+
+
+def get_cache_key(device: str, model: str, engine: str) -> str:
+    """Return the key of a device check with the current settings."""
+    return (
+        f"{device}|{_get_device_index()}|{_get_compute_type()}"
+        f"|{model}|{engine}|{get_versions()}"
+    )
+
+
+class DeviceCheckCache:
+    """
+    Remembers for ttl seconds which device passed the startup test.
+
+    The entries are kept in a json file shared by the workers of the host,
+    keyed by get_cache_key. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, filename: str, ttl: float) -> None:
+        """Create a cache kept in filename."""
+        self.filename = Path(filename)
+        self.ttl = ttl
+
+    def _read(self) -> dict[str, Any]:
+        try:
+            with self.filename.open("r") as fh:
+                entries = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, key: str, now: float | None = None) -> str | None:
+        """Return the device that passed the test for key, or None."""
+        if self.ttl <= 0:
+            return None
+
+        if now is None:
+            now = time.time()
+
+        entry = self._read().get(key)
+        if not isinstance(entry, dict):
+            return None
+
+        if now - entry.get("time", 0) > self.ttl:
+            return None
+
+        return entry.get("device")
+
+    def set(self, key: str, device: str, now: float | None = None) -> None:
+        """Remember that device passed the test for key."""
+        if self.ttl <= 0:
+            return
+
+        if now is None:
+            now = time.time()
+
+        entries = self._read()
+        # Drop the expired ones, the versions change with every update
+        entries = {
+            name: entry
+            for name, entry in entries.items()
+            if isinstance(entry, dict)
+            and now - entry.get("time", 0) <= self.ttl
+        }
+        entries[key] = {"device": device, "time": now}
+        try:
+            directory = self.filename.resolve().parent
+            directory.mkdir(parents=True, exist_ok=True)
+            # Written aside and renamed, so other workers never read half
+            fd, temp_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as fh:
+                json.dump(entries, fh)
+
+            Path(temp_file).replace(self.filename)
+        except OSError as exception:
+            logging.warning(
+                f"DeviceCheckCache. Cannot write {self.filename}: {exception}"
+            )
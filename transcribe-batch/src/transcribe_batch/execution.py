@@ -18,117 +18,659 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-import datetime
+import contextlib
+import dataclasses
+import datetime as dt
+import json
 import logging
 import os
+import selectors
 import subprocess
-import threading
 import tempfile
 import signal
-import psutil
-from typing import Optional
+import threading
+import time
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Any, Optional
 from langdetect import detect_langs
+from transcribe_core.mediaprobe import MediaProbeError, probe
+from transcribe_batch import longaudio
+from transcribe_batch.longaudio import SAMPLE_RATE
+
+
+@dataclasses.dataclass
+class CommandResult:
+    """What a command returned and the resources it used."""
+
+    returncode: int
+    # Read into a growing buffer, returned without copying it
+    stdout: bytes | bytearray = b""
+    stderr: bytes | bytearray = b""
+    wall_time: float = 0
+    cpu_time: float = 0
+    # Peak resident memory in bytes
+    max_rss: int = 0
 
 
 class Command(object):
+    """
+    Runs argv, without a shell, in its own process group.
+
+    stderr is read into memory, and stdout too when it is
+    subprocess.PIPE. On timeout the whole group gets SIGTERM and, if it
+    is still running kill_grace seconds later, SIGKILL. The process is
+    reaped with wait4 to know the CPU time and peak memory it used.
+    """
+
     TIMEOUT_ERROR = -1
     NO_ERROR = 0
+    ERROR = 1
     RUNTIME_ERROR = 100
 
-    def __init__(self, cmd):
-        self.cmd = cmd
+    READ_SIZE = 1024 * 1024
+
+    # The commands started and not reaped yet, by any thread
+    _running: set["Command"] = set()
+    _running_lock = threading.Lock()
+
+    def __init__(
+        self,
+        argv: list[Any],
+        stdout: int | None = subprocess.DEVNULL,
+        kill_grace: float = 5,
+    ) -> None:
+        """Create a command for argv, it is started by run."""
+        self.argv = [str(arg) for arg in argv]
+        self.stdout = stdout
+        self.kill_grace = kill_grace
         self.process = None
+        self._rusage = None
+
+    def _signal_group(self, sig: int) -> None:
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.killpg(self.process.pid, sig)
+
+    def _reap(self, *, block: bool = False) -> bool:
+        if self.process.returncode is not None:
+            return True
+
+        try:
+            pid, status, rusage = os.wait4(
+                self.process.pid, 0 if block else os.WNOHANG
+            )
+        except ChildProcessError:
+            self.process.returncode = self.ERROR
+            return True
+
+        if pid == 0:
+            return False
+
+        self._rusage = rusage
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        return True
+
+    def _terminate(self) -> None:
+        self._signal_group(signal.SIGTERM)
+        deadline = time.monotonic() + self.kill_grace
+        while not self._reap():
+            if time.monotonic() > deadline:
+                logging.warning(f"Command. Killing {self.argv[0]}")
+                self._signal_group(signal.SIGKILL)
+                break
+
+            time.sleep(0.05)
+
+        self._reap(block=True)
+        # Anything left in the group
+        self._signal_group(signal.SIGKILL)
+
+    @classmethod
+    def terminate_all(cls) -> None:
+        """Stop the process groups of all the running commands."""
+        with cls._running_lock:
+            commands = list(cls._running)
+
+        # Signal them all first so they stop at the same time
+        for command in commands:
+            command._signal_group(signal.SIGTERM)
+
+        for command in commands:
+            command._terminate()
+
+    def _read(
+        self,
+        selector: selectors.BaseSelector,
+        output: dict[IO[bytes], bytearray],
+        timeout: float,
+    ) -> bool:
+        events = selector.select(timeout)
+        for key, _ in events:
+            data = os.read(key.fd, self.READ_SIZE)
+            if data:
+                output[key.fileobj] += data
+            else:
+                selector.unregister(key.fileobj)
+
+        return len(events) > 0
+
+    def _wait(
+        self,
+        selector: selectors.BaseSelector,
+        output: dict[IO[bytes], bytearray],
+        deadline: float,
+    ) -> bool:
+        """Read the pipes until the process exits, False on timeout."""
+        poll = 0.01
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return False
+
+            wait = deadline - now
+            if selector.get_map():
+                if not self._read(selector, output, min(wait, 1)) and (
+                    self._reap()
+                ):
+                    # Exited leaving something in its group with the pipes
+                    # open, do not wait for it
+                    self._signal_group(signal.SIGKILL)
+            elif self._reap():
+                return True
+            else:
+                time.sleep(min(wait, poll))
+                poll = min(poll * 2, 0.25)
+
+    def _get_result(
+        self,
+        output: dict[IO[bytes], bytearray],
+        start_time: float,
+        *,
+        timed_out: bool,
+    ) -> CommandResult:
+        result = CommandResult(
+            self.TIMEOUT_ERROR if timed_out else self.process.returncode,
+            stdout=output.get(self.process.stdout, b""),
+            stderr=output.get(self.process.stderr, b""),
+            wall_time=time.monotonic() - start_time,
+        )
+        if self._rusage:
+            result.cpu_time = self._rusage.ru_utime + self._rusage.ru_stime
+            # Linux reports kilobytes
+            result.max_rss = self._rusage.ru_maxrss * 1024
+
+        return result
 
-    # Make sure that you kill also the process started in the Shell
-    def _kill_child_processes(self, parent_pid, sig=signal.SIGTERM):
+    def run(self, timeout: float) -> CommandResult:
+        """Run the command, stopping it after timeout seconds."""
+        start_time = time.monotonic()
         try:
-            parent = psutil.Process(parent_pid)
-        except psutil.NoSuchProcess:
-            logging.error(f"_kill_child_processes.Cannot kill process {parent_pid}")
-            return
+            self.process = subprocess.Popen(
+                self.argv,
+                stdin=subprocess.DEVNULL,
+                stdout=self.stdout,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+        except OSError as exception:
+            logging.error(f"Command. Cannot run {self.argv[0]}: {exception}")
+            return CommandResult(self.ERROR, stderr=str(exception).encode())
 
-        children = parent.children(recursive=True)
-        for process in children:
-            process.send_signal(sig)
+        with self._running_lock:
+            self._running.add(self)
 
-    def run(self, timeout):
-        def target():
-            self.process = subprocess.Popen(self.cmd, shell=True)
-            self.process.communicate()
+        selector = selectors.DefaultSelector()
+        output = {}
+        for pipe in [self.process.stdout, self.process.stderr]:
+            if pipe is not None:
+                selector.register(pipe, selectors.EVENT_READ)
+                output[pipe] = bytearray()
 
-        thread = threading.Thread(target=target)
-        thread.start()
+        try:
+            timed_out = not self._wait(selector, output, start_time + timeout)
+            if timed_out:
+                self._terminate()
 
-        thread.join(timeout)
-        if thread.is_alive():
-            self._kill_child_processes(self.process.pid)
-            return self.TIMEOUT_ERROR
+            self._reap(block=True)
+        finally:
+            with self._running_lock:
+                self._running.discard(self)
 
-        return self.process.returncode
+        while selector.get_map() and self._read(selector, output, 1):
+            pass
 
+        selector.close()
+        for pipe in output:
+            pipe.close()
 
-class Execution(object):
-    def __init__(self, threads):
-        self.threads = threads
+        return self._get_result(output, start_time, timed_out=timed_out)
+
+
+FFMPEG = "ffmpeg"
+
+
+def _get_compute_type() -> str:
+    return os.environ.get("COMPUTE_TYPE", "int8")
+
+
+def _get_device_index() -> str:
+    return os.environ.get("DEVICE_INDEX", "0")
+
+
+# Number of chunks of a long recording transcribed at the same time,
+# 1 disables the long audio mode
+def _get_long_audio_workers() -> int:
+    return max(1, int(os.environ.get("LONG_AUDIO_WORKERS", 1)))
+
+
+def _get_long_audio_min_duration() -> float:
+    return float(os.environ.get("LONG_AUDIO_MIN_DURATION", 30 * 60))
+
+
+# Rough CPU seconds needed to transcribe a second of audio, used until the
+# worker has measured it
+CPU_SECONDS_PER_AUDIO_SECOND = {
+    "small": 1.0,
+    "medium": 2.5,
+}
+
+# Length of each window of audio used to identify the language
+LANGUAGE_WINDOW_SECONDS = 30
+
+
+def _get_language_windows() -> int:
+    return int(os.environ.get("EARLY_LANGUAGE_WINDOWS", 3))
+
+
+def _get_threads_cpu(idents: Iterable[int] | None = None) -> dict[int, float]:
+    """
+    Return the cpu time of the running threads (only the ones in idents
+    if given), by thread ident, leaving out the calling thread.
+    """
+    current = threading.get_ident()
+    times = {}
+    for thread in threading.enumerate():
+        if thread.ident == current:
+            continue
+
+        if idents is not None and thread.ident not in idents:
+            continue
 
-    def _ffmpeg_errors(self, ffmpeg_errfile):
-        return_code = Command.NO_ERROR
         try:
-            if os.path.getsize(ffmpeg_errfile) == 0:
-                return return_code
+            clock = time.pthread_getcpuclockid(thread.ident)
+            times[thread.ident] = time.clock_gettime(clock)
+        except (AttributeError, OSError):
+            # Exited meanwhile, or not supported on this platform
+            continue
+
+    return times
+
+
+def write_outputs(
+    result: dict[str, Any], audio: str, output_dir: str, options: dict
+) -> None:
+    """Write the txt, srt and json files of result, named after audio."""
+    from whisper_ctranslate2.writers import get_writer
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    writer_options = {
+        "highlight_words": options["highlight_words"],
+        "max_line_width": options["max_line_width"],
+        "max_line_count": options["max_line_count"],
+        "max_words_per_line": None,
+        "pretty_json": True,
+    }
+    for output_format in ["txt", "srt", "json"]:
+        writer = get_writer(output_format, output_dir)
+        writer(result, audio, writer_options)
+
+
+class SubprocessEngine(object):
+    """Runs whisper-ctranslate2 for each job, loading the model every time."""
+
+    name = "subprocess"
+    # whisper-ctranslate2 can only read the audio from a file and cannot
+    # identify the language without transcribing
+    supports_samples = False
+    detects_language = False
+
+    def __init__(self, execution: "Execution") -> None:
+        """Create an engine that runs its commands with execution."""
+        self.execution = execution
+
+    def _whisper_errors(self, errors: str) -> None:
+        for line in errors.splitlines():
+            logging.error(f"_whisper_errors: {line.rstrip()}")
+
+    def transcribe(
+        self,
+        audio: str,
+        output_dir: str,
+        model: str,
+        device: str,
+        timeout: float,
+        options: dict,
+        *,
+        samples: bytes | None = None,  # noqa: ARG002
+    ) -> int:
+        """Transcribe the audio file, samples are not supported."""
+        WHISPER_PATH = "whisper-ctranslate2"
+        args = []
+        if options["highlight_words"]:
+            args += ["--highlight_words", "True"]
+
+        if options["max_line_width"]:
+            args += ["--max_line_width", options["max_line_width"]]
+
+        if options["max_line_count"]:
+            args += ["--max_line_count", options["max_line_count"]]
 
-            return_code = -1
-            cnt = 0
-            with open(ffmpeg_errfile, "r") as fh:
-                for line in fh.readlines():
-                    logging.debug(f"_ffmpeg_errors: {line.rstrip()}")
-                    if cnt > 5:
-                        break
+        if options["word_timestamps"]:
+            args += ["--word_timestamps", "True"]
+
+        verbose = os.environ.get("WHISPER_VERBOSE", "false").lower()
+        stdout = subprocess.DEVNULL if verbose == "false" else None
+
+        cmd = [WHISPER_PATH, *args]
+        cmd += ["--pretty_json", "True", "--local_files_only", "True"]
+        cmd += ["--compute_type", _get_compute_type(), "--verbose", "True"]
+        cmd += ["--threads", self.execution.threads, "--model", model]
+        cmd += ["--output_dir", output_dir, "--language", "ca"]
+        cmd += ["--device", device, "--device_index", _get_device_index()]
+        cmd += [audio]
+        result = self.execution._run_command(cmd, timeout, stdout=stdout)
+        self.execution._add_inference_cpu(result.cpu_time)
+        if result.returncode != Command.NO_ERROR:
+            self._whisper_errors(result.stderr.decode(errors="replace"))
+
+        return result.returncode
+
+
+class ResidentEngine(object):
+    """
+    Transcribes in process with faster-whisper.
+
+    The models are loaded the first time they are used and kept for the
+    lifetime of the worker. The outputs are written with the same writers
+    whisper-ctranslate2 uses, so they are identical to the subprocess
+    engine ones. The timeout is checked between segments.
+    """
+
+    name = "resident"
+    supports_samples = True
+    detects_language = True
+
+    def __init__(self, execution: "Execution") -> None:
+        """Create an engine that has not loaded any model yet."""
+        self.execution = execution
+        self.models = {}
+        # The chunks of a long recording ask for the model from several
+        # threads at once, only one of them loads it
+        self._models_lock = threading.Lock()
+
+    @staticmethod
+    def is_available() -> bool:
+        """Return True if faster-whisper and its writers are installed."""
+        try:
+            import faster_whisper  # noqa: F401
+            import whisper_ctranslate2.writers  # noqa: F401
+        except ImportError as exception:
+            logging.error(f"ResidentEngine. Not available: {exception}")
+            return False
+
+        return True
+
+    def get_model(self, model: str, device: str) -> Any:
+        """Return the loaded model, loading it the first time."""
+        from faster_whisper import WhisperModel
+
+        key = (model, device, _get_device_index(), _get_compute_type())
+        with self._models_lock:
+            whisper_model = self.models.get(key)
+            if whisper_model is None:
+                start_time = time.monotonic()
+                whisper_model = WhisperModel(
+                    model,
+                    device=device,
+                    device_index=int(_get_device_index()),
+                    compute_type=_get_compute_type(),
+                    cpu_threads=int(self.execution.threads),
+                    # Chunks of long recordings are transcribed in parallel
+                    num_workers=_get_long_audio_workers(),
+                    local_files_only=True,
+                )
+                self.models[key] = whisper_model
+                elapsed = time.monotonic() - start_time
+                logging.info(f"ResidentEngine. Loaded {key} in {elapsed:.1f}s")
+
+        return whisper_model
+
+    @staticmethod
+    def _to_float(samples: bytes) -> Any:
+        import numpy as np
+
+        # The same scaling faster-whisper applies when it decodes a file
+        return np.frombuffer(samples, np.int16).astype(np.float32) / 32768.0
+
+    def detect_language(
+        self, windows: list[bytes], model: str, device: str
+    ) -> tuple[str, float]:
+        """
+        Identify the language of the windows of samples.
+
+        Returns the language with the highest probability averaged over
+        all the windows and that probability.
+        """
+        whisper_model = self.get_model(model, device)
+        totals = {}
+        for window in windows:
+            _, _, probabilities = whisper_model.detect_language(
+                audio=self._to_float(window)
+            )
+            for language, probability in probabilities:
+                totals[language] = totals.get(language, 0) + probability / len(windows)
 
-                    cnt += 1
+        language = max(totals, key=totals.get)
+        return language, totals[language]
+
+    def transcribe(
+        self,
+        audio: str,
+        output_dir: str,
+        model: str,
+        device: str,
+        timeout: float,
+        options: dict,
+        *,
+        samples: bytes | None = None,
+    ) -> int:
+        """
+        Transcribe the audio file, or samples (16 kHz mono s16le) when
+        given, audio then only names the outputs.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            whisper_model = self.get_model(model, device)
+            segments, info = whisper_model.transcribe(
+                audio if samples is None else self._to_float(samples),
+                language="ca",
+                word_timestamps=options["word_timestamps"],
+            )
+
+            list_segments = []
+            all_text = ""
+            for segment in segments:
+                all_text += segment.text
+                list_segments.append(dataclasses.asdict(segment))
+
+                if time.monotonic() > deadline:
+                    logging.error(f"ResidentEngine. Timeout transcribing {audio}")
+                    return Command.TIMEOUT_ERROR
+
+            result = {
+                "text": all_text,
+                "segments": list_segments,
+                "language": info.language,
+            }
+            write_outputs(result, audio, output_dir, options)
+            return Command.NO_ERROR
+
+        except RuntimeError as exception:
+            # Same code whisper-ctranslate2 exits with, e.g. no usable GPU
+            logging.error(f"ResidentEngine. Runtime error: {exception}")
+            return Command.RUNTIME_ERROR
 
-            return return_code
         except Exception as exception:
-            logging.error(f"_ffmpeg_errors. Error: {exception}")
-            return return_code
-
-    def _run_ffmpeg(self, source_file, converted_audio, timeout):
-        ffmpeg_errfile = "ffmpeg-error.log"
-        cmd = f"ffmpeg -i {source_file} -ar 16000 -ac 1 -c:a pcm_s16le {converted_audio} -y -loglevel error 2>{ffmpeg_errfile} > /dev/null"
-        Command(cmd).run(timeout=timeout)
-        result = self._ffmpeg_errors(ffmpeg_errfile)
-        logging.debug(f"Run {cmd} with result {result}")
+            logging.error(f"ResidentEngine. Error transcribing {audio}: {exception}")
+            return Command.ERROR
+
+
+def get_engine(
+    name: str, execution: "Execution"
+) -> SubprocessEngine | ResidentEngine:
+    """Return the inference engine called name, or the subprocess one."""
+    if name == ResidentEngine.name:
+        if ResidentEngine.is_available():
+            return ResidentEngine(execution)
+
+        logging.error("Resident engine not available, using subprocess engine")
+        return SubprocessEngine(execution)
+
+    if name != SubprocessEngine.name:
+        logging.error(f"Unknown inference engine '{name}', using subprocess")
+
+    return SubprocessEngine(execution)
+
+
+class Execution(object):
+    """Converts the audio of the jobs and runs the inference on it."""
+
+    def __init__(self, threads: int | str, engine: str | None = None) -> None:
+        """Create it with the engine from INFERENCE_ENGINE if not given."""
+        self.threads = threads
+        if engine is None:
+            engine = os.environ.get("INFERENCE_ENGINE", ResidentEngine.name)
+
+        self.engine = get_engine(engine, self)
+        # Measured CPU seconds per second of audio, by model
+        self.cpu_per_audio_second = {}
+        # CPU used by the inference commands, see SubprocessEngine
+        self._inference_cpu = 0
+        self._inference_cpu_lock = threading.Lock()
+        # Decode the audio to memory instead of writing a wav file
+        streaming = os.environ.get("AUDIO_STREAMING", "true").lower() == "true"
+        self.streaming = streaming and self.engine.supports_samples
+
+    def _add_inference_cpu(self, cpu_time: float) -> None:
+        with self._inference_cpu_lock:
+            self._inference_cpu += cpu_time
+
+    def _run_command(
+        self,
+        cmd: list[Any],
+        timeout: float,
+        stdout: int | None = subprocess.DEVNULL,
+    ) -> CommandResult:
+        command = Command(cmd, stdout=stdout)
+        result = command.run(timeout=timeout)
+        logging.debug(
+            f"Run {' '.join(command.argv)} with result {result.returncode} in {result.wall_time:.1f}s, cpu {result.cpu_time:.1f}s, peak rss {result.max_rss // (1024 * 1024)} MB"
+        )
         return result
 
-    def _get_extension(self, filename):
+    def _ffmpeg_errors(self, errors: str) -> int:
+        if not errors:
+            return Command.NO_ERROR
+
+        for line in errors.splitlines()[:6]:
+            logging.debug(f"_ffmpeg_errors: {line.rstrip()}")
+
+        return -1
+
+    def _run_ffmpeg(
+        self, source_file: str, converted_audio: str, timeout: float
+    ) -> int:
+        cmd = [FFMPEG, "-nostdin", "-i", source_file, "-ar", SAMPLE_RATE]
+        cmd += ["-ac", "1", "-c:a", "pcm_s16le", converted_audio, "-y"]
+        cmd += ["-loglevel", "error"]
+        output = self._run_command(cmd, timeout)
+        result = self._ffmpeg_errors(output.stderr.decode(errors="replace"))
+        if result == Command.NO_ERROR and output.returncode != 0:
+            result = output.returncode
+
+        return result
+
+    def _run_ffmpeg_pipe(
+        self, source_file: str, timeout: float
+    ) -> tuple[int, bytearray | None]:
+        cmd = [FFMPEG, "-nostdin", "-i", source_file, "-ar", SAMPLE_RATE]
+        cmd += ["-ac", "1", "-f", "s16le", "-loglevel", "error", "pipe:1"]
+        output = self._run_command(cmd, timeout, stdout=subprocess.PIPE)
+        if output.returncode == Command.TIMEOUT_ERROR:
+            return Command.TIMEOUT_ERROR, None
+
+        result = self._ffmpeg_errors(output.stderr.decode(errors="replace"))
+        if result == Command.NO_ERROR and (
+            output.returncode != 0 or not output.stdout
+        ):
+            result = Command.ERROR
+
+        if result != Command.NO_ERROR:
+            return result, None
+
+        return result, output.stdout
+
+    def get_duration(self, filename: str, timeout: float = 30) -> float | None:
+        """Return the duration in seconds of filename, None if unknown."""
+        try:
+            media = probe(filename, timeout)
+        except MediaProbeError as exception:
+            logging.debug(f"get_duration. Cannot probe {filename}: {exception}")
+            return None
+
+        return media.duration if media else None
+
+    def _get_extension(self, filename: str) -> str:
         extension = "mp4"
-        split_tup = os.path.splitext(filename)
-        if len(split_tup) > 0 and len(split_tup[1]) > 0:
-            extension = split_tup[1]
-            extension = extension[1:]
+        suffix = Path(filename).suffix
+        if len(suffix) > 0:
+            extension = suffix[1:]
 
         return extension
 
-    def _sox_errors(self, sox_errfile):
-        return_code = Command.NO_ERROR
-        try:
-            if os.path.getsize(sox_errfile) == 0:
-                return return_code
+    def _sox_errors(self, errors: str) -> int:
+        if not errors:
+            return Command.NO_ERROR
 
-            return_code = -1
-            cnt = 0
-            with open(sox_errfile, "r") as fh:
-                for line in fh.readlines():
-                    if cnt > 5:
-                        break
+        for line in errors.splitlines()[:6]:
+            logging.debug(f"_sox_errors: {line.rstrip()}")
 
-                    logging.debug(f"_sox_errors: {line.rstrip()}")
-                    cnt += 1
+        return -1
 
-            return return_code
-        except Exception as exception:
-            logging.error(f"_sox_errors. Error: {exception}")
-            return return_code
+    # Some files ffmpeg cannot read are fixed by sox, returns the file
+    # written by sox in work_dir
+    def _run_sox(
+        self,
+        original_filename: str,
+        source_file: str,
+        timeout: float,
+        work_dir: str | None = None,
+    ) -> tuple[int, str]:
+        if work_dir:
+            converted_audio_fix = str(Path(work_dir) / "sox.wav")
+        else:
+            fd, converted_audio_fix = tempfile.mkstemp(suffix=".wav")
+            os.close(fd)
+
+        _format = self._get_extension(original_filename)
+        cmd = ["sox", "-t", _format, source_file, converted_audio_fix]
+        output = self._run_command(cmd, timeout)
+        result = self._sox_errors(output.stderr.decode(errors="replace"))
+        if result == Command.NO_ERROR and output.returncode != 0:
+            result = output.returncode
+
+        return result, converted_audio_fix
 
     def run_conversion(
         self,
@@ -136,107 +678,302 @@ class Execution(object):
         source_file: str,
         converted_audio: str,
         timeout: int,
-    ):
+        work_dir: str | None = None,
+    ) -> int:
+        """Convert source_file to the wav file converted_audio."""
         result = self._run_ffmpeg(source_file, converted_audio, timeout)
         if result != Command.NO_ERROR:
-            converted_audio_fix = tempfile.NamedTemporaryFile().name + ".wav"
+            result, converted_audio_fix = self._run_sox(
+                original_filename, source_file, timeout, work_dir
+            )
+            if result == Command.NO_ERROR:
+                result = self._run_ffmpeg(
+                    converted_audio_fix, converted_audio, timeout
+                )
+
+            Path(converted_audio_fix).unlink(missing_ok=True)
 
-            _format = self._get_extension(original_filename)
-            sox_errfile = "sox-error.log"
+        return result
 
-            cmd = (
-                f"sox -t {_format} {source_file} {converted_audio_fix} 2> {sox_errfile}"
+    def decode_audio(
+        self,
+        original_filename: str,
+        source_file: str,
+        timeout: int,
+        work_dir: str | None = None,
+    ) -> tuple[int, bytes | None]:
+        """
+        Decode source_file to 16 kHz mono s16le samples in memory.
+
+        Returns the result and the samples, None if there was an error.
+        Used instead of run_conversion when the engine supports samples,
+        so no wav file is written and read back. work_dir is where the
+        file repaired by sox is written, if one is needed.
+        """
+        result, samples = self._run_ffmpeg_pipe(source_file, timeout)
+        if result != Command.NO_ERROR:
+            result, converted_audio_fix = self._run_sox(
+                original_filename, source_file, timeout, work_dir
             )
-            Command(cmd).run(timeout=timeout)
-            result = self._sox_errors(sox_errfile)
-            logging.debug(f"Run {cmd} with result {result}")
-            if result != Command.NO_ERROR:
-                return result
+            if result == Command.NO_ERROR:
+                result, samples = self._run_ffmpeg_pipe(
+                    converted_audio_fix, timeout
+                )
 
-            result = self._run_ffmpeg(converted_audio_fix, converted_audio, timeout)
+            Path(converted_audio_fix).unlink(missing_ok=True)
 
-        return result
+        return result, samples
+
+    def _get_audio_duration(
+        self, converted_audio: str, samples: bytes | None
+    ) -> float:
+        if samples is not None:
+            return longaudio.get_duration(samples)
 
-    def _whisper_errors(self, whisper_errfile):
         try:
-            if os.path.getsize(whisper_errfile) == 0:
-                return
+            return longaudio.get_wav_duration(converted_audio)
+        except Exception as exception:
+            logging.debug(f"_get_audio_duration. {converted_audio}: {exception}")
+            return 0
+
+    def _transcribe_long(
+        self,
+        converted_audio: str,
+        samples: bytes | None,
+        duration: float,
+        workers: int,
+        args: tuple[str, str, float, dict, str],
+    ) -> int:
+        """
+        Transcribe a long recording in chunks, workers at the same time.
+
+        The cuts are done at silences close to equal length chunks. The
+        json output of each chunk is joined, with its times moved to where
+        the chunk starts, and the txt and srt are written again from it.
+        """
+        try:
+            return self._transcribe_chunks(
+                converted_audio, samples, duration, workers, args
+            )
+        except Exception as exception:
+            logging.error(f"_transcribe_long. Error transcribing {converted_audio}: {exception}")
+            return Command.ERROR
+
+    def _transcribe_chunks(
+        self,
+        converted_audio: str,
+        samples: bytes | None,
+        duration: float,
+        workers: int,
+        args: tuple[str, str, float, dict, str],
+    ) -> int:
+        model, device, timeout, options, output_dir = args
+        if samples is None:
+            samples = longaudio.read_samples(converted_audio)
+
+        silences = longaudio.find_silences(samples)
+        split_points = longaudio.choose_split_points(duration, silences, workers)
+        chunks = longaudio.get_chunks(duration, split_points)
+        logging.info(
+            f"Transcribing {converted_audio} ({duration:.0f}s) in {len(chunks)} chunks split at {split_points}"
+        )
+
+        name = Path(converted_audio).name.rsplit(".", 1)[0]
+        # Inside the job directory, so it is removed with the job
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=output_dir) as chunks_dir:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = []
+                for index, (start, end) in enumerate(chunks):
+                    chunk_samples = longaudio.slice_samples(samples, start, end)
+                    chunk_audio = str(Path(chunks_dir) / f"{name}-{index}.wav")
+                    if not self.engine.supports_samples:
+                        longaudio.write_samples(chunk_audio, chunk_samples)
+                        chunk_samples = None
+
+                    futures.append(
+                        pool.submit(
+                            self.engine.transcribe,
+                            chunk_audio,
+                            str(Path(chunks_dir) / str(index)),
+                            model,
+                            device,
+                            timeout,
+                            options,
+                            samples=chunk_samples,
+                        )
+                    )
+
+                results = [future.result() for future in futures]
+
+            for result in [Command.RUNTIME_ERROR, Command.TIMEOUT_ERROR]:
+                if result in results:
+                    return result
 
-            with open(whisper_errfile, "r") as fh:
-                for line in fh.readlines():
-                    logging.error(f"_whisper_errors: {line.rstrip()}")
+            if any(result != Command.NO_ERROR for result in results):
+                return Command.ERROR
 
+            outputs = []
+            for index in range(len(chunks)):
+                json_file = Path(chunks_dir) / str(index) / f"{name}-{index}.json"
+                with json_file.open("r") as fh:
+                    outputs.append(json.load(fh))
+
+        offsets = [start for start, _ in chunks]
+        result = longaudio.merge_results(outputs, offsets)
+        write_outputs(result, converted_audio, output_dir, options)
+        return Command.NO_ERROR
+
+    def detect_language(
+        self,
+        converted_audio: str,
+        model: str,
+        samples: bytes | None = None,
+        device: str | None = None,
+    ) -> tuple[str, float] | None:
+        """
+        Identify the language from a few short windows spread through the
+        audio, before transcribing it.
+
+        Returns the language and its probability, or None if the engine
+        cannot identify it.
+        """
+        if not self.engine.detects_language:
+            return None
+
+        if not device:
+            device = os.environ.get("DEVICE", "cpu")
+
+        duration = self._get_audio_duration(converted_audio, samples)
+        windows = []
+        for start, end in longaudio.get_windows(
+            duration, _get_language_windows(), LANGUAGE_WINDOW_SECONDS
+        ):
+            if samples is not None:
+                windows.append(longaudio.slice_samples(samples, start, end))
+            else:
+                windows.append(longaudio.read_samples(converted_audio, start, end))
+
+        start_time = time.monotonic()
+        try:
+            detected = self.engine.detect_language(windows, model, device)
         except Exception as exception:
-            logging.error(f"_whisper_errors. Error: {exception}")
+            logging.error(f"detect_language. Error with {converted_audio}: {exception}")
+            return None
+
+        logging.debug(
+            f"detect_language. {converted_audio} detected {detected} in {time.monotonic() - start_time:.1f}s"
+        )
+        return detected
+
+    def estimate_cpu_time(
+        self, model: str, converted_audio: str, samples: bytes | None = None
+    ) -> float:
+        """Estimate the CPU time transcribing the audio takes."""
+        duration = self._get_audio_duration(converted_audio, samples)
+        ratio = self.cpu_per_audio_second.get(
+            model, CPU_SECONDS_PER_AUDIO_SECOND.get(model, 1.0)
+        )
+        return duration * ratio
 
     def run_inference(
         self,
-        original_filename: str,
+        original_filename: str,  # noqa: ARG002
         model: str,
         converted_audio: str,
         timeout: int,
         highlight_words: Optional[int] = None,
         num_chars: Optional[int] = None,
         num_sentences: Optional[int] = None,
-        device=None,
-        remove_file=True,
-    ):
-        WHISPER_PATH = "whisper-ctranslate2"
-        OUTPUT_DIR = "output_dir/"
-        options = ""
-        word_timestamps = False
-
-        if highlight_words:
-            options += " --highlight_words True"
-            word_timestamps = True
-
-        if num_chars:
-            options += f" --max_line_width {num_chars}"
-            word_timestamps = True
-
-        if num_sentences:
-            options += f" --max_line_count {num_sentences}"
-            word_timestamps = True
-
-        if word_timestamps:
-            options += " --word_timestamps True"
+        *,
+        device: str | None = None,
+        remove_file: bool = True,
+        samples: bytes | None = None,
+        output_dir: str | None = None,
+    ) -> tuple[dt.timedelta, int, str, str, str]:
+        """
+        Transcribe the audio and return the time it took, the result and
+        the txt, srt and json files written.
+        """
+        # The outputs are named after converted_audio and written next to
+        # it unless output_dir is given, so each job should have its own
+        if not output_dir:
+            output_dir = str(Path(converted_audio).absolute().parent)
+
+        options = {
+            "highlight_words": bool(highlight_words),
+            "max_line_width": num_chars or None,
+            "max_line_count": num_sentences or None,
+        }
+        options["word_timestamps"] = bool(
+            highlight_words or num_chars or num_sentences
+        )
 
         logging.debug(f"Options: {options}")
-        start_time = datetime.datetime.now()
-        compute_type = os.environ.get("COMPUTE_TYPE", "int8")
-        verbose = os.environ.get("WHISPER_VERBOSE", "false").lower()
+        start_time = dt.datetime.now()
         if not device:
             device = os.environ.get("DEVICE", "cpu")
-        device_index = os.environ.get("DEVICE_INDEX", "0")
-        redirect = " > /dev/null" if verbose == "false" else ""
-
-        whisper_errfile = "whisper_error.log"
-        cmd = f"{WHISPER_PATH} {options} --pretty_json True --local_files_only True --compute_type {compute_type} --verbose True --threads {self.threads} --model {model} --output_dir {OUTPUT_DIR} --language ca --device {device} --device_index {device_index} {converted_audio} {redirect} 2> {whisper_errfile}"
-        result = Command(cmd).run(timeout=timeout)
-        if result != Command.NO_ERROR:
-            self._whisper_errors(whisper_errfile)
-
-        end_time = datetime.datetime.now() - start_time
 
-        logging.debug(f"Run {cmd} in {end_time} with result {result}")
-
-        if remove_file and os.path.exists(converted_audio):
-            os.remove(converted_audio)
-
-        filename = os.path.basename(converted_audio).rsplit(".", 1)[0]
-        target_file_txt = os.path.abspath(os.path.join(OUTPUT_DIR, filename + ".txt"))
-        target_file_srt = os.path.abspath(os.path.join(OUTPUT_DIR, filename + ".srt"))
-        target_file_json = os.path.abspath(os.path.join(OUTPUT_DIR, filename + ".json"))
+        workers = _get_long_audio_workers()
+        duration = self._get_audio_duration(converted_audio, samples)
+        # Only the CPU used by the inference: the in process one, without
+        # the threads that were already running (the next job is converted
+        # and the previous one finished meanwhile), and the one of the
+        # inference commands. The threads of the chunks start after this
+        inference_cpu = self._inference_cpu
+        process_cpu = time.process_time()
+        threads_cpu = _get_threads_cpu()
+        if workers > 1 and duration >= _get_long_audio_min_duration():
+            result = self._transcribe_long(
+                converted_audio,
+                samples,
+                duration,
+                workers,
+                (model, device, timeout, options, output_dir),
+            )
+        else:
+            result = self.engine.transcribe(
+                converted_audio,
+                output_dir,
+                model,
+                device,
+                timeout,
+                options,
+                samples=samples,
+            )
+        end_time = dt.datetime.now() - start_time
+        process_cpu = time.process_time() - process_cpu
+        threads_end = _get_threads_cpu(threads_cpu.keys())
+        for ident, start in threads_cpu.items():
+            process_cpu -= threads_end.get(ident, start) - start
+
+        cpu_time = max(0, process_cpu) + self._inference_cpu - inference_cpu
+        logging.debug(f"Inference of {converted_audio} used {cpu_time:.1f}s of CPU")
+        if result == Command.NO_ERROR and duration > 0:
+            self.cpu_per_audio_second[model] = cpu_time / duration
+
+        logging.debug(
+            f"Inference of {converted_audio} with {self.engine.name} engine in {end_time} with result {result}"
+        )
+
+        if remove_file:
+            Path(converted_audio).unlink(missing_ok=True)
+
+        filename = Path(converted_audio).name.rsplit(".", 1)[0]
+        target_file_txt = str((Path(output_dir) / f"{filename}.txt").absolute())
+        target_file_srt = str((Path(output_dir) / f"{filename}.srt").absolute())
+        target_file_json = str((Path(output_dir) / f"{filename}.json").absolute())
         return end_time, result, target_file_txt, target_file_srt, target_file_json
 
-    def get_transcription_language(self, file_txt):
+    def get_transcription_language(self, file_txt: str) -> str:
+        """Identify the language of a transcription, ca if unsure."""
         language = "ca"
 
         try:
             ONE_KB = 1024
-            size = os.path.getsize(file_txt)
+            size = Path(file_txt).stat().st_size
             if size >= 512 and size <= 1024 * ONE_KB:
-                with open(file_txt, "r") as fh:
+                with Path(file_txt).open("r") as fh:
                     all_text = fh.read()
                     _lang = detect_langs(all_text)[0]
                     language = _lang.lang
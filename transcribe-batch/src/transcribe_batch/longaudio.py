@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import copy
+import wave
+from typing import Any
+
+# The audio is 16 kHz mono s16le, see Execution.decode_audio
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 2
+
+# Length of the windows in which the audio level is measured
+FRAME_SECONDS = 0.1
+
+
+def find_silences(
+    samples: bytes, min_silence: float = 0.5, threshold_db: float = -40
+) -> list[tuple[float, float]]:
+    """
+    Return the (start, end) in seconds of the silences in samples.
+
+    A silence is at least min_silence seconds of windows with a level
+    below threshold_db (relative to full scale).
+    """
+    import numpy as np
+
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+    audio = np.frombuffer(samples, np.int16)
+    frames = len(audio) // frame
+    if frames == 0:
+        return []
+
+    audio = audio[: frames * frame].reshape(frames, frame).astype(np.float32)
+    rms = np.sqrt(np.mean(np.square(audio / 32768.0), axis=1))
+    quiet = rms < 10 ** (threshold_db / 20)
+
+    silences = []
+    start = None
+    for index, is_quiet in enumerate(quiet.tolist() + [False]):
+        if is_quiet and start is None:
+            start = index
+        elif not is_quiet and start is not None:
+            if (index - start) * FRAME_SECONDS >= min_silence:
+                silences.append((start * FRAME_SECONDS, index * FRAME_SECONDS))
+
+            start = None
+
+    return silences
+
+
+def choose_split_points(
+    duration: float,
+    silences: list[tuple[float, float]],
+    chunks: int,
+    window: float = 60,
+) -> list[float]:
+    """
+    Return where to cut duration seconds of audio in chunks of similar length.
+
+    Each cut goes to the middle of the silence closest to the ideal point,
+    if there is one less than window seconds away, or to the ideal point.
+    """
+    points = []
+    for index in range(1, chunks):
+        ideal = duration * index / chunks
+        best = None
+        for start, end in silences:
+            middle = (start + end) / 2
+            if abs(middle - ideal) > window:
+                continue
+
+            if best is None or abs(middle - ideal) < abs(best - ideal):
+                best = middle
+
+        point = ideal if best is None else best
+        if not points or point > points[-1]:
+            points.append(round(point, 3))
+
+    return points
+
+
+def get_chunks(
+    duration: float, split_points: list[float]
+) -> list[tuple[float, float]]:
+    """Return the (start, end) of the chunks between the split points."""
+    starts = [0, *split_points]
+    ends = [*split_points, duration]
+    return list(zip(starts, ends, strict=True))
+
+
+def slice_samples(samples: bytes, start: float, end: float) -> bytes:
+    """Return the samples between start and end seconds."""
+    first = int(start * SAMPLE_RATE) * BYTES_PER_SAMPLE
+    last = int(end * SAMPLE_RATE) * BYTES_PER_SAMPLE
+    return samples[first:last]
+
+
+def get_duration(samples: bytes) -> float:
+    """Return the duration of samples in seconds."""
+    return len(samples) / (SAMPLE_RATE * BYTES_PER_SAMPLE)
+
+
+def get_wav_duration(wav_file: str) -> float:
+    """Return the duration of wav_file in seconds."""
+    with wave.open(wav_file, "rb") as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def get_windows(
+    duration: float, count: int, length: float
+) -> list[tuple[float, float]]:
+    """
+    Return the (start, end) of count windows of length seconds spread
+    evenly through duration, or the whole audio if it is shorter.
+    """
+    if duration <= count * length:
+        return [(0, duration)]
+
+    windows = []
+    for index in range(count):
+        middle = duration * (index + 0.5) / count
+        windows.append((middle - length / 2, middle + length / 2))
+
+    return windows
+
+
+def read_samples(
+    wav_file: str, start: float = 0, end: float | None = None
+) -> bytes:
+    """Return the samples of wav_file between start and end seconds."""
+    with wave.open(wav_file, "rb") as wav:
+        first = int(start * wav.getframerate())
+        last = (
+            wav.getnframes() if end is None else int(end * wav.getframerate())
+        )
+        wav.setpos(min(first, wav.getnframes()))
+        return wav.readframes(max(0, last - first))
+
+
+def write_samples(wav_file: str, samples: bytes) -> None:
+    """Write samples to wav_file."""
+    with wave.open(wav_file, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(BYTES_PER_SAMPLE)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples)
+
+
+def merge_results(
+    results: list[dict[str, Any]], offsets: list[float]
+) -> dict[str, Any]:
+    """
+    Join the transcriptions of consecutive chunks in a single one.
+
+    results are the json outputs of each chunk and offsets where each
+    chunk starts in seconds. The times are moved by the offset of their
+    chunk and the segments numbered again.
+    """
+    segments = []
+    text = ""
+    for result, offset in zip(results, offsets, strict=True):
+        text += result.get("text", "")
+        for segment in result.get("segments", []):
+            segment = copy.deepcopy(segment)
+            segment["id"] = len(segments) + 1
+            segment["start"] = round(segment["start"] + offset, 3)
+            segment["end"] = round(segment["end"] + offset, 3)
+            if "seek" in segment:
+                # In mel frames, 100 per second
+                segment["seek"] += int(offset * 100)
+
+            for word in segment.get("words") or []:
+                word["start"] = round(word["start"] + offset, 3)
+                word["end"] = round(word["end"] + offset, 3)
+
+            segments.append(segment)
+
+    language = results[0].get("language") if results else None
+    return {"text": text, "segments": segments, "language": language}
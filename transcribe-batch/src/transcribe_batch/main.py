@@ -20,33 +20,61 @@
 
 from __future__ import print_function
 
-import datetime
+import datetime as dt
+import functools
 import logging
 import logging.handlers
 import os
+import shutil
+import signal
+import socket
+import sys
 import tempfile
+import threading
 import time
-
-from transcribe_core.batchfilesdb import BatchFilesDB
+from collections.abc import Callable
+from pathlib import Path
+from types import FrameType
+
+from transcribe_core.batchfilesdb import (
+    NOTIFICATIONS,
+    BatchFile,
+    BatchFilesDB,
+)
 from transcribe_core.processedfiles import ProcessedFiles
 from transcribe_core.usage import Usage
 
+from transcribe_batch import longaudio
+from transcribe_batch.devicecheck import DeviceCheckCache, get_cache_key
 from transcribe_batch.execution import Command, Execution
-from transcribe_batch.lockfile import LockFile
+from transcribe_batch.pipeline import LeaseKeeper, Prefetcher, Stage
+from transcribe_batch.queuewatcher import QueueWatcher
+from transcribe_batch.scheduling import SchedulingPolicy, get_policy
 from transcribe_batch.sendmail import Sendmail
 from transcribe_batch.telemetry.metrics import (
     language_detected_counter,
+    language_rejected_cpu_saved_counter,
     processed_files_counter,
+    queue_wait_histogram,
+    scheduling_policy_gauge,
+    transcription_cache_counter,
     transcription_duration_histogram,
 )
 
 LOGID = os.environ.get("LOGID", "0")
 
+# Length of the clip transcribed by the fast device check
+FAST_CHECK_SECONDS = 5
+
+NOT_CATALAN_LANGUAGES = ["es", "en", "fr"]
+NOT_CATALAN_MESSAGE = "Aquest servei només transcriu textos en català. El fitxer que heu enviat és en un altra llengua.\n"
 
-def init_logging():
+
+def init_logging() -> None:
+    """Log to the worker log file and to the console."""
     LOGDIR = os.environ.get("LOGDIR", "")
     LOGLEVEL = os.environ.get("LOGLEVEL", "INFO").upper()
-    logfile = os.path.join(LOGDIR, f"process-batch-{LOGID}.log")
+    logfile = Path(LOGDIR) / f"process-batch-{LOGID}.log"
     logger = logging.getLogger()
     hdlr = logging.handlers.RotatingFileHandler(
         logfile, maxBytes=1024 * 1024, backupCount=1
@@ -63,38 +91,97 @@ def init_logging():
     logger.addHandler(console)
 
 
-def _check_device(device):
+def _get_device_check_mode() -> str:
+    # full transcribes the test audio with the medium model, fast a few
+    # seconds of it with the small one
+    return os.environ.get("DEVICE_CHECK_MODE", "full").lower()
+
+
+def _get_device_check_ttl() -> float:
+    return float(os.environ.get("DEVICE_CHECK_TTL", 60 * 60 * 24))
+
+
+def _get_device_check_cache() -> str:
+    # On the data volume, so it is kept when the containers are restarted
+    return os.environ.get("DEVICE_CHECK_CACHE", "/srv/data/device-check.json")
+
+
+def _run_device_test(
+    execution: Execution,
+    device: str,
+    model: str,
+    filename: str,
+    output_dir: str,
+    *,
+    fast: bool,
+) -> int:
+    TEST_TIMEOUT = 60
+
+    converted_audio = filename
+    if fast:
+        converted_audio = str(Path(output_dir) / "test_audio.wav")
+        result = execution.run_conversion(
+            filename, filename, converted_audio, TEST_TIMEOUT, output_dir
+        )
+        if result != Command.NO_ERROR:
+            return result
+
+        samples = longaudio.read_samples(
+            converted_audio, 0, FAST_CHECK_SECONDS
+        )
+        longaudio.write_samples(converted_audio, samples)
+
+    _, result, _, _, _ = execution.run_inference(
+        device=device,
+        original_filename=filename,
+        model=model,
+        converted_audio=converted_audio,
+        timeout=TEST_TIMEOUT,
+        remove_file=False,
+        output_dir=output_dir,
+    )
+    return result
+
+
+def _check_device(device: str, execution: Execution) -> None:
     devices = [device]
     if device == "cuda":
         devices.append("cpu")
 
-    filename = os.path.join("audio", "test_audio.mp3")
-    TEST_TIMEOUT = 60
-    execution = Execution(_get_threads())
+    filename = str(Path("audio") / "test_audio.mp3")
+    fast = _get_device_check_mode() == "fast"
+    model = "small" if fast else "medium"
+    cache = DeviceCheckCache(
+        _get_device_check_cache(), _get_device_check_ttl()
+    )
+    key = get_cache_key(device, model, execution.engine.name)
+    cached_device = cache.get(key)
+    if cached_device:
+        if cached_device != device:
+            os.environ["DEVICE"] = cached_device
+
+        logging.info(
+            f"Worker {LOGID} device {cached_device} passed a recent check, skipping the test"
+        )
+        return
 
     for try_device in devices:
-        inference_time, result, target_file_txt, _, _ = (
-            execution.run_inference(
-                device=try_device,
-                original_filename=filename,
-                model="medium",
-                converted_audio=filename,
-                timeout=TEST_TIMEOUT,
-                remove_file=False,
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = _run_device_test(
+                execution, try_device, model, filename, output_dir, fast=fast
             )
-        )
+
         if result == Command.NO_ERROR:
+            cache.set(key, try_device)
             if device == try_device:
                 logging.info(
                     f"Worker {LOGID} device {try_device} working properly"
                 )
                 return
-            else:
-                os.environ["DEVICE"] = try_device
-                logging.info(
-                    f"Worker {LOGID} downgrading to device {try_device}"
-                )
-                return
+
+            os.environ["DEVICE"] = try_device
+            logging.info(f"Worker {LOGID} downgrading to device {try_device}")
+            return
 
         logging.error(f"Worker {LOGID} unable to use {try_device} device")
 
@@ -105,17 +192,15 @@ def _check_device(device):
         time.sleep(1_000_000)
 
 
-def _get_extension(original_filename):
-    split_tup = os.path.splitext(original_filename)
-
-    file_extension = split_tup[1]
+def _get_extension(original_filename: str) -> str:
+    file_extension = Path(original_filename).suffix
     if file_extension == "":
         file_extension = ".bin"
 
     return file_extension
 
 
-def _get_model_file(model_name):
+def _get_model_file(model_name: str) -> str:
     if model_name == "small":
         model = "small"
     elif model_name == "medium":
@@ -126,7 +211,7 @@ def _get_model_file(model_name):
     return model
 
 
-def _get_threads():
+def _get_threads() -> int | str:
     return os.environ.get("THREADS", 4)
 
 
@@ -134,7 +219,88 @@ def _get_timeout() -> int:
     return int(os.environ.get("TIMEOUT_CMD", 60 * 90))
 
 
-def _send_mail(batchfile, inference_time, source_file_base):
+def _get_work_dir() -> str | None:
+    # Where the job directories are created, the system default if not set
+    return os.environ.get("WORK_DIR") or None
+
+
+def _get_worker_id() -> str:
+    return f"{socket.gethostname()}-{LOGID}"
+
+
+def _claim_next(
+    db: BatchFilesDB, batchfiles: list[BatchFile], worker_id: str
+) -> BatchFile | None:
+    for batchfile in batchfiles:
+        claimed = db.claim(batchfile.filename_dbrecord, worker_id)
+        if claimed:
+            batchfile.filename_dbrecord = claimed
+            return batchfile
+
+        logging.debug(
+            f"Worker {LOGID} lost {batchfile.filename_dbrecord} to another worker"
+        )
+
+    return None
+
+
+def _lost_lease(db: BatchFilesDB, batchfile: BatchFile) -> bool:
+    if db.renew(batchfile.filename_dbrecord):
+        return False
+
+    logging.warning(
+        f"Worker {LOGID} lost the lease of {batchfile.filename_dbrecord}, another worker took it over"
+    )
+    return True
+
+
+def _release_claimed(db: BatchFilesDB, worker_id: str) -> None:
+    for filename in db.get_claimed(worker_id):
+        logging.info(f"Worker {LOGID} releasing unfinished {filename}")
+        db.release(filename)
+
+
+def _get_lease_timeout() -> float:
+    return float(os.environ.get("LEASE_TIMEOUT", 60 * 5))
+
+
+def _get_scheduling_policy(execution: Execution) -> SchedulingPolicy:
+    name = os.environ.get("SCHEDULING_POLICY", "fifo").lower()
+    aging = float(os.environ.get("SCHEDULING_AGING", 0.5))
+    half_life = float(os.environ.get("SCHEDULING_FAIR_HALF_LIFE", 60 * 60))
+    policy = get_policy(
+        name, aging=aging, probe=execution.get_duration, half_life=half_life
+    )
+    scheduling_policy_gauge.set(1, {"policy": policy.name, "worker": LOGID})
+    logging.info(f"Worker {LOGID} using scheduling policy {policy.name}")
+    return policy
+
+
+def _get_prefetch() -> int:
+    # Number of jobs claimed and converted ahead of the one being transcribed
+    return max(0, int(os.environ.get("PIPELINE_PREFETCH", 1)))
+
+
+def _get_early_language_detection() -> bool:
+    return os.environ.get("EARLY_LANGUAGE_DETECTION", "true").lower() == "true"
+
+
+def _get_early_language_threshold() -> float:
+    # Catalan is often taken for Spanish, only reject when it is clear
+    return float(os.environ.get("EARLY_LANGUAGE_THRESHOLD", 0.8))
+
+
+def _get_poll_interval() -> tuple[float, float]:
+    min_wait = float(os.environ.get("QUEUE_POLL_MIN", 1))
+    max_wait = float(os.environ.get("QUEUE_POLL_MAX", 30))
+    return min_wait, max_wait
+
+
+def _send_mail(
+    batchfile: BatchFile,
+    inference_time: dt.timedelta | float,  # noqa: ARG001
+    source_file_base: str,
+) -> None:
     context = {
         "uuid": source_file_base,
         "filename": batchfile.original_filename,
@@ -143,7 +309,12 @@ def _send_mail(batchfile, inference_time, source_file_base):
     Sendmail().send_html(batchfile.email, "transcription-finished", context)
 
 
-def _send_mail_error(batchfile, inference_time, source_file_base, message):
+def _send_mail_error(
+    batchfile: BatchFile,
+    inference_time: dt.timedelta | float,  # noqa: ARG001
+    source_file_base: str,  # noqa: ARG001
+    message: str,
+) -> None:
     logging.info(f"_send_mail_error: {message} to {batchfile.email}")
     context = {
         "message": message,
@@ -153,187 +324,616 @@ def _send_mail_error(batchfile, inference_time, source_file_base, message):
     Sendmail().send_html(batchfile.email, "transcription-error", context)
 
 
-def _delete_record(db, batchfile, converted_audio):
+def _get_content_key(batchfile: BatchFile) -> str | None:
+    if not batchfile.content_hash:
+        return None
+
+    return ProcessedFiles.get_content_key(
+        batchfile.content_hash,
+        batchfile.model_name,
+        batchfile.highlight_words,
+        batchfile.num_chars,
+        batchfile.num_sentences,
+    )
+
+
+def _is_cached(batchfile: BatchFile) -> bool:
+    key = _get_content_key(batchfile)
+    return bool(key and ProcessedFiles.find_by_content(key))
+
+
+def _cached_first(batchfiles: list[BatchFile]) -> list[BatchFile]:
+    # Jobs that can reuse an existing transcription take no time, serve them
+    # before any policy ordered job
+    cached = []
+    pending = []
+    for batchfile in batchfiles:
+        if _is_cached(batchfile):
+            cached.append(batchfile)
+        else:
+            pending.append(batchfile)
+
+    return cached + pending
+
+
+def _reuse_transcription(
+    db: BatchFilesDB,
+    batchfile: BatchFile,
+    processed: ProcessedFiles,
+    source_file_base: str,
+) -> bool:
+    key = _get_content_key(batchfile)
+    if key is None:
+        return False
+
+    cached_uuid = ProcessedFiles.find_by_content(key)
+    if cached_uuid is None or not processed.reuse_outputs(cached_uuid):
+        transcription_cache_counter.add(1, {"result": "miss"})
+        return False
+
+    transcription_cache_counter.add(1, {"result": "hit"})
+    logging.info(
+        f"File for {batchfile.email} reuses the transcription of {cached_uuid}"
+    )
+    _send_mail(batchfile, 0, source_file_base)
+    processed.move_file(batchfile.filename_dbrecord)
+    db.delete(batchfile.filename_dbrecord)
+    extension = _get_extension(batchfile.original_filename)
+    processed.move_file_bin(batchfile.filename, extension)
+    processed.register_content(key)
+    model = _get_model_file(batchfile.model_name)
+    processed_files_counter.add(1, {"model": model, "result": "cache_hit"})
+    return True
+
+
+def _notify_cached(db: BatchFilesDB, batchfile: BatchFile) -> None:
+    # The service has already finished the job with the outputs of an
+    # identical upload, only the email is left
+    transcription_cache_counter.add(1, {"result": "hit"})
+    _send_mail(batchfile, 0, Path(batchfile.filename).name)
+    db.delete(batchfile.filename_dbrecord)
+    model = _get_model_file(batchfile.model_name)
+    processed_files_counter.add(1, {"model": model, "result": "cache_hit"})
+
+
+def _delete_record(db: BatchFilesDB, batchfile: BatchFile) -> None:
     db.delete(batchfile.filename_dbrecord)
 
-    if os.path.isfile(batchfile.filename):
-        os.remove(batchfile.filename)
+    if Path(batchfile.filename).is_file():
+        Path(batchfile.filename).unlink()
         logging.debug(f"Deleted {batchfile.filename}")
 
-    if os.path.exists(converted_audio):
-        os.remove(converted_audio)
 
-    LockFile(batchfile.filename_dbrecord).delete()
+def _run_task(task: Callable[[], None]) -> None:
+    task()
 
 
-def main():
-    init_logging()
+class Job(object):
+    """A claimed batch file moving through the pipeline stages."""
 
-    device = os.environ.get("DEVICE", "cpu")
+    def __init__(self, batchfile: BatchFile, out_dir: str) -> None:
+        """Create the job and its working directory inside out_dir."""
+        self.batchfile = batchfile
+        self.model = _get_model_file(batchfile.model_name)
+        self.source_file_base = Path(batchfile.filename).name
+        self.processed = ProcessedFiles(self.source_file_base)
+        # Everything the job writes (converted audio, files repaired by sox,
+        # outputs, chunks) goes in its own directory, so jobs of this and
+        # other workers never share a file
+        self.work_dir = tempfile.mkdtemp(
+            prefix=f"{self.source_file_base}-", dir=out_dir
+        )
+        # When streaming it is never written, it only names the outputs
+        self.converted_audio = str(
+            Path(self.work_dir) / f"{self.source_file_base}.wav"
+        )
+        self.samples = None
+        # Jobs prepared while another one runs are claimed when they start
+        self.claimed = False
+        self.conversion_result = Command.NO_ERROR
+        self.conversion_time = 0
+        self.processing_time = 0
+
+    def cleanup(self) -> None:
+        """Free the samples and remove the working directory."""
+        self.samples = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def _finish_error(
+    db: BatchFilesDB,
+    keeper: LeaseKeeper,
+    job: Job,
+    inference_time: dt.timedelta | float,
+    message: str,
+    action: str,
+) -> None:
+    keeper.drop(job.batchfile.filename_dbrecord)
+    _delete_record(db, job.batchfile)
+    job.cleanup()
+    Usage().log(action)
+    _send_mail_error(
+        job.batchfile, inference_time, job.source_file_base, message
+    )
+
+
+def _finish_success(
+    db: BatchFilesDB,
+    keeper: LeaseKeeper,
+    job: Job,
+    inference_time: dt.timedelta,
+    target_files: tuple[str, ...],
+    device: str,
+) -> None:
+    batchfile = job.batchfile
+    processed = job.processed
+    _send_mail(batchfile, inference_time, job.source_file_base)
+    logging.info(f"File for {batchfile.email} completed in {inference_time}")
+
+    keeper.drop(batchfile.filename_dbrecord)
+    processed.move_file(batchfile.filename_dbrecord)
+    db.delete(batchfile.filename_dbrecord)
+    for target_file in target_files:
+        processed.move_file(target_file)
+
+    job.cleanup()
+
+    extension = _get_extension(batchfile.original_filename)
+    processed.move_file_bin(batchfile.filename, extension)
+    content_key = _get_content_key(batchfile)
+    if content_key:
+        processed.register_content(content_key)
+
+    processed_files_counter.add(1, {"model": job.model, "result": "success"})
+    transcription_duration_histogram.record(
+        job.processing_time, {"model": job.model, "device": device}
+    )
+
+
+def _is_not_catalan(
+    execution: Execution,
+    job: Job,
+    finisher: Stage,
+    keeper: LeaseKeeper,
+    db: BatchFilesDB,
+) -> bool:
+    detected = execution.detect_language(
+        job.converted_audio, job.model, samples=job.samples
+    )
+    if detected is None:
+        return False
+
+    language, probability = detected
+    if language not in NOT_CATALAN_LANGUAGES:
+        return False
+
+    if probability < _get_early_language_threshold():
+        return False
+
+    cpu_saved = execution.estimate_cpu_time(
+        job.model, job.converted_audio, job.samples
+    )
+    language_detected_counter.add(1, {"language": language, "stage": "early"})
+    language_rejected_cpu_saved_counter.add(cpu_saved, {"language": language})
+    processed_files_counter.add(
+        1, {"model": job.model, "result": "not_catalan"}
+    )
     logging.info(
-        f"Process batch files to transcribe. Worker {LOGID} setup with device {device}"
+        f"Non-Catalan language detected before transcribing: '{language}' ({probability:.2f}) for '{job.batchfile.original_filename}', saved about {cpu_saved:.0f}s of CPU"
     )
-    _check_device(device)
+    finisher.put(
+        functools.partial(
+            _finish_error,
+            db,
+            keeper,
+            job,
+            0,
+            NOT_CATALAN_MESSAGE,
+            "whisper_not_catalan",
+        )
+    )
+    return True
+
+
+class BatchProcessor:
+    """
+    Takes the jobs from the queue and runs them through the pipeline.
+
+    The prefetcher thread picks and converts the next job while the
+    current one is transcribed in the calling thread, and the finisher
+    thread delivers the results. The notifier thread sends the emails of
+    the uploads that the service finished from the cache.
+    """
 
-    db = BatchFilesDB()
-    ProcessedFiles.ensure_dir()
-    purge_last_time = time.time()
     PURGE_INTERVAL_SECONDS = 60 * 60 * 6  # For times per day
     PURGE_OLDER_THAN_DAYS = 3
-    WAV_FILE = "file.wav"
-    execution = Execution(_get_threads())
 
-    temp_dir = tempfile.TemporaryDirectory()
-    out_dir = temp_dir.name
-    while True:
-        batchfiles = db.select()
-        for idx in range(len(batchfiles) - 1, -1, -1):
-            batchfile = batchfiles[idx]
-            if LockFile(batchfile.filename_dbrecord).has_lock():
-                batchfiles.remove(batchfile)
-
-        if len(batchfiles) > 0:
-            batchfile = batchfiles[0]
-            if not LockFile(batchfile.filename_dbrecord).create():
-                time.sleep(5)
-                continue
-
-            source_file = batchfile.filename
+    def __init__(self, execution: Execution, device: str) -> None:
+        """Set up the queue and the pipeline stages, nothing runs yet."""
+        self.execution = execution
+        self.device = device
+        self.db = BatchFilesDB()
+        self.worker_id = _get_worker_id()
+        _release_claimed(self.db, self.worker_id)
+        indexed = self.db.migrate()
+        logging.info(f"Worker {LOGID} found {indexed} records in the queue")
+        ProcessedFiles.ensure_dir()
+        self.purge_last_time = time.time()
+        self.lease_timeout = _get_lease_timeout()
+        self.policy = _get_scheduling_policy(execution)
+        min_wait, max_wait = _get_poll_interval()
+        self.watcher = QueueWatcher(
+            self.db.ENTRIES, min_wait=min_wait, max_wait=max_wait
+        )
+        self.notifications = BatchFilesDB(NOTIFICATIONS, backend="files")
+        _release_claimed(self.notifications, self.worker_id)
+        self.notifications_watcher = QueueWatcher(
+            NOTIFICATIONS, min_wait=min_wait, max_wait=max_wait
+        )
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix=f"transcribe-{LOGID}-", dir=_get_work_dir()
+        )
+        # Renew often enough that a couple of missed renewals do not expire it
+        self.keeper = LeaseKeeper(
+            self.db.renew, interval=self.lease_timeout / 4
+        )
+        prefetch = _get_prefetch()
+        logging.info(f"Worker {LOGID} prefetching {prefetch} jobs")
+        self.finisher = Stage("finisher", _run_task, maxsize=prefetch + 1)
+        # Files being converted ahead by this worker and not claimed yet
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.early_language_detection = _get_early_language_detection()
+        self.prefetcher = Prefetcher(self.prepare, depth=prefetch + 1)
+
+    def _finish_later(
+        self,
+        job: Job,
+        inference_time: dt.timedelta | float,
+        message: str,
+        action: str,
+    ) -> None:
+        self.finisher.put(
+            functools.partial(
+                _finish_error,
+                self.db,
+                self.keeper,
+                job,
+                inference_time,
+                message,
+                action,
+            )
+        )
 
-            logging.info(
-                f"Processing: {source_file} - for {batchfile.email} - pending {len(batchfiles)}"
+    def start(self, job: Job, waiting: int) -> bool:
+        """Start a claimed job, returns False if it is already done."""
+        batchfile = job.batchfile
+        job.claimed = True
+        self.policy.charge(batchfile)
+        if batchfile.enqueued:
+            queue_wait_histogram.record(
+                time.time() - batchfile.enqueued, {"policy": self.policy.name}
             )
 
-            model = _get_model_file(batchfile.model_name)
-            source_file_base = os.path.basename(source_file)
-            processed = ProcessedFiles(source_file_base)
+        logging.info(
+            f"Processing: {batchfile.filename} - for {batchfile.email} - pending {waiting}"
+        )
 
-            converted_audio = os.path.join(out_dir, WAV_FILE)
+        if _reuse_transcription(
+            self.db, batchfile, job.processed, job.source_file_base
+        ):
+            job.cleanup()
+            return False
 
-            timeout = _get_timeout()
-            transcription_start_time = time.time()
-            result = execution.run_conversion(
-                batchfile.original_filename,
-                source_file,
-                converted_audio,
-                timeout,
-            )
+        self.keeper.hold(batchfile.filename_dbrecord)
+        return True
 
-            if result != Command.NO_ERROR:
-                processed_files_counter.add(
-                    1, {"model": model, "result": "conversion_error"}
-                )
-                _delete_record(db, batchfile, converted_audio)
-                msg = "No s'ha pogut llegir el fitxer. Normalment, això succeeix perquè el fitxer que heu enviat no és d'àudio o vídeo o és malmès.\n"
-                msg += "Si està malmès, podeu provar de convertir-lo a una altre format (procés que sol reparar el fitxer) a https://online-audio-converter.com/\n"
-                msg += "i tornar-nos a enviar la versió convertida."
-                Usage().log("conversion_error")
-                _send_mail_error(batchfile, 0, source_file_base, msg)
-                continue
+    def _purge(self) -> None:
+        now = time.time()
+        if now > self.purge_last_time + self.PURGE_INTERVAL_SECONDS:
+            self.purge_last_time = now
+            purged = ProcessedFiles.purge_files(self.PURGE_OLDER_THAN_DAYS)
+            logging.info(
+                f"Purging {dt.datetime.now()}, {purged} files deleted"
+            )
 
-            (
-                inference_time,
-                result,
-                target_file_txt,
-                target_file_srt,
-                target_file_json,
-            ) = execution.run_inference(
+    def _select(self) -> list[BatchFile]:
+        self.db.reclaim_expired(self.lease_timeout)
+        batchfiles = _cached_first(
+            self.policy.order(self.db.select(waiting=True))
+        )
+        with self.pending_lock:
+            return [
+                batchfile
+                for batchfile in batchfiles
+                if batchfile.filename_dbrecord not in self.pending
+            ]
+
+    def _take(self, batchfiles: list[BatchFile]) -> Job | None:
+        # An idle worker claims the job right away. A busy one only
+        # converts the audio and claims the job when it starts, so
+        # meanwhile it stays in the queue for idle workers. Reusing a
+        # transcription takes no time, it never waits
+        if self.prefetcher.is_idle() or _is_cached(batchfiles[0]):
+            batchfile = _claim_next(self.db, batchfiles, self.worker_id)
+            if batchfile is None:
+                return None
+
+            job = Job(batchfile, self.temp_dir.name)
+            if not self.start(job, len(batchfiles)):
+                return None
+
+            return job
+
+        batchfile = batchfiles[0]
+        job = Job(batchfile, self.temp_dir.name)
+        with self.pending_lock:
+            self.pending.add(batchfile.filename_dbrecord)
+
+        return job
+
+    def _convert(self, job: Job) -> None:
+        batchfile = job.batchfile
+        start_time = time.time()
+        if self.execution.streaming:
+            job.conversion_result, job.samples = self.execution.decode_audio(
                 batchfile.original_filename,
-                model,
-                converted_audio,
-                timeout,
-                batchfile.highlight_words,
-                batchfile.num_chars,
-                batchfile.num_sentences,
+                batchfile.filename,
+                _get_timeout(),
+                work_dir=job.work_dir,
             )
+        else:
+            job.conversion_result = self.execution.run_conversion(
+                batchfile.original_filename,
+                batchfile.filename,
+                job.converted_audio,
+                _get_timeout(),
+                work_dir=job.work_dir,
+            )
+        job.conversion_time = time.time() - start_time
+
+    def prepare(self) -> Job | None:
+        """Prepare the next job, run by the prefetcher thread."""
+        self._purge()
+        batchfiles = self._select()
+        if not batchfiles:
+            self.watcher.wait()
+            return None
+
+        # There may be more work waiting, look again right away
+        self.watcher.reset()
+        job = self._take(batchfiles)
+        if job is None:
+            return None
+
+        self._convert(job)
+        return job
+
+    def _claim(self, job: Job) -> bool:
+        """Make sure the job is still ours, returns False to skip it."""
+        batchfile = job.batchfile
+        if job.claimed:
+            if _lost_lease(self.db, batchfile):
+                self.keeper.drop(batchfile.filename_dbrecord)
+                job.cleanup()
+                return False
+
+            return True
+
+        filename_dbrecord = batchfile.filename_dbrecord
+        claimed = self.db.claim(filename_dbrecord, self.worker_id)
+        with self.pending_lock:
+            self.pending.discard(filename_dbrecord)
+
+        if not claimed:
+            logging.debug(
+                f"Worker {LOGID} lost {filename_dbrecord} to another worker"
+            )
+            job.cleanup()
+            return False
 
-            if result == Command.RUNTIME_ERROR:
-                processed_files_counter.add(
-                    1, {"model": model, "result": "runtime_error"}
-                )
-                Usage().log("whisper_runtime_error")
-                logging.error(
-                    f"Runtime error. File '{batchfile.original_filename}' not processed"
-                )
-                time.sleep(3600)  # 1h
-                continue
-
-            if result == Command.TIMEOUT_ERROR:
-                processed_files_counter.add(
-                    1, {"model": model, "result": "timeout_error"}
-                )
-                _delete_record(db, batchfile, converted_audio)
-                minutes = int(timeout / 60)
-                msg = f"Ha trigat massa temps en processar-se. Aturem l'operació després de {minutes} minuts de processament.\n"
-                msg += "Podeu enviar fitxers més curts, usar un model petit o bé usar el client Buzz per fer-ho al vostre PC."
-                Usage().log("whisper_timeout")
-                _send_mail_error(
-                    batchfile, inference_time, source_file_base, msg
-                )
-                continue
+        batchfile.filename_dbrecord = claimed
+        return self.start(job, self.db.count())
 
-            if result != Command.NO_ERROR:
-                processed_files_counter.add(
-                    1, {"model": model, "result": "whisper_error"}
-                )
-                _delete_record(db, batchfile, converted_audio)
-                _send_mail_error(
-                    batchfile,
-                    inference_time,
-                    source_file_base,
-                    "Reviseu que sigui un d'àudio o vídeo vàlid.",
-                )
-                Usage().log("whisper_returns_error")
+    def _hold(self, job: Job) -> None:
+        """Put the worker on hold after a runtime error."""
+        batchfile = job.batchfile
+        processed_files_counter.add(
+            1, {"model": job.model, "result": "runtime_error"}
+        )
+        Usage().log("whisper_runtime_error")
+        logging.error(
+            f"Runtime error. File '{batchfile.original_filename}' not processed"
+        )
+        # Keep the claim on this job while on hold, so the failure does not
+        # move to other workers, and let them take the prefetched ones
+        job.cleanup()
+        for prefetched in self.prefetcher.pause():
+            prefetched.cleanup()
+            if not prefetched.claimed:
                 continue
 
-            language = execution.get_transcription_language(target_file_txt)
-            language_detected_counter.add(1, {"language": language})
-            if language in ["es", "en", "fr"]:
-                processed_files_counter.add(
-                    1, {"model": model, "result": "not_catalan"}
-                )
-                _delete_record(db, batchfile, converted_audio)
-                msg = "Aquest servei només transcriu textos en català. El fitxer que heu enviat és en un altra llengua.\n"
-                _send_mail_error(
-                    batchfile, inference_time, source_file_base, msg
-                )
-                logging.info(
-                    f"Non-Catalan language detected: '{language}' for '{batchfile.original_filename}'"
-                )
-                Usage().log("whisper_not_catalan")
-                continue
+            filename_dbrecord = prefetched.batchfile.filename_dbrecord
+            self.keeper.drop(filename_dbrecord)
+            self.db.release(filename_dbrecord)
+
+        with self.pending_lock:
+            self.pending.clear()
+
+        time.sleep(3600)  # 1h
+        self.keeper.drop(batchfile.filename_dbrecord)
+        self.db.release(batchfile.filename_dbrecord)
+        self.prefetcher.resume()
+
+    def _transcribe(self, job: Job) -> None:
+        batchfile = job.batchfile
+        model = job.model
+        timeout = _get_timeout()
+        inference_start_time = time.time()
+        (
+            inference_time,
+            result,
+            target_file_txt,
+            target_file_srt,
+            target_file_json,
+        ) = self.execution.run_inference(
+            batchfile.original_filename,
+            model,
+            job.converted_audio,
+            timeout,
+            batchfile.highlight_words,
+            batchfile.num_chars,
+            batchfile.num_sentences,
+            samples=job.samples,
+            output_dir=job.work_dir,
+        )
+        job.samples = None
 
-            extension = _get_extension(batchfile.original_filename)
-            _send_mail(batchfile, inference_time, source_file_base)
-            logging.info(
-                f"File for {batchfile.email} completed in {inference_time}"
-            )
+        if _lost_lease(self.db, batchfile):
+            self.keeper.drop(batchfile.filename_dbrecord)
+            job.cleanup()
+            return
 
-            processed.move_file(batchfile.filename_dbrecord)
-            processed.move_file(target_file_srt)
-            processed.move_file(target_file_txt)
-            processed.move_file(target_file_json)
-            processed.move_file_bin(source_file, extension)
-            LockFile(batchfile.filename_dbrecord).delete()
+        if result == Command.RUNTIME_ERROR:
+            self._hold(job)
+            return
 
-            transcription_total_time = time.time() - transcription_start_time
+        if result == Command.TIMEOUT_ERROR:
+            processed_files_counter.add(
+                1, {"model": model, "result": "timeout_error"}
+            )
+            minutes = int(timeout / 60)
+            msg = f"Ha trigat massa temps en processar-se. Aturem l'operació després de {minutes} minuts de processament.\n"
+            msg += "Podeu enviar fitxers més curts, usar un model petit o bé usar el client Buzz per fer-ho al vostre PC."
+            self._finish_later(job, inference_time, msg, "whisper_timeout")
+            return
 
+        if result != Command.NO_ERROR:
             processed_files_counter.add(
-                1, {"model": model, "result": "success"}
+                1, {"model": model, "result": "whisper_error"}
             )
-            transcription_duration_histogram.record(
-                transcription_total_time, {"model": model, "device": device}
+            self._finish_later(
+                job,
+                inference_time,
+                "Reviseu que sigui un d'àudio o vídeo vàlid.",
+                "whisper_returns_error",
             )
+            return
 
-        now = time.time()
-        if now > purge_last_time + PURGE_INTERVAL_SECONDS:
-            purge_last_time = now
-            purged = ProcessedFiles.purge_files(PURGE_OLDER_THAN_DAYS)
+        language = self.execution.get_transcription_language(target_file_txt)
+        language_detected_counter.add(
+            1, {"language": language, "stage": "transcription"}
+        )
+        if language in NOT_CATALAN_LANGUAGES:
+            processed_files_counter.add(
+                1, {"model": model, "result": "not_catalan"}
+            )
             logging.info(
-                f"Purging {datetime.datetime.now()}, {purged} files deleted"
+                f"Non-Catalan language detected: '{language}' for '{batchfile.original_filename}'"
+            )
+            self._finish_later(
+                job, inference_time, NOT_CATALAN_MESSAGE, "whisper_not_catalan"
             )
+            return
 
-        time.sleep(30)
+        job.processing_time = job.conversion_time + (
+            time.time() - inference_start_time
+        )
+        self.finisher.put(
+            functools.partial(
+                _finish_success,
+                self.db,
+                self.keeper,
+                job,
+                inference_time,
+                (target_file_srt, target_file_txt, target_file_json),
+                self.device,
+            )
+        )
+
+    def notify(self) -> None:
+        """Send the email of the next upload finished by the service."""
+        self.notifications.reclaim_expired(self.lease_timeout)
+        batchfiles = self.notifications.select(waiting=True)
+        if not batchfiles:
+            self.notifications_watcher.wait()
+            return
+
+        batchfile = _claim_next(self.notifications, batchfiles, self.worker_id)
+        if batchfile is not None:
+            _notify_cached(self.notifications, batchfile)
+
+    def _run_notifier(self) -> None:
+        while True:
+            try:
+                self.notify()
+            except Exception:
+                logging.exception(f"Worker {LOGID} error sending an email")
+                time.sleep(self.notifications_watcher.max_wait)
+
+    def process(self, job: Job) -> None:
+        """Run a prepared job to the end."""
+        if not self._claim(job):
+            return
+
+        if job.conversion_result != Command.NO_ERROR:
+            processed_files_counter.add(
+                1, {"model": job.model, "result": "conversion_error"}
+            )
+            msg = "No s'ha pogut llegir el fitxer. Normalment, això succeeix perquè el fitxer que heu enviat no és d'àudio o vídeo o és malmès.\n"
+            msg += "Si està malmès, podeu provar de convertir-lo a una altre format (procés que sol reparar el fitxer) a https://online-audio-converter.com/\n"
+            msg += "i tornar-nos a enviar la versió convertida."
+            self._finish_later(job, 0, msg, "conversion_error")
+            return
+
+        if self.early_language_detection and _is_not_catalan(
+            self.execution, job, self.finisher, self.keeper, self.db
+        ):
+            return
+
+        self._transcribe(job)
+
+    def run(self) -> None:
+        """Start the pipeline stages and process jobs forever."""
+        self.keeper.start()
+        self.finisher.start()
+        self.prefetcher.start()
+        threading.Thread(
+            target=self._run_notifier, name="notifier", daemon=True
+        ).start()
+        while True:
+            job = self.prefetcher.get()
+            try:
+                self.process(job)
+            finally:
+                self.prefetcher.task_done()
+
+
+def _terminate(signum: int, _frame: FrameType | None) -> None:
+    # ffmpeg and whisper run in their own process groups, they do not get
+    # the signal sent to the worker and would be left running
+    logging.info(f"Worker {LOGID} received signal {signum}, stopping")
+    Command.terminate_all()
+    sys.exit(0)
+
+
+def main() -> None:
+    """Check the device and process the queue forever."""
+    init_logging()
+    signal.signal(signal.SIGTERM, _terminate)
+
+    device = os.environ.get("DEVICE", "cpu")
+    logging.info(
+        f"Process batch files to transcribe. Worker {LOGID} setup with device {device}"
+    )
+    # With the resident engine the model loaded by a full device check is
+    # the one used for the jobs, otherwise the first job loads it
+    execution = Execution(_get_threads())
+    logging.info(
+        f"Worker {LOGID} using {execution.engine.name} inference engine"
+    )
+    _check_device(device, execution)
+    BatchProcessor(execution, device).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import logging
+import queue
+import threading
+from collections.abc import Callable
+from typing import Any
+
+
+class LeaseKeeper:
+    """
+    Renews every interval seconds the leases of the claimed jobs held by
+    the worker, also while they wait between stages.
+    """
+
+    def __init__(
+        self, renew: Callable[[str], bool], interval: float = 30
+    ) -> None:
+        """Create a keeper that calls renew with each held filename."""
+        self.renew = renew
+        self.interval = interval
+        self._held: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def hold(self, filename: str) -> None:
+        """Start renewing the lease of filename."""
+        with self._lock:
+            self._held.add(filename)
+
+    def drop(self, filename: str) -> None:
+        """Stop renewing the lease of filename."""
+        with self._lock:
+            self._held.discard(filename)
+
+    def get_held(self) -> set[str]:
+        """Return the filenames whose leases are being renewed."""
+        with self._lock:
+            return set(self._held)
+
+    def renew_all(self) -> None:
+        """Renew every held lease, dropping the ones that are lost."""
+        for filename in self.get_held():
+            if self.renew(filename):
+                continue
+
+            with self._lock:
+                # Dropped while renewing, the job has just been finished
+                if filename not in self._held:
+                    continue
+
+                self._held.discard(filename)
+
+            # The lease expired and the job went back to the queue, the
+            # stage holding it finds out with its own check
+            logging.warning(f"LeaseKeeper. Cannot renew {filename}")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.renew_all()
+
+    def start(self) -> None:
+        """Start renewing in a thread."""
+        self._thread = threading.Thread(
+            target=self._run, name="lease-keeper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the renewing thread and wait for it."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+class Stage:
+    """A thread that calls function with each item put in its queue."""
+
+    def __init__(
+        self, name: str, function: Callable[[Any], object], maxsize: int = 1
+    ) -> None:
+        """Create the stage, its thread runs once started."""
+        self.name = name
+        self.function = function
+        self.queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True
+        )
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                self.function(item)
+            except Exception:
+                logging.exception(f"Stage {self.name}. Error processing item")
+            finally:
+                self.queue.task_done()
+
+    def start(self) -> None:
+        """Start processing the queued items."""
+        self._thread.start()
+
+    def put(self, item: Any) -> None:
+        """Queue item, blocks while the queue is full."""
+        self.queue.put(item)
+
+    def join(self) -> None:
+        """Wait until every queued item has been processed."""
+        self.queue.join()
+
+
+class Prefetcher:
+    """
+    Runs produce in a thread to prepare the next jobs ahead of time.
+
+    produce returns a prepared job, or None when it did not prepare one
+    (when the queue is empty it is expected to wait for new work). At most
+    depth jobs are held at a time, counting the ones already given out
+    with get that have not been marked with task_done. produce is only
+    called when there is a free slot, so a worker does not claim more
+    jobs than it can run soon and the rest stay for other workers.
+    produce can call is_idle to know if the job it prepares is the only
+    one the worker has, that is, if it will run right away.
+    """
+
+    def __init__(self, produce: Callable[[], Any], depth: int = 2) -> None:
+        """Create the prefetcher, it prepares jobs once started."""
+        self.produce = produce
+        self._slots = threading.Semaphore(max(1, depth))
+        self._jobs = queue.Queue()
+        self._running = threading.Event()
+        self._running.set()
+        self._busy = threading.Lock()
+        # Jobs queued or given out and not marked with task_done
+        self._outstanding = 0
+        self._outstanding_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="prefetcher", daemon=True
+        )
+
+    def _run(self) -> None:
+        while True:
+            self._running.wait()
+            self._slots.acquire()
+            job = None
+            with self._busy:
+                if self._running.is_set():
+                    try:
+                        job = self.produce()
+                    except Exception:
+                        logging.exception("Prefetcher. Error preparing job")
+
+                if job is not None:
+                    with self._outstanding_lock:
+                        self._outstanding += 1
+
+                    self._jobs.put(job)
+
+            if job is None:
+                self._slots.release()
+
+    def start(self) -> None:
+        """Start preparing jobs."""
+        self._thread.start()
+
+    def get(self) -> Any:
+        """Return the next prepared job, blocks until there is one."""
+        return self._jobs.get()
+
+    def task_done(self) -> None:
+        """Free the slot of a job returned by get."""
+        with self._outstanding_lock:
+            self._outstanding -= 1
+
+        self._slots.release()
+
+    def is_idle(self) -> bool:
+        """Return True if no job is waiting or being run."""
+        with self._outstanding_lock:
+            return self._outstanding == 0
+
+    def pause(self) -> list[Any]:
+        """
+        Stop preparing jobs and return the ones prepared but not taken.
+
+        Waits for a job being prepared to be queued, so none is missed.
+        """
+        self._running.clear()
+        with self._busy:
+            pass
+
+        jobs = []
+        while True:
+            try:
+                jobs.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+
+            with self._outstanding_lock:
+                self._outstanding -= 1
+
+            self._slots.release()
+
+        return jobs
+
+    def resume(self) -> None:
+        """Prepare jobs again after pause."""
+        self._running.set()
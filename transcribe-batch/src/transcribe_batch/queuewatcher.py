@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class QueueWatcher:
+    """
+    Waits until a new record shows up in the entries directory.
+
+    Uses inotify when the kernel and the filesystem support it. Otherwise
+    (or when no event arrives) it polls, doubling the wait after each
+    idle poll from min_wait up to max_wait.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        suffix: str = ".dbrecord",
+        min_wait: float = 1,
+        max_wait: float = 30,
+        *,
+        use_inotify: bool = True,
+    ) -> None:
+        """Create a watcher for the records ending in suffix."""
+        self.directory = directory
+        self.suffix = suffix
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.wait_time = min_wait
+        self.fd = None
+        if use_inotify:
+            self.fd = self._init_inotify()
+
+    def _init_inotify(self) -> int | None:
+        try:
+            Path(self.directory).mkdir(parents=True, exist_ok=True)
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+            )
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory), mask)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch")
+
+            logging.debug(f"QueueWatcher. Watching {self.directory}")
+            return fd
+        except Exception as e:
+            logging.info(
+                f"QueueWatcher. inotify not available, polling {self.directory}: {e}"
+            )
+            return None
+
+    @property
+    def uses_inotify(self) -> bool:
+        """Return True if new records are notified by inotify."""
+        return self.fd is not None
+
+    def _read_events(self) -> bool:
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return found
+
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if name.decode(errors="replace").endswith(self.suffix):
+                    found = True
+
+    def reset(self) -> None:
+        """Go back to the shortest wait, called after a job is taken."""
+        self.wait_time = self.min_wait
+
+    def wait(self) -> bool:
+        """
+        Block until a record is created or the current wait expires.
+
+        Returns True if woken up by a new record.
+        """
+        if self.fd is None:
+            timeout = self.wait_time
+            self.wait_time = min(self.wait_time * 2, self.max_wait)
+            time.sleep(timeout)
+            return False
+
+        # With inotify there is no need to back off, the timeout is only
+        # a safety net for missed events
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if readable and self._read_events():
+                self.reset()
+                return True
+
+    def close(self) -> None:
+        """Stop watching the directory."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import logging
+import time
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+from transcribe_core.batchfilesdb import BatchFile
+
+# Returns the duration in seconds of an audio file, None if unknown
+Probe = Callable[[str], float | None]
+
+# Relative cost of transcribing one second of audio with each model
+MODEL_COST = {
+    "small": 0.5,
+    "medium": 1.0,
+}
+
+# Used when the duration of a file cannot be known
+DEFAULT_DURATION = 10 * 60
+
+# Rough bitrate to estimate the duration from the file size (128 kbps)
+BYTES_PER_SECOND = 16_000
+
+
+class SchedulingPolicy:
+    """Decides in which order the waiting jobs are served."""
+
+    name: str | None = None
+
+    def order(
+        self, batchfiles: Iterable[BatchFile], now: float | None = None
+    ) -> list[BatchFile]:
+        """Return batchfiles sorted with the next job to run first."""
+        raise NotImplementedError
+
+    def charge(self, batchfile: BatchFile, now: float | None = None) -> None:
+        """Account for batchfile once it has been taken by the worker."""
+        pass
+
+
+class FifoPolicy(SchedulingPolicy):
+    """Oldest job first, the order in which they were queued."""
+
+    name = "fifo"
+
+    def order(
+        self,
+        batchfiles: Iterable[BatchFile],
+        now: float | None = None,  # noqa: ARG002
+    ) -> list[BatchFile]:
+        """Return batchfiles in the order they were queued."""
+        return list(batchfiles)
+
+
+class CostPolicy(SchedulingPolicy):
+    """
+    Base for the policies that need the expected cost of a job.
+
+    The expected cost of a job is its audio duration weighted by the cost
+    of its model.
+    """
+
+    def __init__(self, probe: Probe | None = None) -> None:
+        """Create the policy, probe finds the duration of the files."""
+        self.probe = probe
+        self._durations: dict[str, float] = {}
+
+    def _get_duration(self, batchfile: BatchFile) -> float:
+        if batchfile.duration:
+            return batchfile.duration
+
+        duration = self._durations.get(batchfile.filename)
+        if duration is None:
+            if self.probe:
+                duration = self.probe(batchfile.filename)
+
+            if not duration and batchfile.file_size:
+                duration = batchfile.file_size / BYTES_PER_SECOND
+
+            duration = duration or DEFAULT_DURATION
+            self._durations[batchfile.filename] = duration
+
+        return duration
+
+    def _get_enqueued(self, batchfile: BatchFile, now: float) -> float:
+        if batchfile.enqueued:
+            return batchfile.enqueued
+
+        try:
+            return Path(batchfile.filename_dbrecord).stat().st_mtime
+        except OSError:
+            return now
+
+    def _forget(self, batchfiles: Iterable[BatchFile]) -> None:
+        # Forget the jobs that are no longer waiting
+        waiting = {batchfile.filename for batchfile in batchfiles}
+        for filename in list(self._durations):
+            if filename not in waiting:
+                del self._durations[filename]
+
+    def expected_cost(self, batchfile: BatchFile) -> float:
+        """Return the audio duration weighted by the model cost."""
+        model_cost = MODEL_COST.get(batchfile.model_name, 1.0)
+        return self._get_duration(batchfile) * model_cost
+
+
+class ShortestJobFirstPolicy(CostPolicy):
+    """
+    Shortest expected job first, with aging.
+
+    Each second a job has waited lowers its score by aging seconds, so a
+    long job is eventually served even if short ones keep arriving.
+    """
+
+    name = "sjf"
+
+    def __init__(self, aging: float = 0.5, probe: Probe | None = None) -> None:
+        """Create the policy, aging is the score lost per second waited."""
+        super().__init__(probe)
+        self.aging = aging
+
+    def score(self, batchfile: BatchFile, now: float) -> float:
+        """Return the score of batchfile, lower is served first."""
+        waited = max(0, now - self._get_enqueued(batchfile, now))
+        return self.expected_cost(batchfile) - self.aging * waited
+
+    def order(
+        self, batchfiles: Iterable[BatchFile], now: float | None = None
+    ) -> list[BatchFile]:
+        """Return batchfiles sorted by score."""
+        if now is None:
+            now = time.time()
+
+        batchfiles = list(batchfiles)
+        self._forget(batchfiles)
+        return sorted(batchfiles, key=lambda b: self.score(b, now))
+
+
+class FairSharePolicy(CostPolicy):
+    """
+    Fair share between the users (emails) that have jobs waiting.
+
+    Every job served is charged to its email: one unit per job, or its
+    expected audio cost when by_audio is set. The charges decay with a
+    half life of half_life seconds. Waiting jobs are served in order of
+    the usage their email would have accumulated when they start, so a
+    user with several long files queued alternates with the others
+    instead of being served back to back.
+
+    The usage is kept by each worker, it is not shared between workers.
+    """
+
+    name = "fair"
+
+    def __init__(
+        self,
+        *,
+        by_audio: bool = False,
+        half_life: float = 3600,
+        probe: Probe | None = None,
+    ) -> None:
+        """Create the policy, with no usage charged yet."""
+        super().__init__(probe)
+        self.by_audio = by_audio
+        self.half_life = half_life
+        self._usage: dict[str, float] = {}
+        self._updated: float | None = None
+        if by_audio:
+            self.name = "fair-audio"
+
+    def _decay(self, now: float) -> None:
+        if self._updated is not None and self.half_life > 0:
+            factor = 0.5 ** (max(0, now - self._updated) / self.half_life)
+            for email in list(self._usage):
+                usage = self._usage[email] * factor
+                if usage < 1e-3:
+                    del self._usage[email]
+                else:
+                    self._usage[email] = usage
+
+        self._updated = now
+
+    def _cost(self, batchfile: BatchFile) -> float:
+        if self.by_audio:
+            return self.expected_cost(batchfile)
+
+        return 1
+
+    def get_usage(self, email: str, now: float | None = None) -> float:
+        """Return the decayed usage charged to email."""
+        if now is None:
+            now = time.time()
+
+        self._decay(now)
+        return self._usage.get(email.lower(), 0)
+
+    def charge(self, batchfile: BatchFile, now: float | None = None) -> None:
+        """Charge the cost of batchfile to its email."""
+        if now is None:
+            now = time.time()
+
+        self._decay(now)
+        email = batchfile.email.lower()
+        self._usage[email] = self._usage.get(email, 0) + self._cost(batchfile)
+
+    def order(
+        self, batchfiles: Iterable[BatchFile], now: float | None = None
+    ) -> list[BatchFile]:
+        """Return batchfiles sorted by the usage of their email."""
+        if now is None:
+            now = time.time()
+
+        batchfiles = list(batchfiles)
+        self._forget(batchfiles)
+        self._decay(now)
+
+        starts = {}
+        keys = []
+        for position, batchfile in enumerate(batchfiles):
+            # The same user whatever the case, as for the queue limits
+            email = batchfile.email.lower()
+            start = starts.get(email, self._usage.get(email, 0))
+            starts[email] = start + self._cost(batchfile)
+            keys.append((start, position, batchfile))
+
+        keys.sort(key=lambda key: key[:2])
+        return [batchfile for _, _, batchfile in keys]
+
+
+def get_policy(
+    name: str,
+    aging: float = 0.5,
+    probe: Probe | None = None,
+    half_life: float = 3600,
+) -> SchedulingPolicy:
+    """Return the policy called name, fifo if it is unknown."""
+    if name == FifoPolicy.name:
+        return FifoPolicy()
+
+    if name == ShortestJobFirstPolicy.name:
+        return ShortestJobFirstPolicy(aging=aging, probe=probe)
+
+    if name in (FairSharePolicy.name, "fair-audio"):
+        return FairSharePolicy(
+            by_audio=name == "fair-audio", half_life=half_life, probe=probe
+        )
+
+    logging.error(f"Unknown scheduling policy '{name}', using fifo")
+    return FifoPolicy()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import contextlib
+import functools
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections.abc import Iterable
+from pathlib import Path
+from types import FrameType
+
+import psutil
+from transcribe_core.batchfilesdb import BatchFilesDB
+
+LOGID = os.environ.get("LOGID", "0")
+MAIN = str(Path(__file__).resolve().parent / "main.py")
+
+# A worker that exits sooner than this after starting is restarted with
+# an increasing delay, up to RESTART_MAX_DELAY
+RESTART_MIN_RUNTIME = 60
+RESTART_MAX_DELAY = 5 * 60
+
+GIGABYTE = 1024 * 1024 * 1024
+
+
+def init_logging() -> None:
+    """Log to the console and to the supervisor log file."""
+    LOGDIR = os.environ.get("LOGDIR", "")
+    LOGLEVEL = os.environ.get("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=LOGLEVEL,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(Path(LOGDIR) / f"supervisor-{LOGID}.log"),
+        ],
+    )
+
+
+def get_max_workers(
+    cpus: list[int], memory: float, threads: int, worker_memory: float
+) -> int:
+    """
+    Return how many workers fit in cpus (a list of cpu ids) with threads
+    cores each and in memory bytes with worker_memory bytes each.
+    """
+    by_cpus = len(cpus) // max(1, threads)
+    by_memory = int(memory // worker_memory) if worker_memory else by_cpus
+    return max(1, min(by_cpus, by_memory))
+
+
+def partition_cpus(cpus: Iterable[int], count: int) -> list[list[int]]:
+    """Split cpus in count disjoint sets of consecutive cpus."""
+    cpus = sorted(cpus)
+    size, extra = divmod(len(cpus), count)
+    partitions = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        partitions.append(cpus[start:end])
+        start = end
+
+    return partitions
+
+
+class Worker:
+    """A worker process (main.py), pinned to a set of cpus."""
+
+    def __init__(self, index: int) -> None:
+        """Create the worker number index, it is not started."""
+        self.index = index
+        self.logid = f"{LOGID}-{index}"
+        # The same id main.py uses to claim jobs
+        self.worker_id = f"{socket.gethostname()}-{self.logid}"
+        self.process: subprocess.Popen | None = None
+        self.cpus: list[int] = []
+        self.threads = 0
+        self.started = 0
+        self.restart_delay = 1
+        self.next_start = 0
+
+    def is_running(self) -> bool:
+        """Return True if the worker process is alive."""
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, cpus: list[int]) -> None:
+        """Start the worker pinned to cpus, with one thread per cpu."""
+        env = dict(os.environ, LOGID=self.logid, THREADS=str(len(cpus)))
+        self.process = subprocess.Popen(
+            [sys.executable, MAIN],
+            env=env,
+            preexec_fn=functools.partial(os.sched_setaffinity, 0, cpus),
+        )
+        self.cpus = list(cpus)
+        self.threads = len(cpus)
+        self.started = time.monotonic()
+        logging.info(
+            f"Supervisor. Started worker {self.logid} (pid {self.process.pid}) on cpus {self.cpus}"
+        )
+
+    def set_cpus(self, cpus: list[int]) -> None:
+        """Move all the threads of the running worker to cpus."""
+        try:
+            tasks = [
+                int(task.name)
+                for task in Path(f"/proc/{self.process.pid}/task").iterdir()
+            ]
+        except OSError:
+            tasks = [self.process.pid]
+
+        for task in tasks:
+            # The thread may have exited meanwhile
+            with contextlib.suppress(OSError):
+                os.sched_setaffinity(task, cpus)
+
+        logging.info(
+            f"Supervisor. Moved worker {self.logid} from cpus {self.cpus} to {list(cpus)}"
+        )
+        self.cpus = list(cpus)
+
+    def stop(self, timeout: float = 30) -> None:
+        """Terminate the worker, killing it after timeout seconds."""
+        if not self.is_running():
+            return
+
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+        logging.info(f"Supervisor. Stopped worker {self.logid}")
+
+    def exited(self) -> bool:
+        """Return True once, when the worker has exited by itself."""
+        if self.process is None or self.process.poll() is None:
+            return False
+
+        runtime = time.monotonic() - self.started
+        logging.error(
+            f"Supervisor. Worker {self.logid} exited with {self.process.returncode} after {runtime:.0f}s"
+        )
+        if runtime < RESTART_MIN_RUNTIME:
+            self.restart_delay = min(self.restart_delay * 2, RESTART_MAX_DELAY)
+        else:
+            self.restart_delay = 1
+
+        self.next_start = time.monotonic() + self.restart_delay
+        self.process = None
+        return True
+
+
+class Supervisor:
+    """
+    Runs up to max_workers workers on disjoint sets of cpus.
+
+    Workers that exit are restarted. When rebalance is set, the number of
+    workers follows the number of jobs queued and processing, so when
+    there are fewer jobs than workers each one gets more cpus. A busy
+    worker is moved to its new cpus right away, and restarted with the
+    new number of threads once it has finished its job. Workers are
+    added as soon as jobs arrive, but only removed once there have been
+    fewer jobs for shrink_delay seconds, since restarting a worker
+    reloads its model.
+    """
+
+    def __init__(
+        self,
+        db: BatchFilesDB,
+        cpus: Iterable[int],
+        max_workers: int,
+        *,
+        rebalance: bool = True,
+        shrink_delay: float = 5 * 60,
+    ) -> None:
+        """Create the supervisor, no worker is started until step."""
+        self.db = db
+        self.cpus = sorted(cpus)
+        self.max_workers = max_workers
+        self.rebalance = rebalance
+        self.shrink_delay = shrink_delay
+        self.workers = [Worker(index) for index in range(max_workers)]
+        self.desired = 0
+        self.shrink_since: float | None = None
+
+    def is_busy(self, worker: Worker) -> bool:
+        """Return True if worker is running and has claimed a job."""
+        return (
+            worker.is_running()
+            and len(self.db.get_claimed(worker.worker_id)) > 0
+        )
+
+    def _release_claimed(self, worker: Worker) -> None:
+        # Jobs claimed by a worker that is gone go back to the queue
+        for filename in self.db.get_claimed(worker.worker_id):
+            logging.info(f"Supervisor. Releasing {filename} of {worker.logid}")
+            self.db.release(filename)
+
+    def get_desired_workers(
+        self, busy: list[Worker], now: float | None = None
+    ) -> int:
+        """Return how many workers should run for the jobs in the queue."""
+        if not self.rebalance:
+            return self.max_workers
+
+        if now is None:
+            now = time.monotonic()
+
+        depth = self.db.count() + self.db.count_processing()
+        desired = min(max(depth, len(busy), 1), self.max_workers)
+        if desired >= self.desired:
+            self.desired = desired
+            self.shrink_since = None
+        elif self.shrink_since is None:
+            self.shrink_since = now
+        elif now - self.shrink_since >= self.shrink_delay:
+            self.desired = max(desired, len(busy))
+            self.shrink_since = None
+
+        return self.desired
+
+    def plan(
+        self, desired: int, busy: list[Worker]
+    ) -> dict[int, list[int] | None]:
+        """
+        Return the cpus of each worker index, None for the ones that
+        should not run. The busy workers keep running.
+        """
+        partitions = partition_cpus(self.cpus, desired)
+        others = [worker for worker in self.workers if worker not in busy]
+        # Running workers first, so fewer workers are started
+        others.sort(key=lambda worker: not worker.is_running())
+        plan = {worker.index: None for worker in self.workers}
+        # There are fewer partitions than workers when some should not run
+        for worker, cpus in zip(busy + others, partitions, strict=False):
+            plan[worker.index] = cpus
+
+        return plan
+
+    def step(self) -> None:
+        """Restart, add, remove and move workers to follow the queue."""
+        for worker in self.workers:
+            if worker.exited():
+                self._release_claimed(worker)
+
+        busy = [worker for worker in self.workers if self.is_busy(worker)]
+        desired = self.get_desired_workers(busy)
+        plan = self.plan(desired, busy)
+        now = time.monotonic()
+        for worker in self.workers:
+            cpus = plan[worker.index]
+            if cpus is None:
+                if worker.is_running():
+                    worker.stop()
+                    self._release_claimed(worker)
+
+                continue
+
+            if not worker.is_running():
+                if now >= worker.next_start:
+                    worker.start(cpus)
+
+                continue
+
+            if worker.cpus != cpus:
+                worker.set_cpus(cpus)
+
+            if worker.threads != len(cpus) and worker not in busy:
+                worker.stop()
+                worker.start(cpus)
+
+    def stop(self) -> None:
+        """Stop all the workers."""
+        for worker in self.workers:
+            worker.stop()
+
+
+def _get_worker_memory() -> float:
+    # Memory needed by a worker, mostly the models it loads
+    return float(os.environ.get("WORKER_MEMORY_GB", 3)) * GIGABYTE
+
+
+def main() -> None:
+    """Run the workers until the supervisor is terminated."""
+    init_logging()
+
+    cpus = sorted(os.sched_getaffinity(0))
+    memory = psutil.virtual_memory().available
+    threads = int(os.environ.get("THREADS", 4))
+    max_workers = get_max_workers(cpus, memory, threads, _get_worker_memory())
+    max_workers = min(
+        max_workers, int(os.environ.get("SUPERVISOR_WORKERS", max_workers))
+    )
+    rebalance = (
+        os.environ.get("SUPERVISOR_REBALANCE", "true").lower() == "true"
+    )
+    interval = float(os.environ.get("SUPERVISOR_INTERVAL", 10))
+    logging.info(
+        f"Supervisor. {len(cpus)} cpus, {memory / GIGABYTE:.1f} GB available, running up to {max_workers} workers, rebalance {rebalance}"
+    )
+
+    supervisor = Supervisor(
+        BatchFilesDB(), cpus, max_workers, rebalance=rebalance
+    )
+
+    def terminate(signum: int, _frame: FrameType | None) -> None:
+        logging.info(f"Supervisor. Received signal {signum}, stopping workers")
+        supervisor.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    while True:
+        try:
+            supervisor.step()
+        except Exception:
+            logging.exception("Supervisor. Error supervising workers")
+
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    main()
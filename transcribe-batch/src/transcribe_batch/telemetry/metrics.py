@@ -30,3 +30,27 @@ language_detected_counter = meter.create_counter(
     unit="1",
     description="Total detected audio files by language.",
 )
+
+language_rejected_cpu_saved_counter = meter.create_counter(
+    "language_rejected_cpu_saved_seconds_total",
+    unit="s",
+    description="Estimated CPU time not spent transcribing files rejected by the early language detection, by language",
+)
+
+scheduling_policy_gauge = meter.create_gauge(
+    "scheduling_policy",
+    unit="1",
+    description="Scheduling policy used by each worker (1 for the active policy)",
+)
+
+queue_wait_histogram = meter.create_histogram(
+    "queue_wait_seconds",
+    unit="s",
+    description="Time a job waited in the queue before a worker took it, by scheduling policy",
+)
+
+transcription_cache_counter = meter.create_counter(
+    "transcription_cache_total",
+    unit="1",
+    description="Uploads with a content hash, by whether an existing transcription was reused (hit) or not (miss)",
+)
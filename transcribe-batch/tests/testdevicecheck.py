@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import json
+import os
+import tempfile
+import unittest
+
+from transcribe_batch.devicecheck import DeviceCheckCache, get_cache_key
+
+
+class TestDeviceCheckCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "cache", "check.json")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_empty(self):
+        cache = DeviceCheckCache(self.filename, 60)
+        self.assertIsNone(cache.get("key"))
+
+    def test_set_get(self):
+        cache = DeviceCheckCache(self.filename, 60)
+        cache.set("cuda", "cpu", now=1000)
+        self.assertEqual("cpu", cache.get("cuda", now=1060))
+        self.assertIsNone(cache.get("cpu", now=1060))
+
+    def test_expired(self):
+        cache = DeviceCheckCache(self.filename, 60)
+        cache.set("cpu", "cpu", now=1000)
+        self.assertIsNone(cache.get("cpu", now=1061))
+
+    def test_set_drops_expired(self):
+        cache = DeviceCheckCache(self.filename, 60)
+        cache.set("old", "cpu", now=1000)
+        cache.set("new", "cpu", now=1100)
+        with open(self.filename) as fh:
+            self.assertEqual(["new"], list(json.load(fh)))
+
+    def test_disabled(self):
+        cache = DeviceCheckCache(self.filename, 0)
+        cache.set("cpu", "cpu")
+        self.assertIsNone(cache.get("cpu"))
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_corrupted_file(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, "w") as fh:
+            fh.write("{")
+
+        cache = DeviceCheckCache(self.filename, 60)
+        self.assertIsNone(cache.get("cpu"))
+        cache.set("cpu", "cpu")
+        self.assertEqual("cpu", cache.get("cpu"))
+
+    def test_get_cache_key(self):
+        key = get_cache_key("cuda", "medium", "resident")
+        self.assertTrue(key.startswith("cuda|"))
+        self.assertIn("|medium|resident|", key)
+        self.assertIn("ctranslate2=", key)
+        self.assertNotEqual(key, get_cache_key("cuda", "small", "resident"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,13 +17,365 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
+import dataclasses
+import os
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+import types
 import unittest
+from pathlib import Path
+from unittest import mock
 
-from transcribe_batch.execution import Execution
+from transcribe_batch import execution as execution_module
+from transcribe_batch import longaudio
+from transcribe_batch.execution import (
+    Command,
+    CommandResult,
+    Execution,
+    ResidentEngine,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@dataclasses.dataclass
+class FakeSegment:
+    start: float
+    end: float
+    text: str
+    words: list = None
+
+
+@dataclasses.dataclass
+class FakeInfo:
+    language: str = "ca"
+
+
+class FakeModel:
+    def __init__(self):
+        self.calls = []
+
+    def transcribe(self, audio, language, word_timestamps):
+        self.calls.append((audio, language, word_timestamps))
+        segments = [
+            FakeSegment(0.0, 1.5, " Bon dia."),
+            FakeSegment(1.5, 3.0, " Com estàs?"),
+        ]
+        return iter(segments), FakeInfo()
+
+    def detect_language(self, audio):
+        self.calls.append(("detect_language", len(audio)))
+        if len(self.calls) == 1:
+            return "es", 0.9, [("es", 0.9), ("ca", 0.1)]
+
+        return "ca", 0.6, [("ca", 0.6), ("es", 0.4)]
+
+
+class TestResidentEngine(unittest.TestCase):
+    OPTIONS = {
+        "highlight_words": False,
+        "max_line_width": None,
+        "max_line_count": None,
+        "word_timestamps": False,
+    }
+
+    def _create_engine(self, model):
+        execution = Execution(threads=4, engine="subprocess")
+        engine = ResidentEngine(execution)
+        engine.get_model = lambda model_name, device: model
+        return engine
+
+    def test_transcribe_writes_outputs(self):
+        model = FakeModel()
+        engine = self._create_engine(model)
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = engine.transcribe(
+                "file.wav", output_dir, "medium", "cpu", 60, self.OPTIONS
+            )
+            self.assertEqual(Command.NO_ERROR, result)
+            self.assertEqual([("file.wav", "ca", False)], model.calls)
+
+            with open(os.path.join(output_dir, "file.txt")) as fh:
+                self.assertEqual("Bon dia.\nCom estàs?\n", fh.read())
+
+            with open(os.path.join(output_dir, "file.srt")) as fh:
+                self.assertIn("00:00:01,500 --> 00:00:03,000", fh.read())
+
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "file.json")))
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_detect_language(self):
+        model = FakeModel()
+        engine = self._create_engine(model)
+        windows = [b"\0\0" * 16000, b"\0\0" * 8000]
+        language, probability = engine.detect_language(windows, "medium", "cpu")
+        self.assertEqual("es", language)
+        self.assertAlmostEqual(0.65, probability)
+        self.assertEqual(
+            [("detect_language", 16000), ("detect_language", 8000)],
+            model.calls,
+        )
+
+    def test_get_model_loads_once(self):
+        created = []
+
+        class SlowWhisperModel:
+            def __init__(self, model, **kwargs):
+                created.append(model)
+                time.sleep(0.2)
+
+        faster_whisper = types.ModuleType("faster_whisper")
+        faster_whisper.WhisperModel = SlowWhisperModel
+        engine = ResidentEngine(Execution(threads=4, engine="subprocess"))
+        models = []
+        with mock.patch.dict(sys.modules, {"faster_whisper": faster_whisper}):
+            threads = [
+                threading.Thread(
+                    target=lambda: models.append(
+                        engine.get_model("medium", "cpu")
+                    )
+                )
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(["medium"], created)
+        self.assertEqual(1, len({id(model) for model in models}))
+
+    def test_transcribe_timeout(self):
+        engine = self._create_engine(FakeModel())
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = engine.transcribe(
+                "file.wav", output_dir, "medium", "cpu", -1, self.OPTIONS
+            )
+            self.assertEqual(Command.TIMEOUT_ERROR, result)
+
+    def test_transcribe_runtime_error(self):
+        model = FakeModel()
+
+        def transcribe(audio, language, word_timestamps):
+            raise RuntimeError("CUDA failed")
+
+        model.transcribe = transcribe
+        engine = self._create_engine(model)
+        result = engine.transcribe(
+            "file.wav", "output_dir", "medium", "cuda", 60, self.OPTIONS
+        )
+        self.assertEqual(Command.RUNTIME_ERROR, result)
+
+
+class TestCommand(unittest.TestCase):
+    def test_run_timeout(self):
+        start = time.monotonic()
+        result = Command(["sleep", "5"]).run(timeout=0.2)
+        self.assertEqual(Command.TIMEOUT_ERROR, result.returncode)
+        self.assertLess(time.monotonic() - start, 4)
+
+    def test_run_timeout_kills_group(self):
+        # The shell ignores SIGTERM and leaves a child behind
+        script = "trap '' TERM; sleep 5 & sleep 5"
+        start = time.monotonic()
+        result = Command(["sh", "-c", script], kill_grace=0.2).run(
+            timeout=0.2
+        )
+        self.assertEqual(Command.TIMEOUT_ERROR, result.returncode)
+        self.assertLess(time.monotonic() - start, 4)
+
+    def test_run_captures_output(self):
+        result = Command(
+            ["sh", "-c", "printf out; printf err >&2; exit 3"],
+            stdout=subprocess.PIPE,
+        ).run(timeout=10)
+        self.assertEqual(3, result.returncode)
+        self.assertEqual(b"out", result.stdout)
+        self.assertEqual(b"err", result.stderr)
+
+    def test_run_resource_usage(self):
+        script = "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"
+        result = Command(["sh", "-c", script]).run(timeout=30)
+        self.assertEqual(Command.NO_ERROR, result.returncode)
+        self.assertGreater(result.wall_time, 0)
+        self.assertGreater(result.cpu_time, 0)
+        self.assertGreater(result.max_rss, 0)
+
+    def test_run_not_found(self):
+        result = Command(["does-not-exist"]).run(timeout=10)
+        self.assertEqual(Command.ERROR, result.returncode)
+
+    def test_terminate_all(self):
+        results = []
+        command = Command(["sh", "-c", "sleep 30 & sleep 30"])
+        thread = threading.Thread(
+            target=lambda: results.append(command.run(timeout=60))
+        )
+        start = time.monotonic()
+        thread.start()
+        while command not in Command._running:
+            time.sleep(0.01)
+
+        Command.terminate_all()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertNotIn(command, Command._running)
+        self.assertFalse(self._group_running(command.process.pid))
+
+    def _group_running(self, pgid):
+        # Members killed but not reaped yet are zombies, they do not count
+        for stat in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                fields = stat.read_text().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+
+            if int(fields[2]) == pgid and fields[0] != "Z":
+                return True
+
+        return False
+
+
+class TestDecodeAudio(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.temp_dir.name)
+        self.ffmpeg = execution_module.FFMPEG
+
+    def tearDown(self):
+        execution_module.FFMPEG = self.ffmpeg
+        os.chdir(self.cwd)
+        self.temp_dir.cleanup()
+
+    def _fake_ffmpeg(self, script):
+        filename = os.path.join(self.temp_dir.name, "ffmpeg")
+        with open(filename, "w") as fh:
+            fh.write("#!/bin/sh\n" + script)
+
+        os.chmod(filename, 0o755)
+        execution_module.FFMPEG = filename
+
+    def test_decode_audio(self):
+        self._fake_ffmpeg("printf 'abcd'\n")
+        execution = Execution(threads=4, engine="subprocess")
+        result, samples = execution.decode_audio("file.mp3", "file.mp3", 10)
+        self.assertEqual(Command.NO_ERROR, result)
+        self.assertEqual(b"abcd", samples)
+
+    def test_decode_audio_error(self):
+        self._fake_ffmpeg("printf 'abcd'\necho 'Invalid data' >&2\n")
+        execution = Execution(threads=4, engine="subprocess")
+        execution._run_sox = lambda *args: (Command.ERROR, "none.wav")
+        result, samples = execution.decode_audio("file.mp3", "file.mp3", 10)
+        self.assertEqual(Command.ERROR, result)
+        self.assertIsNone(samples)
+
+    def test_decode_audio_timeout(self):
+        self._fake_ffmpeg("exec sleep 5\n")
+        execution = Execution(threads=4, engine="subprocess")
+        result, samples = execution._run_ffmpeg_pipe("file.mp3", 0.2)
+        self.assertEqual(Command.TIMEOUT_ERROR, result)
+        self.assertIsNone(samples)
+
+    def test_streaming_needs_engine_support(self):
+        execution = Execution(threads=4, engine="subprocess")
+        self.assertFalse(execution.streaming)
+
+
+def _spin(seconds):
+    start = time.thread_time()
+    while time.thread_time() - start < seconds:
+        pass
+
+
+class SpinEngine:
+    name = "spin"
+    supports_samples = False
+
+    def transcribe(
+        self, audio, output_dir, model, device, timeout, options, samples=None
+    ):
+        _spin(0.3)
+        return Command.NO_ERROR
 
 
 class TestExecution(unittest.TestCase):
+    def _create_audio(self, directory, seconds=10):
+        wav_file = os.path.join(directory, "file.wav")
+        longaudio.write_samples(wav_file, b"\0\0" * 16000 * seconds)
+        return wav_file
+
+    def test_cpu_per_audio_second_only_inference(self):
+        execution = Execution(threads=4, engine="subprocess")
+        execution.engine = SpinEngine()
+        stop = threading.Event()
+
+        def other_work():
+            while not stop.is_set():
+                _spin(0.01)
+
+        # Like the prefetcher converting the next job meanwhile
+        thread = threading.Thread(target=other_work)
+        thread.start()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                execution.run_inference(
+                    "file.mp3",
+                    "medium",
+                    self._create_audio(directory),
+                    60,
+                    output_dir=directory,
+                )
+        finally:
+            stop.set()
+            thread.join()
+
+        cpu_time = execution.cpu_per_audio_second["medium"] * 10
+        self.assertGreater(cpu_time, 0.25)
+        self.assertLess(cpu_time, 0.45)
+
+    def test_cpu_per_audio_second_subprocess(self):
+        execution = Execution(threads=4, engine="subprocess")
+        execution._run_command = lambda *args, **kwargs: CommandResult(
+            Command.NO_ERROR, cpu_time=12
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            execution.run_inference(
+                "file.mp3",
+                "medium",
+                self._create_audio(directory),
+                60,
+                output_dir=directory,
+            )
+
+        self.assertAlmostEqual(
+            1.2, execution.cpu_per_audio_second["medium"], places=1
+        )
+
+    def test_detect_language_not_supported(self):
+        execution = Execution(threads=4, engine="subprocess")
+        self.assertIsNone(execution.detect_language("file.wav", "medium"))
+
+    def test_estimate_cpu_time(self):
+        execution = Execution(threads=4, engine="subprocess")
+        samples = b"\0\0" * 16000 * 10
+        self.assertEqual(
+            25, execution.estimate_cpu_time("medium", "file.wav", samples)
+        )
+        execution.cpu_per_audio_second["medium"] = 4
+        self.assertEqual(
+            40, execution.estimate_cpu_time("medium", "file.wav", samples)
+        )
+
     def test_get_transcription_language_short_text(self):
         with tempfile.NamedTemporaryFile(mode="w") as temp_file:
             text = "Short text"
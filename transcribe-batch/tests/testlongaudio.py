@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from transcribe_batch import longaudio
+from transcribe_batch.execution import Command, Execution
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _silence(seconds):
+    return b"\0\0" * int(seconds * longaudio.SAMPLE_RATE)
+
+
+class TestLongAudio(unittest.TestCase):
+    def test_choose_split_points_at_silences(self):
+        silences = [(100, 102), (290, 292), (640, 650)]
+        points = longaudio.choose_split_points(900, silences, 3)
+        self.assertEqual([291, 645], points)
+
+    def test_choose_split_points_without_silences(self):
+        points = longaudio.choose_split_points(900, [(10, 11)], 3)
+        self.assertEqual([300, 600], points)
+
+    def test_get_chunks(self):
+        chunks = longaudio.get_chunks(900, [291, 645])
+        self.assertEqual([(0, 291), (291, 645), (645, 900)], chunks)
+
+    def test_slice_samples(self):
+        samples = bytes(range(256)) * 250
+        chunk = longaudio.slice_samples(samples, 0.5, 1)
+        self.assertEqual(16000, len(chunk))
+        self.assertEqual(samples[16000:32000], chunk)
+
+    def test_get_windows(self):
+        windows = longaudio.get_windows(600, 3, 30)
+        self.assertEqual([(85, 115), (285, 315), (485, 515)], windows)
+        self.assertEqual([(0, 60)], longaudio.get_windows(60, 3, 30))
+
+    def test_read_samples_window(self):
+        samples = bytes(range(256)) * 250
+        with tempfile.TemporaryDirectory() as directory:
+            wav_file = os.path.join(directory, "file.wav")
+            longaudio.write_samples(wav_file, samples)
+            window = longaudio.read_samples(wav_file, 0.5, 1)
+            self.assertEqual(samples[16000:32000], window)
+            self.assertEqual(b"", longaudio.read_samples(wav_file, 5, 6))
+
+    def test_wav_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wav_file = os.path.join(directory, "file.wav")
+            longaudio.write_samples(wav_file, _silence(2))
+            self.assertEqual(_silence(2), longaudio.read_samples(wav_file))
+            self.assertEqual(2, longaudio.get_wav_duration(wav_file))
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_find_silences(self):
+        tone = b"\xff\x7f\x01\x80" * 8000
+        samples = tone + _silence(1) + tone + _silence(0.2) + tone
+        self.assertEqual([(1.0, 2.0)], longaudio.find_silences(samples))
+
+    def test_merge_results(self):
+        first = {
+            "text": " Bon dia.",
+            "segments": [{"id": 1, "seek": 0, "start": 0.5, "end": 1.0}],
+            "language": "ca",
+        }
+        second = {
+            "text": " Adéu.",
+            "segments": [
+                {
+                    "id": 1,
+                    "seek": 0,
+                    "start": 0.0,
+                    "end": 2.0,
+                    "words": [{"start": 0.0, "end": 0.5, "word": " Adéu"}],
+                }
+            ],
+            "language": "ca",
+        }
+        result = longaudio.merge_results([first, second], [0, 60])
+        self.assertEqual(" Bon dia. Adéu.", result["text"])
+        self.assertEqual([1, 2], [s["id"] for s in result["segments"]])
+        segment = result["segments"][1]
+        self.assertEqual((60, 62), (segment["start"], segment["end"]))
+        self.assertEqual(6000, segment["seek"])
+        self.assertEqual(60.5, segment["words"][0]["end"])
+        self.assertEqual(0.0, second["segments"][0]["start"])
+
+
+class FakeEngine:
+    name = "fake"
+    supports_samples = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def transcribe(
+        self, audio, output_dir, model, device, timeout, options, samples=None
+    ):
+        self.chunks.append(longaudio.get_wav_duration(audio))
+        index = len(self.chunks)
+        os.makedirs(output_dir)
+        name = os.path.basename(audio).rsplit(".", 1)[0]
+        result = {
+            "text": f" Frase {index}.",
+            "segments": [
+                {"id": 1, "start": 0.0, "end": 1.0, "text": f" Frase {index}."}
+            ],
+            "language": "ca",
+        }
+        with open(os.path.join(output_dir, name + ".json"), "w") as fh:
+            json.dump(result, fh)
+
+        return Command.NO_ERROR
+
+
+class TestTranscribeLong(unittest.TestCase):
+    OPTIONS = {
+        "highlight_words": False,
+        "max_line_width": None,
+        "max_line_count": None,
+        "word_timestamps": False,
+    }
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.temp_dir.name, "out")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @mock.patch.object(longaudio, "find_silences", return_value=[])
+    def test_transcribe_long(self, find_silences):
+        execution = Execution(threads=4, engine="subprocess")
+        execution.engine = FakeEngine()
+        wav_file = os.path.join(self.temp_dir.name, "file.wav")
+        longaudio.write_samples(wav_file, _silence(60))
+
+        args = ("medium", "cpu", 60, self.OPTIONS, self.output_dir)
+        result = execution._transcribe_long(wav_file, None, 60, 2, args)
+        self.assertEqual(Command.NO_ERROR, result)
+        self.assertEqual([30, 30], execution.engine.chunks)
+
+        with open(os.path.join(self.output_dir, "file.srt")) as fh:
+            srt = fh.read()
+
+        self.assertIn("1\n00:00:00,000 --> 00:00:01,000\nFrase 1.", srt)
+        self.assertIn("2\n00:00:30,000 --> 00:00:31,000\nFrase 2.", srt)
+        # The chunks are removed, only the outputs are left
+        self.assertEqual(
+            ["file.json", "file.srt", "file.txt"],
+            sorted(os.listdir(self.output_dir)),
+        )
+
+    @mock.patch.object(longaudio, "find_silences", return_value=[])
+    @mock.patch.dict(
+        os.environ,
+        {"LONG_AUDIO_WORKERS": "2", "LONG_AUDIO_MIN_DURATION": "10"},
+    )
+    def test_run_inference_output_dir(self, find_silences):
+        execution = Execution(threads=4, engine="subprocess")
+        execution.engine = FakeEngine()
+        wav_file = os.path.join(self.temp_dir.name, "file.wav")
+        longaudio.write_samples(wav_file, _silence(20))
+
+        _, result, txt, srt, json_file = execution.run_inference(
+            "file.mp3", "medium", wav_file, 60, output_dir=self.output_dir
+        )
+        self.assertEqual(Command.NO_ERROR, result)
+        self.assertFalse(os.path.exists(wav_file))
+        for target_file, extension in [
+            (txt, "txt"),
+            (srt, "srt"),
+            (json_file, "json"),
+        ]:
+            self.assertEqual(
+                os.path.join(self.output_dir, "file." + extension), target_file
+            )
+            self.assertTrue(os.path.exists(target_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import threading
+import time
+import unittest
+
+from transcribe_batch.pipeline import LeaseKeeper, Prefetcher, Stage
+
+
+class TestLeaseKeeper(unittest.TestCase):
+    def test_renews_held(self):
+        renewed = []
+        keeper = LeaseKeeper(lambda f: renewed.append(f) or True)
+        keeper.hold("a")
+        keeper.hold("b")
+        keeper.drop("b")
+        keeper.renew_all()
+        self.assertEqual(["a"], renewed)
+        self.assertEqual({"a"}, keeper.get_held())
+
+    def test_drops_lost(self):
+        keeper = LeaseKeeper(lambda f: False)
+        keeper.hold("a")
+        keeper.renew_all()
+        self.assertEqual(set(), keeper.get_held())
+
+    def test_thread_renews(self):
+        renewed = threading.Event()
+        keeper = LeaseKeeper(lambda f: renewed.set() or True, interval=0.01)
+        keeper.hold("a")
+        keeper.start()
+        self.assertTrue(renewed.wait(5))
+        keeper.stop()
+
+
+class TestStage(unittest.TestCase):
+    def test_processes_items(self):
+        done = []
+
+        def function(item):
+            if item == 2:
+                raise ValueError()
+
+            done.append(item)
+
+        stage = Stage("test", function, maxsize=1)
+        stage.start()
+        for item in range(4):
+            stage.put(item)
+
+        stage.join()
+        self.assertEqual([0, 1, 3], done)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def _produce(self, produced):
+        def produce():
+            produced.append(len(produced))
+            return produced[-1]
+
+        return produce
+
+    def test_depth_bounds_held_jobs(self):
+        produced = []
+        prefetcher = Prefetcher(self._produce(produced), depth=2)
+        prefetcher.start()
+        self.assertEqual(0, prefetcher.get())
+        time.sleep(0.1)
+        # One job given out and one prepared ahead
+        self.assertEqual([0, 1], produced)
+
+        prefetcher.task_done()
+        self.assertEqual(1, prefetcher.get())
+        time.sleep(0.1)
+        self.assertEqual([0, 1, 2], produced)
+
+    def test_none_does_not_take_slot(self):
+        results = [None, None, "job"]
+        prefetcher = Prefetcher(lambda: results.pop(0) if results else None, 1)
+        prefetcher.start()
+        self.assertEqual("job", prefetcher.get())
+
+    def test_pause_returns_prepared(self):
+        produced = []
+        prefetcher = Prefetcher(self._produce(produced), depth=3)
+        prefetcher.start()
+        self.assertEqual(0, prefetcher.get())
+        time.sleep(0.1)
+
+        self.assertEqual([1, 2], prefetcher.pause())
+        prefetcher.task_done()
+        time.sleep(0.1)
+        self.assertEqual([0, 1, 2], produced)
+
+        prefetcher.resume()
+        self.assertEqual(3, prefetcher.get())
+
+    def test_is_idle(self):
+        idle = []
+
+        def produce():
+            idle.append(prefetcher.is_idle())
+            return len(idle)
+
+        prefetcher = Prefetcher(produce, depth=2)
+        self.assertTrue(prefetcher.is_idle())
+        prefetcher.start()
+        self.assertEqual(1, prefetcher.get())
+        time.sleep(0.1)
+        # The first job was prepared with nothing else to do, the second
+        # one while the first was running
+        self.assertEqual([True, False], idle)
+        self.assertFalse(prefetcher.is_idle())
+
+        prefetcher.pause()
+        prefetcher.task_done()
+        self.assertTrue(prefetcher.is_idle())
+
+
+if __name__ == "__main__":
+    unittest.main()
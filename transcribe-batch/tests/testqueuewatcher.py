@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from transcribe_batch.queuewatcher import QueueWatcher
+
+
+class TestQueueWatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _create_later(self, name, delay=0.1):
+        def target():
+            time.sleep(delay)
+            with open(os.path.join(self.temp_dir.name, name), "w") as fh:
+                fh.write("v2")
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def test_wakes_up_on_new_record(self):
+        watcher = QueueWatcher(self.temp_dir.name, max_wait=10)
+        if not watcher.uses_inotify:
+            self.skipTest("inotify not available")
+
+        thread = self._create_later("record.dbrecord")
+        start = time.monotonic()
+        self.assertTrue(watcher.wait())
+        self.assertLess(time.monotonic() - start, 5)
+        thread.join()
+        watcher.close()
+
+    def test_ignores_other_files(self):
+        watcher = QueueWatcher(self.temp_dir.name, max_wait=0.5)
+        if not watcher.uses_inotify:
+            self.skipTest("inotify not available")
+
+        thread = self._create_later("record.dbrecord.lock")
+        self.assertFalse(watcher.wait())
+        thread.join()
+        watcher.close()
+
+    def test_polling_backoff(self):
+        watcher = QueueWatcher(
+            self.temp_dir.name, min_wait=0.01, max_wait=0.04, use_inotify=False
+        )
+        self.assertFalse(watcher.wait())
+        self.assertEqual(0.02, watcher.wait_time)
+        watcher.wait()
+        watcher.wait()
+        self.assertEqual(0.04, watcher.wait_time)
+        watcher.reset()
+        self.assertEqual(0.01, watcher.wait_time)
+
+
+if __name__ == "__main__":
+    unittest.main()
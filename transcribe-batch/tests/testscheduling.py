@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import unittest
+
+from transcribe_core.batchfilesdb import BatchFile
+
+from transcribe_batch.scheduling import (
+    FairSharePolicy,
+    FifoPolicy,
+    ShortestJobFirstPolicy,
+    get_policy,
+)
+
+NOW = 1_000_000
+
+
+def _batchfile(
+    name,
+    duration=None,
+    waited=0,
+    model_name="medium",
+    file_size=None,
+    email="jmas@softcatala.org",
+):
+    return BatchFile(
+        filename_dbrecord=f"{name}.dbrecord",
+        filename=name,
+        email=email,
+        model_name=model_name,
+        original_filename=f"{name}.mp3",
+        delete_token="dt_token",
+        enqueued=NOW - waited,
+        duration=duration,
+        file_size=file_size,
+    )
+
+
+def _names(batchfiles):
+    return [batchfile.filename for batchfile in batchfiles]
+
+
+class TestScheduling(unittest.TestCase):
+    def test_fifo(self):
+        batchfiles = [_batchfile("long", 3 * 3600), _batchfile("short", 120)]
+        self.assertEqual(["long", "short"], _names(FifoPolicy().order(batchfiles)))
+
+    def test_sjf_shortest_first(self):
+        batchfiles = [
+            _batchfile("long", 3 * 3600, waited=60),
+            _batchfile("short", 120, waited=30),
+        ]
+        policy = ShortestJobFirstPolicy(aging=0.5)
+        self.assertEqual(["short", "long"], _names(policy.order(batchfiles, NOW)))
+
+    def test_sjf_aging(self):
+        batchfiles = [
+            _batchfile("long", 3 * 3600, waited=6 * 3600),
+            _batchfile("short", 120),
+        ]
+        policy = ShortestJobFirstPolicy(aging=0.5)
+        self.assertEqual(["long", "short"], _names(policy.order(batchfiles, NOW)))
+
+    def test_sjf_model_cost(self):
+        batchfiles = [
+            _batchfile("medium", 600, model_name="medium"),
+            _batchfile("small", 900, model_name="small"),
+        ]
+        policy = ShortestJobFirstPolicy(aging=0)
+        self.assertEqual(["small", "medium"], _names(policy.order(batchfiles, NOW)))
+
+    def test_sjf_probe_cached(self):
+        probed = []
+
+        def probe(filename):
+            probed.append(filename)
+            return {"a": 600, "b": 60}[filename]
+
+        batchfiles = [_batchfile("a"), _batchfile("b")]
+        policy = ShortestJobFirstPolicy(aging=0, probe=probe)
+        self.assertEqual(["b", "a"], _names(policy.order(batchfiles, NOW)))
+        policy.order(batchfiles, NOW)
+        self.assertEqual(["a", "b"], probed)
+
+    def test_sjf_file_size_estimate(self):
+        batchfiles = [
+            _batchfile("big", file_size=100_000_000),
+            _batchfile("small", file_size=1_000_000),
+        ]
+        policy = ShortestJobFirstPolicy(aging=0)
+        self.assertEqual(["small", "big"], _names(policy.order(batchfiles, NOW)))
+
+    def test_fair_round_robin(self):
+        batchfiles = [
+            _batchfile("a1", email="a@softcatala.org"),
+            _batchfile("a2", email="a@softcatala.org"),
+            _batchfile("a3", email="a@softcatala.org"),
+            _batchfile("b1", email="b@softcatala.org"),
+            _batchfile("c1", email="c@softcatala.org"),
+            _batchfile("b2", email="b@softcatala.org"),
+        ]
+        policy = FairSharePolicy()
+        self.assertEqual(
+            ["a1", "b1", "c1", "a2", "b2", "a3"],
+            _names(policy.order(batchfiles, NOW)),
+        )
+
+    def test_fair_charge(self):
+        batchfiles = [
+            _batchfile("a2", email="a@softcatala.org"),
+            _batchfile("b1", email="b@softcatala.org"),
+        ]
+        policy = FairSharePolicy(half_life=3600)
+        policy.charge(_batchfile("a1", email="a@softcatala.org"), NOW)
+        self.assertEqual(["b1", "a2"], _names(policy.order(batchfiles, NOW)))
+
+        # After several half lives the usage is forgotten
+        later = NOW + 20 * 3600
+        self.assertEqual(0, policy.get_usage("a@softcatala.org", later))
+        self.assertEqual(["a2", "b1"], _names(policy.order(batchfiles, later)))
+
+    def test_fair_email_case(self):
+        batchfiles = [
+            _batchfile("a1", email="a@softcatala.org"),
+            _batchfile("a2", email="A@softcatala.org"),
+            _batchfile("b1", email="b@softcatala.org"),
+        ]
+        policy = FairSharePolicy()
+        self.assertEqual(["a1", "b1", "a2"], _names(policy.order(batchfiles, NOW)))
+
+        policy.charge(_batchfile("a0", email="A@SOFTCATALA.ORG"), NOW)
+        self.assertEqual(1, policy.get_usage("a@softcatala.org", NOW))
+
+    def test_fair_audio(self):
+        batchfiles = [
+            _batchfile("a1", 90 * 60, email="a@softcatala.org"),
+            _batchfile("a2", 60, email="a@softcatala.org"),
+            _batchfile("b1", 30 * 60, email="b@softcatala.org"),
+            _batchfile("b2", 30 * 60, email="b@softcatala.org"),
+        ]
+        policy = get_policy("fair-audio")
+        self.assertEqual(
+            ["a1", "b1", "b2", "a2"], _names(policy.order(batchfiles, NOW))
+        )
+
+    def test_get_policy_unknown(self):
+        self.assertEqual("fifo", get_policy("unknown").name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+
+import unittest
+from unittest import mock
+
+from transcribe_batch.supervisor import (
+    Supervisor,
+    Worker,
+    get_max_workers,
+    partition_cpus,
+)
+
+GIGABYTE = 1024 * 1024 * 1024
+
+
+class FakeDB:
+    def __init__(self):
+        self.waiting = 0
+        self.claimed = {}
+        self.released = []
+
+    def count(self):
+        return self.waiting
+
+    def count_processing(self):
+        return sum(len(claimed) for claimed in self.claimed.values())
+
+    def get_claimed(self, worker_id):
+        return self.claimed.get(worker_id, [])
+
+    def release(self, filename):
+        self.released.append(filename)
+
+
+class FakeProcess:
+    pid = 0
+    returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+def _start(worker, cpus):
+    worker.process = FakeProcess()
+    worker.cpus = list(cpus)
+    worker.threads = len(cpus)
+    worker.starts = getattr(worker, "starts", 0) + 1
+
+
+def _stop(worker, timeout=30):
+    worker.process = None
+
+
+@mock.patch.object(
+    Worker, "set_cpus", lambda w, cpus: setattr(w, "cpus", cpus)
+)
+@mock.patch.object(Worker, "stop", _stop)
+@mock.patch.object(Worker, "start", _start)
+class TestSupervisor(unittest.TestCase):
+    def _create(self, cpus=8, max_workers=4):
+        self.db = FakeDB()
+        return Supervisor(
+            self.db, list(range(cpus)), max_workers, shrink_delay=0
+        )
+
+    def _cpus(self, supervisor):
+        return [
+            worker.cpus if worker.is_running() else None
+            for worker in supervisor.workers
+        ]
+
+    def test_without_rebalance_runs_all(self):
+        supervisor = self._create()
+        supervisor.rebalance = False
+        supervisor.step()
+        self.assertEqual(
+            [[0, 1], [2, 3], [4, 5], [6, 7]], self._cpus(supervisor)
+        )
+
+    def test_shallow_queue_gives_more_cpus(self):
+        supervisor = self._create()
+        supervisor.step()
+        self.assertEqual(
+            [list(range(8)), None, None, None], self._cpus(supervisor)
+        )
+
+        self.db.waiting = 2
+        supervisor.step()
+        self.assertEqual(
+            [[0, 1, 2, 3], [4, 5, 6, 7], None, None], self._cpus(supervisor)
+        )
+
+    def test_busy_worker_moved_and_restarted_when_idle(self):
+        supervisor = self._create()
+        supervisor.step()
+        first = supervisor.workers[0]
+        self.db.claimed[first.worker_id] = ["job.dbrecord"]
+        self.db.waiting = 3
+        supervisor.step()
+        # Moved to fewer cpus but not restarted while busy
+        self.assertEqual([0, 1], first.cpus)
+        self.assertEqual(8, first.threads)
+        self.assertEqual(1, first.starts)
+
+        self.db.claimed = {}
+        supervisor.step()
+        self.assertEqual(2, first.threads)
+        self.assertEqual(2, first.starts)
+
+    def test_shrink_waits(self):
+        supervisor = self._create()
+        supervisor.shrink_delay = 60
+        self.db.waiting = 4
+        self.assertEqual(4, supervisor.get_desired_workers([], now=0))
+        self.db.waiting = 0
+        self.assertEqual(4, supervisor.get_desired_workers([], now=10))
+        self.assertEqual(4, supervisor.get_desired_workers([], now=30))
+        self.assertEqual(1, supervisor.get_desired_workers([], now=71))
+
+    def test_restart_exited(self):
+        supervisor = self._create()
+        supervisor.rebalance = False
+        supervisor.step()
+        worker = supervisor.workers[1]
+        self.db.claimed[worker.worker_id] = ["job.dbrecord"]
+        worker.process.returncode = 1
+        worker.next_start = 0
+        with mock.patch("transcribe_batch.supervisor.RESTART_MIN_RUNTIME", 0):
+            supervisor.step()
+
+        self.assertEqual(["job.dbrecord"], self.db.released)
+        self.assertFalse(worker.is_running())
+
+        worker.next_start = 0
+        supervisor.step()
+        self.assertTrue(worker.is_running())
+        self.assertEqual(2, worker.starts)
+
+
+class TestSizing(unittest.TestCase):
+    def test_get_max_workers(self):
+        cpus = list(range(32))
+        self.assertEqual(
+            8, get_max_workers(cpus, 64 * GIGABYTE, 4, 3 * GIGABYTE)
+        )
+        self.assertEqual(
+            5, get_max_workers(cpus, 16 * GIGABYTE, 4, 3 * GIGABYTE)
+        )
+        self.assertEqual(
+            1, get_max_workers([0, 1], 64 * GIGABYTE, 4, GIGABYTE)
+        )
+
+    def test_partition_cpus(self):
+        self.assertEqual(
+            [[0, 1, 2], [3, 4], [5, 6]], partition_cpus(range(7), 3)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,17 +17,48 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-import fnmatch
 import logging
 import os
+import threading
+import time
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 
+from transcribe_core.queuestore import (
+    FileQueueStore,
+    QueueStore,
+    get_queue_store,
+)
+
 
 class BatchFile:
     """TODO: Docstring this class."""
 
+    # Queue scans create thousands of these, slots keep them small
+    __slots__ = (
+        "filename_dbrecord",
+        "filename",
+        "email",
+        "model_name",
+        "original_filename",
+        "delete_token",
+        "highlight_words",
+        "num_chars",
+        "num_sentences",
+        "enqueued",
+        "file_size",
+        "duration",
+        "priority",
+        "sample_rate",
+        "channels",
+        "channel_layout",
+        "codec",
+        "content_hash",
+    )
+
     def __init__(
         self,
         filename_dbrecord: str,
@@ -39,6 +70,15 @@ class BatchFile:
         highlight_words: bool | None = None,
         num_chars: int | None = None,
         num_sentences: int | None = None,
+        enqueued: float | None = None,
+        file_size: int | None = None,
+        duration: float | None = None,
+        priority: int = 0,
+        sample_rate: int | None = None,
+        channels: int | None = None,
+        channel_layout: str | None = None,
+        codec: str | None = None,
+        content_hash: str | None = None,
     ) -> None:
         """TODO: Docstring this."""
         self.filename_dbrecord = filename_dbrecord
@@ -50,6 +90,15 @@ class BatchFile:
         self.highlight_words = highlight_words
         self.num_chars = self._safe_int(num_chars)
         self.num_sentences = self._safe_int(num_sentences)
+        self.enqueued = enqueued
+        self.file_size = file_size
+        self.duration = duration
+        self.priority = priority
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.channel_layout = channel_layout
+        self.codec = codec
+        self.content_hash = content_hash
 
     @staticmethod
     def _safe_int(value: Any) -> int | None:
@@ -61,39 +110,288 @@ class BatchFile:
             return None
 
 
+# Record formats. A record is a single line of tab separated fields.
+#
+# v2: version, filename, email, model_name, original_filename,
+#     delete_token, highlight_words, num_chars, num_sentences
+#     Missing values are written as 'None', booleans as 'True'/'False'.
+#
+# v3: the v2 fields followed by enqueued (epoch seconds), file_size
+#     (bytes), duration (seconds) and priority. Missing values are
+#     written as empty strings and booleans as '1'/'0'. Later revisions
+#     may append fields: readers ignore unknown trailing fields.
+#     Revision 2 appends sample_rate, channels, channel_layout and codec
+#     of the audio, probed at upload. Revision 1 records lack them.
+#     Revision 3 appends content_hash, the sha256 of the uploaded file.
+
+
+def _format_optional(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+
+def _parse_bool(string: str) -> bool | None:
+    return None if string == "" else string == "1"
+
+
+def _parse_int(string: str) -> int | None:
+    return None if string == "" else int(string)
+
+
+def _parse_float(string: str) -> float | None:
+    return None if string == "" else float(string)
+
+
+def _parse_v2_bool(string: str) -> bool | None:
+    return None if string in ("None", "") else string == "True"
+
+
+def _parse_v2_int(string: str) -> int | None:
+    return None if string in ("None", "") else BatchFile._safe_int(string)
+
+
+def _parse_v3(filename_dbrecord: str, components: list[str]) -> BatchFile:
+    record = BatchFile.__new__(BatchFile)
+    record.filename_dbrecord = filename_dbrecord
+    record.filename = components[1]
+    record.email = components[2]
+    record.model_name = components[3]
+    record.original_filename = components[4]
+    record.delete_token = components[5]
+    record.highlight_words = _parse_bool(components[6])
+    record.num_chars = _parse_int(components[7])
+    record.num_sentences = _parse_int(components[8])
+    record.enqueued = _parse_float(components[9])
+    record.file_size = _parse_int(components[10])
+    record.duration = _parse_float(components[11])
+    record.priority = int(components[12])
+    if len(components) > 16:
+        record.sample_rate = _parse_int(components[13])
+        record.channels = _parse_int(components[14])
+        record.channel_layout = components[15] or None
+        record.codec = components[16] or None
+    else:
+        record.sample_rate = None
+        record.channels = None
+        record.channel_layout = None
+        record.codec = None
+    if len(components) > 17:
+        record.content_hash = components[17] or None
+    else:
+        record.content_hash = None
+    return record
+
+
+# Records of the uploads that the service finished with the outputs of an
+# identical one. Only their email is left, a worker sends it.
+NOTIFICATIONS = "/srv/data/notifications"
+
+
+# Records are read with a bounded pool of threads. Each open costs
+# milliseconds on a network filesystem, reading them concurrently hides
+# most of that latency. Below PARALLEL_READ_MIN records reading them
+# serially is faster than handing them to the pool.
+READ_THREADS = int(os.environ.get("QUEUE_READ_THREADS", 16))
+PARALLEL_READ_MIN = 8
+
+_read_executor: ThreadPoolExecutor | None = None
+_read_executor_pid = 0
+_read_executor_lock = threading.Lock()
+
+
+def _get_read_executor() -> ThreadPoolExecutor:
+    global _read_executor, _read_executor_pid
+
+    with _read_executor_lock:
+        # A pool created before a fork has no threads in the child
+        if _read_executor is None or _read_executor_pid != os.getpid():
+            _read_executor = ThreadPoolExecutor(
+                max_workers=READ_THREADS, thread_name_prefix="dbrecord"
+            )
+            _read_executor_pid = os.getpid()
+
+        return _read_executor
+
+
+def _read_first_line(filename: str) -> str | None:
+    try:
+        with Path(filename).open("r") as fh:
+            return fh.readline()
+    except Exception as exception:
+        logging.error(
+            f"_read_record. Unable to read {filename}. Error: {exception}"
+        )
+        return None
+
+
+def read_first_lines(filenames: list[str]) -> list[str | None]:
+    """Read the first line of each file, in the same order."""
+    if len(filenames) < PARALLEL_READ_MIN:
+        return [_read_first_line(filename) for filename in filenames]
+
+    return list(_get_read_executor().map(_read_first_line, filenames))
+
+
 # This is a disk based priority queue with works as filenames
-# as items to store
+# as items to store. Each item is a file in the entries directory and
+# a QueueStore keeps track of the order in which they are served.
+# A worker takes an item by renaming it into its own directory under
+# processing/, the rename is atomic so only one worker can win it.
 class Queue:  # works with filenames
     """TODO: Docstring this class."""
 
     g_check_directory = True
+    PROCESSING = "processing"
 
-    def __init__(self, entries: str = "/srv/data/entries") -> None:
+    def __init__(
+        self, entries: str = "/srv/data/entries", backend: str | None = None
+    ) -> None:
         """TODO: Docstring this."""
         self.ENTRIES = entries
+        self.backend = backend
+
+    @property
+    def store(self) -> QueueStore:
+        """Return the store for ENTRIES, importing old records if needed."""
+        store = get_queue_store(self.ENTRIES, self.backend)
+        if store.needs_migration():
+            self.migrate(store)
+
+        return store
+
+    def _get_email(self, content: str) -> str:  # noqa: ARG002
+        return ""
+
+    def _get_enqueued(self, content: str) -> float | None:  # noqa: ARG002
+        return None
 
-    def _find(self, directory: str, pattern: str) -> list[str]:
-        filelist = []
+    def migrate(self, store: QueueStore | None = None) -> int:
+        """Rebuild the store index from the records found on disk."""
+        if store is None:
+            store = get_queue_store(self.ENTRIES, self.backend)
 
-        for root, _, files in os.walk(directory):
-            for basename in files:
-                if fnmatch.fnmatch(basename, pattern):
-                    filename = str(Path(root) / basename)
-                    filelist.append(filename)
+        entries = Path(self.ENTRIES)
+        records = []
+        for filename in FileQueueStore(self.ENTRIES).get_all():
+            parent = Path(filename).parent
+            worker = None if parent == entries else parent.name
+            try:
+                path = Path(filename)
+                mtime = path.stat().st_mtime
+                content = path.read_text()
+            except OSError as exception:
+                logging.error(
+                    f"Queue.migrate. Unable to read {filename}. Error: {exception}"
+                )
+                continue
+
+            email = self._get_email(content)
+            enqueued = self._get_enqueued(content) or mtime
+            records.append((filename, email, content, enqueued, worker))
 
-        filelist.sort(key=lambda filename: Path(filename).stat().st_mtime)
-        return filelist
+        store.sync(records)
+        return len(records)
 
     def count(self) -> int:
         """TODO: Docstring this."""
-        filenames = self._find(self.ENTRIES, "*.dbrecord")
-        return len(filenames)
+        return self.store.count()
+
+    def count_processing(self) -> int:
+        """Return the number of items claimed by a worker."""
+        return self.store.count_processing()
 
     def get_all(self) -> list[str]:
         """TODO: Docstring this."""
-        return self._find(self.ENTRIES, "*.dbrecord")
+        return self.store.get_all()
+
+    def get_waiting(self) -> list[str]:
+        """Return the items not claimed by any worker, oldest first."""
+        return self.store.get_all(waiting=True)
+
+    def get_processing_directory(self, worker: str) -> Path:
+        """Return the directory where worker keeps its claimed items."""
+        return Path(self.ENTRIES) / self.PROCESSING / worker
+
+    def get_claimed(self, worker: str) -> list[str]:
+        """Return the items currently claimed by worker."""
+        directory = self.get_processing_directory(worker)
+        if not directory.exists():
+            return []
+
+        return sorted(str(path) for path in directory.glob("*.dbrecord"))
+
+    def claim(self, filename: str, worker: str) -> str | None:
+        """
+        Take an item out of the waiting queue for worker.
+
+        A single rename both claims and dequeues the item. Returns the
+        new filename, or None if another worker claimed it first.
+        The modification time of a claimed item is its lease heartbeat,
+        it is set before the rename so the claim is never seen expired.
+        """
+        directory = self.get_processing_directory(worker)
+        directory.mkdir(parents=True, exist_ok=True)
+        target = directory / Path(filename).name
+        try:
+            os.utime(filename)
+            Path(filename).rename(target)
+        except FileNotFoundError:
+            return None
+
+        self.store.move(filename, str(target), worker)
+        return str(target)
+
+    def renew(self, filename: str) -> bool:
+        """
+        Renew the lease of a claimed item.
+
+        Returns False if the item is no longer there, for example because
+        its lease expired and another worker reclaimed it.
+        """
+        try:
+            os.utime(filename)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def reclaim_expired(self, lease_seconds: float) -> list[str]:
+        """Put back in the queue the claimed items with an expired lease."""
+        time_limit = time.time() - lease_seconds
+        reclaimed = []
+        processing = Path(self.ENTRIES) / self.PROCESSING
+        for path in processing.glob("*/*.dbrecord"):
+            try:
+                expired = path.stat().st_mtime < time_limit
+            except FileNotFoundError:
+                continue
+
+            if not expired:
+                continue
+
+            target = self.release(str(path))
+            if target:
+                logging.info(f"Queue.reclaim_expired. Lease expired: {path}")
+                reclaimed.append(target)
+
+        return reclaimed
+
+    def release(self, filename: str) -> str | None:
+        """Put a claimed item back in the waiting queue."""
+        target = Path(self.ENTRIES) / Path(filename).name
+        try:
+            Path(filename).rename(target)
+        except FileNotFoundError:
+            return None
+
+        self.store.move(filename, str(target), None)
+        return str(target)
 
-    def put(self, filename_dbrecord: str, content: str) -> None:
+    def put(
+        self, filename_dbrecord: str, content: str, email: str = ""
+    ) -> None:
         """TODO: Docstring this."""
         if self.g_check_directory:
             self.g_check_directory = False
@@ -102,11 +400,48 @@ class Queue:  # works with filenames
         if not entries_path.exists():
             entries_path.mkdir(parents=True)
 
-        Path(filename_dbrecord).write_text(content)
+        # The record is written under a temporary name and renamed into
+        # place, so readers and directory watchers only ever see complete
+        # records. It is indexed once the file is there, the index never
+        # points to a missing file.
+        temp_file = Path(f"{filename_dbrecord}.tmp")
+        temp_file.write_text(content)
+        temp_file.replace(filename_dbrecord)
+        self.store.add(filename_dbrecord, email, content)
 
     def delete(self, filename: str) -> None:
         """TODO: Docstring this."""
-        Path(filename).unlink()
+        Path(filename).unlink(missing_ok=True)
+        self.store.remove(filename)
+
+    def _exists(self, filename: str) -> bool:
+        # A claim or a release renames the file before the index is
+        # updated, look for it in the other places it can be meanwhile
+        if Path(filename).exists():
+            return True
+
+        name = Path(filename).name
+        if (Path(self.ENTRIES) / name).exists():
+            return True
+
+        processing = Path(self.ENTRIES) / self.PROCESSING
+        return any(processing.glob(f"*/{name}"))
+
+    def _drop_missing(
+        self, contents: list[tuple[str, str | None]]
+    ) -> list[tuple[str, str | None]]:
+        """Drop from the index the items whose file no longer exists."""
+        found = []
+        for filename, content in contents:
+            # Without content the file has just been found on disk
+            if content is None or self._exists(filename):
+                found.append((filename, content))
+                continue
+
+            logging.warning(f"Queue. Dropping {filename}, the file is gone")
+            self.store.remove(filename)
+
+        return found
 
 
 class BatchFilesDB(Queue):
@@ -122,26 +457,6 @@ class BatchFilesDB(Queue):
         """TODO: Docstring this."""
         return str(uuid.uuid4())
 
-    def _optional_int(self, string: str) -> int | None:
-        try:
-            return (
-                None if string == "None" or len(string) == 0 else int(string)
-            )
-        except Exception as e:
-            logging.error(f"_optional_int. Error: {e}")
-            return None
-
-    def _optional_bool(self, string: str) -> bool | None:
-        try:
-            return (
-                None
-                if string == "None" or len(string) == 0
-                else string == "True"
-            )
-        except Exception as e:
-            logging.error(f"_optional_bool. Error: {e}")
-            return None
-
     def create(
         self,
         filename: str,
@@ -152,6 +467,14 @@ class BatchFilesDB(Queue):
         num_chars: str | None = None,
         num_sentences: str | None = None,
         record_uuid: str | None = None,
+        file_size: int | None = None,
+        duration: float | None = None,
+        priority: int = 0,
+        sample_rate: int | None = None,
+        channels: int | None = None,
+        channel_layout: str | None = None,
+        codec: str | None = None,
+        content_hash: str | None = None,
     ) -> str | None:
         """TODO: Docstring this."""
         if not record_uuid:
@@ -160,23 +483,69 @@ class BatchFilesDB(Queue):
         filename_dbrecord = self.get_record_file_from_uuid(record_uuid)
         dt_token = self.get_new_uuid()
         delete_token = f"dt_{dt_token}"
-        line = f"v2{self.SEPARATOR}{filename}{self.SEPARATOR}{email}{self.SEPARATOR}{model_name}{self.SEPARATOR}{original_filename}{self.SEPARATOR}{delete_token}"
-        line += f"{self.SEPARATOR}{highlight_words}{self.SEPARATOR}{num_chars}{self.SEPARATOR}{num_sentences}"
-        self.put(filename_dbrecord, line)
+        # Values are validated here so that reading a record never has to
+        # recover from a bad field
+        fields = [
+            "v3",
+            str(filename),
+            email,
+            model_name,
+            original_filename,
+            delete_token,
+            _format_optional(highlight_words),
+            _format_optional(BatchFile._safe_int(num_chars)),
+            _format_optional(BatchFile._safe_int(num_sentences)),
+            repr(time.time()),
+            _format_optional(file_size),
+            _format_optional(duration),
+            str(int(priority)),
+            _format_optional(sample_rate),
+            _format_optional(channels),
+            _format_optional(channel_layout),
+            _format_optional(codec),
+            _format_optional(content_hash),
+        ]
+        line = self.SEPARATOR.join(fields)
+        self.put(filename_dbrecord, line, email)
         return record_uuid
 
-    def select(self, email: str | None = None) -> list[BatchFile]:
+    def _get_email(self, content: str) -> str:
+        components = content.split(self.SEPARATOR, 3)
+        return components[2] if len(components) > 2 else ""
+
+    def _get_enqueued(self, content: str) -> float | None:
+        if not content.startswith("v3"):
+            return None
+
+        components = content.split(self.SEPARATOR, 10)
+        return _parse_float(components[9]) if len(components) > 9 else None
+
+    def count(self, email: str | None = None) -> int:
         """TODO: Docstring this."""
-        filenames = self.get_all()
-        records = []
-        for filename in filenames:
-            record = self._read_record(filename)
+        store = self.store
+        if email is not None and not store.indexes_email:
+            return len(self.select(email=email))
 
-            if email and record and record.email.lower() != email.lower():
-                continue
+        return store.count(email)
 
-            if record is not None:
-                records.append(record)
+    def count_per_email(self) -> dict[str, int]:
+        """Return the number of records of each email, in lowercase."""
+        store = self.store
+        if store.indexes_email:
+            return store.count_per_email()
+
+        return dict(Counter(record.email.lower() for record in self.select()))
+
+    def select(
+        self, email: str | None = None, *, waiting: bool = False
+    ) -> list[BatchFile]:
+        """TODO: Docstring this."""
+        records = self._parse_records(
+            self._drop_missing(self.store.get_contents(email, waiting=waiting))
+        )
+        if email:
+            email = email.lower()
+            records = [r for r in records if r.email.lower() == email]
 
         return records
 
@@ -185,27 +554,82 @@ class BatchFilesDB(Queue):
         record = self._read_record(record_fullpath)
         return record
 
-    def _read_record(self, filename_dbrecord: str) -> BatchFile | None:
-        try:
-            with Path(filename_dbrecord).open("r") as fh:
-                line = fh.readline()
-                components = line.split(self.SEPARATOR)
-                if components[0] == "v2":
-                    return BatchFile(
-                        filename_dbrecord=filename_dbrecord,
-                        filename=components[1],
-                        email=components[2],
-                        model_name=components[3],
-                        original_filename=components[4],
-                        delete_token=components[5],
-                        highlight_words=self._optional_bool(components[6]),
-                        num_chars=self._optional_int(components[7]),
-                        num_sentences=self._optional_int(components[8]),
+    def _parse_record(self, filename_dbrecord: str, line: str) -> BatchFile:
+        components = line.rstrip("\n").split(self.SEPARATOR)
+        version = components[0]
+        if version == "v3":
+            return _parse_v3(filename_dbrecord, components)
+
+        if version == "v2":
+            return BatchFile(
+                filename_dbrecord=filename_dbrecord,
+                filename=components[1],
+                email=components[2],
+                model_name=components[3],
+                original_filename=components[4],
+                delete_token=components[5],
+                highlight_words=_parse_v2_bool(components[6]),
+                num_chars=_parse_v2_int(components[7]),
+                num_sentences=_parse_v2_int(components[8]),
+            )
+        raise RuntimeError("dbrecord version not supported")
+
+    def _parse_records(
+        self, contents: list[tuple[str, str | None]]
+    ) -> list[BatchFile]:
+        """
+        Parse many records at once.
+
+        v3 records take a single split and no per field error handling,
+        anything else goes through the generic path.
+        """
+        missing = [filename for filename, content in contents if not content]
+        if missing:
+            lines = dict(zip(missing, read_first_lines(missing), strict=True))
+            contents = [
+                (filename, content or lines[filename])
+                for filename, content in contents
+            ]
+
+        records = []
+        append = records.append
+        separator = self.SEPARATOR
+        for filename, content in contents:
+            if content is None:
+                # Already logged by read_first_lines
+                record = None
+            elif content.startswith("v3\t"):
+                try:
+                    record = _parse_v3(
+                        filename, content.rstrip("\n").split(separator)
+                    )
+                except (ValueError, IndexError) as exception:
+                    logging.error(
+                        f"_parse_records. Unable to parse {filename}. Error: {exception}"
                     )
-                raise RuntimeError("dbrecord version not supported")
+                    record = None
+            else:
+                record = self._record_from_content(filename, content)
 
+            if record is not None:
+                append(record)
+
+        return records
+
+    def _record_from_content(
+        self, filename_dbrecord: str, line: str
+    ) -> BatchFile | None:
+        try:
+            return self._parse_record(filename_dbrecord, line)
         except Exception as exception:
             logging.error(
-                f"_read_record. Unable to read {filename_dbrecord}. Error: {exception}"
+                f"_read_record. Unable to parse {filename_dbrecord}. Error: {exception}"
             )
             return None
+
+    def _read_record(self, filename_dbrecord: str) -> BatchFile | None:
+        line = _read_first_line(filename_dbrecord)
+        if line is None:
+            return None
+
+        return self._record_from_content(filename_dbrecord, line)
@@ -0,0 +1,123 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import json
+import logging
+import shutil
+import subprocess
+from dataclasses import dataclass
+
+FFPROBE = "ffprobe"
+
+
+class MediaProbeError(Exception):
+    """The file has no audio stream that can be decoded."""
+
+
+@dataclass
+class MediaInfo:
+    """What the container headers say about the first audio stream."""
+
+    duration: float | None = None
+    sample_rate: int | None = None
+    channels: int | None = None
+    channel_layout: str | None = None
+    codec: str | None = None
+
+
+def is_available() -> bool:
+    """Return True if ffprobe is installed."""
+    return shutil.which(FFPROBE) is not None
+
+
+def _to_float(value: str | None) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value: str | int | None) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_ffprobe(output: str) -> MediaInfo:
+    """
+    Build a MediaInfo from the json written by ffprobe.
+
+    Raises MediaProbeError if there is no audio stream.
+    """
+    data = json.loads(output or "{}")
+    streams = data.get("streams") or []
+    if not streams:
+        raise MediaProbeError("No audio stream found")
+
+    stream = streams[0]
+    duration = _to_float(data.get("format", {}).get("duration"))
+    if duration is None:
+        duration = _to_float(stream.get("duration"))
+
+    return MediaInfo(
+        duration=duration,
+        sample_rate=_to_int(stream.get("sample_rate")),
+        channels=_to_int(stream.get("channels")),
+        channel_layout=stream.get("channel_layout") or None,
+        codec=stream.get("codec_name") or None,
+    )
+
+
+def probe(filename: str, timeout: float = 30) -> MediaInfo | None:
+    """
+    Read the container headers of filename with ffprobe.
+
+    Returns None if the file cannot be probed here (ffprobe is missing or
+    it timed out). Raises MediaProbeError if ffprobe cannot decode the file
+    or it has no audio.
+    """
+    cmd = [
+        FFPROBE,
+        "-v",
+        "error",
+        "-select_streams",
+        "a:0",
+        "-show_entries",
+        "format=duration:stream=codec_name,sample_rate,channels,channel_layout,duration",
+        "-of",
+        "json",
+        str(filename),
+    ]
+    try:
+        result = subprocess.run(
+            cmd, capture_output=True, text=True, timeout=timeout, check=False
+        )
+    except (OSError, subprocess.TimeoutExpired) as exception:
+        logging.debug(f"probe. Cannot probe {filename}: {exception}")
+        return None
+
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise MediaProbeError(error[-1] if error else "ffprobe failed")
+
+    try:
+        return parse_ffprobe(result.stdout)
+    except ValueError as exception:
+        raise MediaProbeError(str(exception)) from exception
@@ -18,6 +18,7 @@
 # Boston, MA 02111-1307, USA.
 
 import fnmatch
+import hashlib
 import logging
 import os
 import shutil
@@ -27,6 +28,13 @@ from pathlib import Path
 
 PROCESSED = "/srv/data/processed"
 
+# Maps the content of an upload and its options to the uuid that holds
+# its transcription. Entries are purged with the processed files.
+CONTENT_INDEX = "index"
+
+# Outputs that can be reused for an identical upload
+REUSABLE_EXTENSIONS = ("txt", "srt", "json")
+
 
 class ProcessedFiles:
     """TODO: Docstring this class."""
@@ -92,10 +100,14 @@ class ProcessedFiles:
 
         logging.debug(f"Moved file {full_filename} to {target}")
 
-    def _find_files(directory: str, pattern: str) -> list[str]:
+    def _find_files(
+        directory: str, pattern: str, exclude: str | None = None
+    ) -> list[str]:
         filelist = []
 
-        for root, _, files in os.walk(directory):
+        for root, dirs, files in os.walk(directory):
+            if exclude in dirs:
+                dirs.remove(exclude)
             for basename in files:
                 if fnmatch.fnmatch(basename, pattern):
                     filename = str(Path(root) / basename)
@@ -105,7 +117,7 @@ class ProcessedFiles:
 
     def get_num_of_files_stored(directory: str = PROCESSED) -> int:
         """TODO: Docstring this."""
-        files = ProcessedFiles._find_files(directory, "*")
+        files = ProcessedFiles._find_files(directory, "*", CONTENT_INDEX)
         return len(files)
 
     def _get_human_readable_size(size: int) -> str:
@@ -120,7 +132,7 @@ class ProcessedFiles:
 
     def get_num_of_files_stored_size(directory: str = PROCESSED) -> str:
         """TODO: Docstring this."""
-        files = ProcessedFiles._find_files(directory, "*")
+        files = ProcessedFiles._find_files(directory, "*", CONTENT_INDEX)
         total_size = 0
         for _file in files:
             total_size += Path(_file).stat().st_size
@@ -174,3 +186,76 @@ class ProcessedFiles:
                 deleted += 1
 
         return deleted
+
+    @staticmethod
+    def get_content_key(
+        content_hash: str,
+        model_name: str,
+        highlight_words: bool | None,  # noqa: FBT001
+        num_chars: int | None,
+        num_sentences: int | None,
+    ) -> str:
+        """Return the index key of an upload with the given options."""
+        fields = [
+            content_hash,
+            model_name,
+            str(highlight_words),
+            str(num_chars),
+            str(num_sentences),
+        ]
+        return hashlib.sha256("\t".join(fields).encode()).hexdigest()
+
+    @staticmethod
+    def find_by_content(key: str, directory: str = PROCESSED) -> str | None:
+        """Return the uuid whose outputs match key, if they still exist."""
+        index = Path(directory) / CONTENT_INDEX / key
+        try:
+            _uuid = index.read_text().strip()
+        except OSError:
+            return None
+
+        for extension in REUSABLE_EXTENSIONS:
+            if not (Path(directory) / f"{_uuid}.{extension}").exists():
+                return None
+
+        return _uuid
+
+    def register_content(self, key: str, directory: str = PROCESSED) -> None:
+        """Record that the outputs of this uuid answer key."""
+        index = Path(directory) / CONTENT_INDEX
+        index.mkdir(parents=True, exist_ok=True)
+        temp = index / f"{key}.{os.getpid()}.tmp"
+        temp.write_text(self.uuid)
+        temp.replace(index / key)
+
+    def reuse_outputs(
+        self, source_uuid: str, directory: str = PROCESSED
+    ) -> bool:
+        """
+        Make the outputs of source_uuid available under this uuid.
+
+        Hard links are used when possible so no space is taken. Returns
+        False if any output is missing, leaving nothing behind.
+        """
+        created = []
+        for extension in REUSABLE_EXTENSIONS:
+            source = Path(directory) / f"{source_uuid}.{extension}"
+            target = Path(directory) / f"{self.uuid}.{extension}"
+            try:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy(source, target)
+            except OSError as exception:
+                logging.error(
+                    f"reuse_outputs. Cannot reuse {source}: {exception}"
+                )
+                for filename in created:
+                    filename.unlink(missing_ok=True)
+                return False
+
+            # A new mtime keeps the copy for the whole purge period
+            os.utime(target)
+            created.append(target)
+
+        return True
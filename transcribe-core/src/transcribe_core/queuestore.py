@@ -0,0 +1,441 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import abc
+import fnmatch
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# SQLite in WAL mode needs a local filesystem, the data volume is usually
+# a network one
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "files")
+
+RECORD_PATTERN = "*.dbrecord"
+
+
+class QueueStore(abc.ABC):
+    """
+    Keeps the list of records in a queue directory.
+
+    The records themselves are always files in the directory, the store
+    only decides how they are found and in which order they are served.
+    Records claimed by a worker live in a subdirectory of processing/
+    until the job is done and still count as part of the queue.
+    """
+
+    # True if count and get_contents can filter by email themselves and
+    # the store has count_per_email
+    indexes_email = False
+
+    def __init__(self, entries: str) -> None:
+        """Create a store for the records in the entries directory."""
+        self.entries = entries
+
+    def needs_migration(self) -> bool:
+        """Return True if existing records have to be imported."""
+        return False
+
+    # The index hooks do nothing in stores that keep no index
+    def add(  # noqa: B027
+        self,
+        filename: str,
+        email: str,
+        content: str,
+        enqueued: float | None = None,
+    ) -> None:
+        """Register a record that has just been written."""
+        pass
+
+    def remove(self, filename: str) -> None:  # noqa: B027
+        """Forget a record that is no longer in the queue."""
+        pass
+
+    def move(  # noqa: B027
+        self, filename: str, new_filename: str, worker: str | None
+    ) -> None:
+        """Register that a record was claimed by worker, or released."""
+        pass
+
+    def count(self, email: str | None = None) -> int:  # noqa: ARG002
+        """Return the number of records, optionally for one email."""
+        return len(self.get_all())
+
+    def count_processing(self) -> int:
+        """Return the number of records claimed by a worker."""
+        return self.count() - len(self.get_all(waiting=True))
+
+    @abc.abstractmethod
+    def get_all(self, *, waiting: bool = False) -> list[str]:
+        """Return the record filenames (only unclaimed if waiting)."""
+
+    def get_contents(
+        self,
+        email: str | None = None,  # noqa: ARG002
+        *,
+        waiting: bool = False,
+    ) -> list[tuple[str, str | None]]:
+        """
+        Return (filename, content) pairs, oldest first.
+
+        Content is None when the store does not keep it and the caller
+        has to read the record file.
+        """
+        return [(filename, None) for filename in self.get_all(waiting=waiting)]
+
+    def sync(  # noqa: B027
+        self, records: list[tuple[str, str, str, float, str | None]]
+    ) -> None:
+        """Make the index match the records found on disk."""
+        pass
+
+
+class FileQueueStore(QueueStore):
+    """Finds the records by walking the entries directory on each call."""
+
+    def _find(self, directory: str, pattern: str) -> list[str]:
+        # scandir gives us the names and types in one pass, the mtime for
+        # sorting comes from the same DirEntry without building Paths
+        found = []
+        directories = [directory]
+        while directories:
+            try:
+                with os.scandir(directories.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif fnmatch.fnmatch(entry.name, pattern):
+                            try:
+                                mtime = entry.stat().st_mtime
+                            except FileNotFoundError:
+                                continue
+                            found.append((mtime, entry.path))
+            except FileNotFoundError:
+                continue
+
+        found.sort()
+        return [filename for _, filename in found]
+
+    def get_all(self, *, waiting: bool = False) -> list[str]:
+        """Return the record filenames (only unclaimed if waiting)."""
+        filenames = self._find(self.entries, RECORD_PATTERN)
+        if waiting:
+            entries = Path(self.entries)
+            filenames = [f for f in filenames if Path(f).parent == entries]
+
+        return filenames
+
+
+class SQLiteQueueStore(QueueStore):
+    """
+    Keeps an ordered index of the records in a SQLite database.
+
+    The database lives next to the records and runs in WAL mode so the
+    service and the workers can read it while another process writes.
+    WAL needs shared memory, use the 'files' backend when the entries
+    directory is on a network filesystem.
+    """
+
+    DATABASE = "queue.sqlite"
+    SCHEMA_VERSION = 3
+    indexes_email = True
+
+    def __init__(self, entries: str) -> None:
+        """Open (and create if needed) the index for entries."""
+        super().__init__(entries)
+        self.lock = threading.Lock()
+        self._migrate = False
+        self.connection = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        Path(self.entries).mkdir(parents=True, exist_ok=True)
+        database = Path(self.entries) / self.DATABASE
+        connection = sqlite3.connect(
+            database,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        # Needed for the delete trigger to run on INSERT OR REPLACE
+        connection.execute("PRAGMA recursive_triggers=ON")
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                filename TEXT PRIMARY KEY,
+                email TEXT NOT NULL,
+                enqueued REAL NOT NULL,
+                content TEXT NOT NULL,
+                worker TEXT
+            );
+            CREATE INDEX IF NOT EXISTS entries_enqueued
+                ON entries(enqueued);
+            CREATE INDEX IF NOT EXISTS entries_email
+                ON entries(email, enqueued);
+
+            -- Live admission counters: one row per email and the total
+            CREATE TABLE IF NOT EXISTS counters (
+                email TEXT PRIMARY KEY,
+                total INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queue_total (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO queue_total VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS entries_count_insert
+                AFTER INSERT ON entries
+            BEGIN
+                INSERT INTO counters VALUES (NEW.email, 1)
+                    ON CONFLICT(email) DO UPDATE SET total = total + 1;
+                UPDATE queue_total SET total = total + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_count_delete
+                AFTER DELETE ON entries
+            BEGIN
+                UPDATE counters SET total = total - 1
+                    WHERE email = OLD.email;
+                DELETE FROM counters WHERE email = OLD.email AND total <= 0;
+                UPDATE queue_total SET total = total - 1;
+            END;
+            """
+        )
+        columns = {
+            row[1] for row in connection.execute("PRAGMA table_info(entries)")
+        }
+        if "worker" not in columns:
+            connection.execute("ALTER TABLE entries ADD COLUMN worker TEXT")
+
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_worker"
+            " ON entries(worker, enqueued)"
+        )
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        self._migrate = version < self.SCHEMA_VERSION
+        return connection
+
+    def needs_migration(self) -> bool:
+        """Return True if the index has never imported the directory."""
+        return self._migrate
+
+    def add(
+        self,
+        filename: str,
+        email: str,
+        content: str,
+        enqueued: float | None = None,
+    ) -> None:
+        """Register a record that has just been written."""
+        if enqueued is None:
+            enqueued = time.time()
+
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (filename, email, enqueued, content) VALUES (?, ?, ?, ?)",
+                (filename, email.lower(), enqueued, content),
+            )
+
+    def remove(self, filename: str) -> None:
+        """Forget a record that is no longer in the queue."""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM entries WHERE filename = ?", (filename,)
+            )
+
+    def move(
+        self, filename: str, new_filename: str, worker: str | None
+    ) -> None:
+        """Register that a record was claimed by worker, or released."""
+        with self.lock:
+            self.connection.execute(
+                "UPDATE entries SET filename = ?, worker = ?"
+                " WHERE filename = ?",
+                (new_filename, worker, filename),
+            )
+
+    def count(self, email: str | None = None) -> int:
+        """
+        Return the number of records, optionally for one email.
+
+        Reads the counters kept by the triggers, a single key lookup.
+        """
+        with self.lock:
+            if email is None:
+                cursor = self.connection.execute(
+                    "SELECT total FROM queue_total"
+                )
+            else:
+                cursor = self.connection.execute(
+                    "SELECT total FROM counters WHERE email = ?",
+                    (email.lower(),),
+                )
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    def count_per_email(self) -> dict[str, int]:
+        """Return the number of records of each (lowercase) email."""
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT email, total FROM counters WHERE total > 0"
+            )
+            return dict(cursor.fetchall())
+
+    def count_processing(self) -> int:
+        """Return the number of records claimed by a worker."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM entries WHERE worker IS NOT NULL"
+            ).fetchone()[0]
+
+    def _where(
+        self, email: str | None, *, waiting: bool
+    ) -> tuple[str, tuple[str, ...]]:
+        conditions = []
+        params = ()
+        if email is not None:
+            conditions.append("email = ?")
+            params = (email.lower(),)
+
+        if waiting:
+            conditions.append("worker IS NULL")
+
+        if not conditions:
+            return "", params
+
+        return " WHERE " + " AND ".join(conditions), params
+
+    def get_all(self, *, waiting: bool = False) -> list[str]:
+        """Return the record filenames (only unclaimed if waiting)."""
+        where, params = self._where(None, waiting=waiting)
+        with self.lock:
+            cursor = self.connection.execute(
+                f"SELECT filename FROM entries{where}"
+                " ORDER BY enqueued, rowid",
+                params,
+            )
+            return [row[0] for row in cursor]
+
+    def get_contents(
+        self, email: str | None = None, *, waiting: bool = False
+    ) -> list[tuple[str, str | None]]:
+        """Return (filename, content) pairs, oldest first."""
+        where, params = self._where(email, waiting=waiting)
+        with self.lock:
+            cursor = self.connection.execute(
+                f"SELECT filename, content FROM entries{where}"
+                " ORDER BY enqueued, rowid",
+                params,
+            )
+            return cursor.fetchall()
+
+    def _rebuild_counters(self) -> None:
+        self.connection.execute("DELETE FROM counters")
+        self.connection.execute(
+            "INSERT INTO counters"
+            " SELECT email, COUNT(*) FROM entries GROUP BY email"
+        )
+        self.connection.execute(
+            "UPDATE queue_total SET total = (SELECT COUNT(*) FROM entries)"
+        )
+
+    def sync(
+        self, records: list[tuple[str, str, str, float, str | None]]
+    ) -> None:
+        """
+        Make the index match the records found on disk.
+
+        Records already indexed keep their enqueue time, rows whose file
+        no longer exists are dropped. Rows added by another process while
+        the directory was being scanned are kept since their file exists.
+        The admission counters are recomputed from the result.
+        """
+        found = {record[0] for record in records}
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO entries"
+                    " (filename, email, enqueued, content, worker)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (filename, email.lower(), enqueued, content, worker)
+                        for filename, email, content, enqueued, worker in (
+                            records
+                        )
+                    ],
+                )
+                indexed = self.connection.execute(
+                    "SELECT filename FROM entries"
+                ).fetchall()
+                stale = [
+                    (filename,)
+                    for (filename,) in indexed
+                    if filename not in found and not Path(filename).exists()
+                ]
+                self.connection.executemany(
+                    "DELETE FROM entries WHERE filename = ?", stale
+                )
+                self._rebuild_counters()
+                self.connection.execute(
+                    f"PRAGMA user_version = {self.SCHEMA_VERSION}"
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+        self._migrate = False
+        logging.info(
+            f"SQLiteQueueStore. Indexed {len(records)} records in {self.entries}, dropped {len(stale)} stale"
+        )
+
+
+_stores: dict[tuple[str, str, int], QueueStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_queue_store(entries: str, backend: str | None = None) -> QueueStore:
+    """
+    Return the store for the entries directory.
+
+    Stores are shared inside a process, a forked process gets its own
+    since SQLite connections cannot be shared across a fork.
+    """
+    if backend is None:
+        backend = QUEUE_BACKEND
+
+    key = (entries, backend, os.getpid())
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            if backend == "sqlite":
+                store = SQLiteQueueStore(entries)
+            elif backend == "files":
+                store = FileQueueStore(entries)
+            else:
+                raise ValueError(f"Unknown queue backend '{backend}'")
+
+            _stores[key] = store
+
+        return store
@@ -38,8 +38,8 @@ class TestBatchFilesDB(unittest.TestCase):
     def tearDown(self):
         self.temp_dir.cleanup()
 
-    def _create_db_object(self):
-        db = BatchFilesDB()
+    def _create_db_object(self, backend=None):
+        db = BatchFilesDB(backend=backend)
         db.ENTRIES = self.ENTRIES
         return db
 
@@ -111,7 +111,13 @@ class TestBatchFilesDB(unittest.TestCase):
         self.assertEqual(self.MODEL_NAME, record.model_name)
 
     def test_selected_expected_order(self):
-        db = self._create_db_object()
+        self._test_selected_expected_order(backend="sqlite")
+
+    def test_selected_expected_order_files_backend(self):
+        self._test_selected_expected_order(backend="files")
+
+    def _test_selected_expected_order(self, backend):
+        db = self._create_db_object(backend=backend)
         MINUTES_SEC = 60
         MAX_FILES_IN_QUEUE = 20
 
@@ -138,6 +144,228 @@ class TestBatchFilesDB(unittest.TestCase):
         records = len(records_org) - len(db.select())
         self.assertEqual(1, records)
 
+    def test_count_email(self):
+        db = self._create_db_object()
+        db.create(self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3")
+        db.create(self.FILENAME, self.EMAIL2, self.MODEL_NAME, "original_filename.mp3")
+        db.create(self.FILENAME, self.EMAIL3, self.MODEL_NAME, "original_filename.mp3")
+
+        self.assertEqual(3, db.count())
+        self.assertEqual(2, db.count(email=self.EMAIL))
+        self.assertEqual(1, db.count(email=self.EMAIL2))
+
+    def test_count_per_email(self):
+        self._test_count_per_email(backend="sqlite")
+
+    def test_count_per_email_files_backend(self):
+        self._test_count_per_email(backend="files")
+
+    def _test_count_per_email(self, backend):
+        db = self._create_db_object(backend=backend)
+        for email in ["a@x.org", "A@x.org", "A@X.ORG", self.EMAIL2]:
+            db.create(self.FILENAME, email, self.MODEL_NAME, "original_filename.mp3")
+
+        self.assertEqual({"a@x.org": 3, self.EMAIL2: 1}, db.count_per_email())
+        self.assertEqual(3, db.count(email="A@x.org"))
+
+    def test_count_after_replace_and_delete(self):
+        db = self._create_db_object()
+        _uuid = db.create(
+            self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3"
+        )
+        db.create(
+            self.FILENAME,
+            self.EMAIL,
+            self.MODEL_NAME,
+            "original_filename.mp3",
+            record_uuid=_uuid,
+        )
+        self.assertEqual(1, db.count())
+        self.assertEqual(1, db.count(email=self.EMAIL))
+
+        db.delete(db.get_record_file_from_uuid(_uuid))
+        self.assertEqual(0, db.count())
+        self.assertEqual(0, db.count(email=self.EMAIL))
+
+    def test_files_backend(self):
+        db = self._create_db_object(backend="files")
+        db.create(self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3")
+        db.create(self.FILENAME, self.EMAIL2, self.MODEL_NAME, "original_filename.mp3")
+
+        self.assertEqual(2, db.count())
+        self.assertEqual(1, db.count(email=self.EMAIL))
+        self.assertEqual(1, len(db.select(email=self.EMAIL2)))
+
+    def _write_v2_record(self, db, filename, email, highlight_words="None", num_chars="None"):
+        filename_dbrecord = db.get_record_file_from_uuid(db.get_new_uuid())
+        line = f"v2\t{filename}\t{email}\t{self.MODEL_NAME}\toriginal_filename.mp3\tdt_token\t{highlight_words}\t{num_chars}\tNone"
+        with open(filename_dbrecord, "w") as fh:
+            fh.write(line)
+        return filename_dbrecord
+
+    def test_migrate_existing_records(self):
+        db = self._create_db_object(backend="files")
+        MINUTES_SEC = 60
+        for _id in range(0, 5):
+            filename_dbrecord = self._write_v2_record(db, _id, self.EMAIL)
+            past_time = time.time() - (MINUTES_SEC * _id)
+            os.utime(filename_dbrecord, (past_time, past_time))
+
+        db = self._create_db_object(backend="sqlite")
+        records = db.select()
+        self.assertEqual(5, len(records))
+        self.assertEqual("4", records[0].filename)
+        self.assertEqual("0", records[4].filename)
+
+    def test_migrate_drops_stale_records(self):
+        db = self._create_db_object(backend="sqlite")
+        _uuid = db.create(
+            self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3"
+        )
+        os.remove(db.get_record_file_from_uuid(_uuid))
+
+        self.assertEqual(1, db.count())
+        db.migrate()
+        self.assertEqual(0, db.count())
+
+    def test_select_drops_missing_records(self):
+        db = self._create_db_object(backend="sqlite")
+        _uuid = db.create(
+            self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3"
+        )
+        claimed_uuid = db.create(
+            self.FILENAME, self.EMAIL2, self.MODEL_NAME, "original_filename.mp3"
+        )
+        db.claim(db.get_record_file_from_uuid(claimed_uuid), "worker-1")
+        os.remove(db.get_record_file_from_uuid(_uuid))
+
+        records = db.select()
+        self.assertEqual(1, len(records))
+        self.assertEqual(self.EMAIL2, records[0].email)
+        self.assertEqual(1, db.count())
+
+    def _test_claim(self, backend):
+        db = self._create_db_object(backend=backend)
+        _uuid = db.create(
+            self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3"
+        )
+        db.create(self.FILENAME, self.EMAIL2, self.MODEL_NAME, "original_filename.mp3")
+        filename_dbrecord = db.get_record_file_from_uuid(_uuid)
+
+        claimed = db.claim(filename_dbrecord, "worker-1")
+        self.assertEqual(
+            os.path.join(self.ENTRIES, "processing", "worker-1", _uuid + ".dbrecord"),
+            claimed,
+        )
+        self.assertEqual(None, db.claim(filename_dbrecord, "worker-2"))
+        self.assertEqual([claimed], db.get_claimed("worker-1"))
+
+        self.assertEqual(2, db.count())
+        self.assertEqual(1, db.count_processing())
+        waiting = db.select(waiting=True)
+        self.assertEqual(1, len(waiting))
+        self.assertEqual(self.EMAIL2, waiting[0].email)
+
+        self.assertEqual(filename_dbrecord, db.release(claimed))
+        self.assertEqual(0, db.count_processing())
+        self.assertEqual(2, len(db.select(waiting=True)))
+
+    def test_claim(self):
+        self._test_claim("sqlite")
+
+    def test_claim_files_backend(self):
+        self._test_claim("files")
+
+    def test_reclaim_expired(self):
+        db = self._create_db_object()
+        _uuid = db.create(
+            self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3"
+        )
+        filename_dbrecord = db.get_record_file_from_uuid(_uuid)
+        claimed = db.claim(filename_dbrecord, "worker-1")
+
+        self.assertEqual([], db.reclaim_expired(60))
+        self.assertTrue(db.renew(claimed))
+
+        old_time = time.time() - 120
+        os.utime(claimed, (old_time, old_time))
+        self.assertEqual([filename_dbrecord], db.reclaim_expired(60))
+        self.assertEqual(1, len(db.select(waiting=True)))
+        self.assertFalse(db.renew(claimed))
+
+    def test_migrate_claimed_records(self):
+        db = self._create_db_object(backend="files")
+        _uuid = db.create(
+            self.FILENAME, self.EMAIL, self.MODEL_NAME, "original_filename.mp3"
+        )
+        db.claim(db.get_record_file_from_uuid(_uuid), "worker-1")
+
+        db = self._create_db_object(backend="sqlite")
+        self.assertEqual(1, db.count())
+        self.assertEqual(1, db.count_processing())
+        self.assertEqual(0, len(db.select(waiting=True)))
+
+    def test_read_v2_record(self):
+        db = self._create_db_object()
+        filename_dbrecord = self._write_v2_record(
+            db, self.FILENAME, self.EMAIL, highlight_words="True", num_chars="20"
+        )
+
+        record = db._read_record(filename_dbrecord)
+        self.assertEqual(self.FILENAME, record.filename)
+        self.assertEqual(self.EMAIL, record.email)
+        self.assertEqual(True, record.highlight_words)
+        self.assertEqual(20, record.num_chars)
+        self.assertEqual(None, record.num_sentences)
+        self.assertEqual(None, record.enqueued)
+        self.assertEqual(0, record.priority)
+
+    def test_create_v3_fields(self):
+        db = self._create_db_object()
+        before = time.time()
+        _uuid = db.create(
+            self.FILENAME,
+            self.EMAIL,
+            self.MODEL_NAME,
+            "original_filename.mp3",
+            file_size=1024,
+            duration=61.5,
+            priority=2,
+            sample_rate=44100,
+            channels=2,
+            channel_layout="stereo",
+            codec="mp3",
+            content_hash="9f86d081",
+        )
+
+        record = db.select()[0]
+        self.assertEqual(db.get_record_file_from_uuid(_uuid), record.filename_dbrecord)
+        self.assertEqual(1024, record.file_size)
+        self.assertEqual(61.5, record.duration)
+        self.assertEqual(2, record.priority)
+        self.assertGreaterEqual(record.enqueued, before)
+        self.assertEqual(44100, record.sample_rate)
+        self.assertEqual(2, record.channels)
+        self.assertEqual("stereo", record.channel_layout)
+        self.assertEqual("mp3", record.codec)
+        self.assertEqual("9f86d081", record.content_hash)
+
+    def test_read_v3_record_without_media(self):
+        db = self._create_db_object()
+        filename = db.get_record_file_from_uuid("0a1b2c3d")
+        fields = ["v3", self.FILENAME, self.EMAIL, self.MODEL_NAME, "a.mp3",
+                  "dt_token", "", "", "", "1000.5", "1024", "61.5", "0"]
+        with open(filename, "w") as fh:
+            fh.write("\t".join(fields))
+
+        record = db.select()[0]
+        self.assertEqual(61.5, record.duration)
+        self.assertIsNone(record.sample_rate)
+        self.assertIsNone(record.channels)
+        self.assertIsNone(record.channel_layout)
+        self.assertIsNone(record.codec)
+        self.assertIsNone(record.content_hash)
+
     def test_create_extraparams_values(self):
         db = self._create_db_object()
 
@@ -165,7 +393,7 @@ class TestBatchFilesDB(unittest.TestCase):
         self.assertEqual(NUM_CHARS, record.num_chars)
         self.assertEqual(NUM_SENTENCES, record.num_sentences)
 
-    def _test_create_with_bad_params(self):
+    def test_create_with_bad_params(self):
         db = self._create_db_object()
 
         HIGHLIGHT_WORDS = True
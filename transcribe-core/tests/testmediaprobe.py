@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025 Jordi Mas i Hernandez <jmas@softcatala.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+from transcribe_core import mediaprobe
+from transcribe_core.mediaprobe import MediaProbeError, parse_ffprobe
+import json
+import tempfile
+import unittest
+
+
+class TestMediaProbe(unittest.TestCase):
+    def test_parse_ffprobe(self):
+        output = json.dumps(
+            {
+                "streams": [
+                    {
+                        "codec_name": "mp3",
+                        "sample_rate": "44100",
+                        "channels": 2,
+                        "channel_layout": "stereo",
+                    }
+                ],
+                "format": {"duration": "61.500000"},
+            }
+        )
+        info = parse_ffprobe(output)
+        self.assertEqual(61.5, info.duration)
+        self.assertEqual(44100, info.sample_rate)
+        self.assertEqual(2, info.channels)
+        self.assertEqual("stereo", info.channel_layout)
+        self.assertEqual("mp3", info.codec)
+
+    def test_parse_ffprobe_stream_duration(self):
+        output = json.dumps(
+            {"streams": [{"codec_name": "opus", "duration": "3.2"}], "format": {}}
+        )
+        info = parse_ffprobe(output)
+        self.assertEqual(3.2, info.duration)
+        self.assertIsNone(info.sample_rate)
+        self.assertIsNone(info.channel_layout)
+
+    def test_parse_ffprobe_no_audio(self):
+        output = json.dumps({"streams": [], "format": {"duration": "10"}})
+        with self.assertRaises(MediaProbeError):
+            parse_ffprobe(output)
+
+    def test_probe_without_ffprobe(self):
+        original = mediaprobe.FFPROBE
+        mediaprobe.FFPROBE = "ffprobe-does-not-exist"
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".mp3") as fh:
+                self.assertIsNone(mediaprobe.probe(fh.name))
+                self.assertFalse(mediaprobe.is_available())
+        finally:
+            mediaprobe.FFPROBE = original
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -57,6 +57,15 @@ class TestProcessedFiles(unittest.TestCase):
         num = ProcessedFiles.get_num_of_files_stored(self.temp_dir.name)
         self.assertEqual(TOTAL_FILES, num)
 
+    def test_get_num_of_files_stored_skips_index(self):
+        self._write_outputs("a")
+        ProcessedFiles("a").register_content("key", self.temp_dir.name)
+
+        num = ProcessedFiles.get_num_of_files_stored(self.temp_dir.name)
+        size = ProcessedFiles.get_num_of_files_stored_size(self.temp_dir.name)
+        self.assertEqual(3, num)
+        self.assertEqual("10 bytes", size)
+
     def test_get_num_of_files_stored_size(self):
         for day in range(0, 2):
             filename = os.path.join(self.temp_dir.name, f"file-{day}")
@@ -66,6 +75,41 @@ class TestProcessedFiles(unittest.TestCase):
         size = ProcessedFiles.get_num_of_files_stored_size(self.temp_dir.name)
         self.assertEqual("10 bytes", size)
 
+    def _write_outputs(self, _uuid):
+        for extension in ["txt", "srt", "json"]:
+            filename = os.path.join(self.temp_dir.name, f"{_uuid}.{extension}")
+            with open(filename, "w") as file:
+                file.write(extension)
+
+    def test_get_content_key(self):
+        key = ProcessedFiles.get_content_key("abc", "medium", None, None, None)
+        self.assertEqual(key, ProcessedFiles.get_content_key("abc", "medium", None, None, None))
+        self.assertNotEqual(key, ProcessedFiles.get_content_key("abc", "small", None, None, None))
+        self.assertNotEqual(key, ProcessedFiles.get_content_key("abc", "medium", True, None, None))
+
+    def test_find_by_content(self):
+        directory = self.temp_dir.name
+        key = ProcessedFiles.get_content_key("abc", "medium", None, None, None)
+        self.assertIsNone(ProcessedFiles.find_by_content(key, directory))
+
+        self._write_outputs("uuid1")
+        ProcessedFiles("uuid1").register_content(key, directory)
+        self.assertEqual("uuid1", ProcessedFiles.find_by_content(key, directory))
+
+        os.remove(os.path.join(directory, "uuid1.srt"))
+        self.assertIsNone(ProcessedFiles.find_by_content(key, directory))
+
+    def test_reuse_outputs(self):
+        directory = self.temp_dir.name
+        self._write_outputs("uuid1")
+        self.assertTrue(ProcessedFiles("uuid2").reuse_outputs("uuid1", directory))
+        for extension in ["txt", "srt", "json"]:
+            with open(os.path.join(directory, f"uuid2.{extension}")) as file:
+                self.assertEqual(extension, file.read())
+
+        self.assertFalse(ProcessedFiles("uuid3").reuse_outputs("missing", directory))
+        self.assertFalse(os.path.exists(os.path.join(directory, "uuid3.txt")))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -25,4 +25,26 @@ QUEUE_CAPACITY = int(os.getenv("QUEUE_CAPACITY", "150"))
 # 1GB by default
 MAX_SIZE = int(os.getenv("MAX_SIZE", 1024 * 1024 * 1024))
 
+# Uploads are copied to UPLOAD_FOLDER in chunks of this size
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# Size of the buffer that groups the chunks into larger disk writes
+UPLOAD_WRITE_BUFFER = int(os.getenv("UPLOAD_WRITE_BUFFER", 8 * 1024 * 1024))
+
+# Seconds ffprobe has to read the headers of an upload
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "30"))
+
+# Partial data of the resumable uploads, purged after UPLOAD_SESSION_TTL
+UPLOAD_SESSIONS_FOLDER = "/srv/data/files/sessions/"
+
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+
+# Threads used for writing uploads and for queue and metadata operations
+DATA_IO_THREADS = int(os.getenv("DATA_IO_THREADS", "4"))
+
+METADATA_IO_THREADS = int(os.getenv("METADATA_IO_THREADS", "8"))
+
 MAX_PER_EMAIL = int(os.getenv("MAX_PER_EMAIL", "3"))
+
+# Seconds a queue snapshot is reused before reading the queue again
+QUEUE_SNAPSHOT_TTL = float(os.getenv("QUEUE_SNAPSHOT_TTL", "2"))
@@ -0,0 +1,42 @@
+import asyncio
+import functools
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from transcribe_service.constants import DATA_IO_THREADS, METADATA_IO_THREADS
+
+# Bulk data: writing the uploaded files
+_data_executor = ThreadPoolExecutor(
+    max_workers=DATA_IO_THREADS, thread_name_prefix="data-io"
+)
+
+# Small metadata operations: queue records, counts and directory scans
+_metadata_executor = ThreadPoolExecutor(
+    max_workers=METADATA_IO_THREADS, thread_name_prefix="metadata-io"
+)
+
+
+def _run(
+    executor: ThreadPoolExecutor, func: Callable, *args: Any, **kwargs: Any
+) -> asyncio.Future:
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def run_data(func: Callable, *args: Any, **kwargs: Any) -> asyncio.Future:
+    """Run a blocking bulk data operation outside the event loop."""
+    return _run(_data_executor, func, *args, **kwargs)
+
+
+def run_metadata(func: Callable, *args: Any, **kwargs: Any) -> asyncio.Future:
+    """Run a blocking metadata operation outside the event loop."""
+    return _run(_metadata_executor, func, *args, **kwargs)
+
+
+def shutdown_executors() -> None:
+    """Wait for the pending operations and stop the threads."""
+    _data_executor.shutdown(wait=True)
+    _metadata_executor.shutdown(wait=True)
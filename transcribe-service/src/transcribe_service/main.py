@@ -5,11 +5,15 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from transcribe_service.executors import shutdown_executors
 from transcribe_service.logging import init_logging
+from transcribe_service.middleware import PreBodyAdmissionMiddleware
 from transcribe_service.routes import file, stats, uuid
 from transcribe_service.routes.legacy import file as legacy_file
 from transcribe_service.routes.legacy import uuid as legacy_uuid
+from transcribe_service.services.upload_session import _purge_upload_sessions
 from transcribe_service.telemetry.metrics import (
+    _measure_event_loop_lag,
     _reconcile_in_process,
     _update_queue_depth,
 )
@@ -20,9 +24,14 @@ async def lifespan(_app: FastAPI):  # noqa: ANN201, D103
     init_logging()
     task_queue_depth = asyncio.create_task(_update_queue_depth())
     task_reconcile = asyncio.create_task(_reconcile_in_process())
+    task_event_loop_lag = asyncio.create_task(_measure_event_loop_lag())
+    task_purge_uploads = asyncio.create_task(_purge_upload_sessions())
     yield
     task_queue_depth.cancel()
     task_reconcile.cancel()
+    task_event_loop_lag.cancel()
+    task_purge_uploads.cancel()
+    shutdown_executors()
 
 
 app = FastAPI(title="Softcatalà Transcription Service", lifespan=lifespan)
@@ -35,6 +44,7 @@ app.include_router(legacy_uuid.delete_uuid_router)
 app.include_router(legacy_file.get_file_router)
 app.include_router(legacy_file.upload_file_router)
 
+app.add_middleware(PreBodyAdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -0,0 +1,97 @@
+import json
+from urllib.parse import parse_qs
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from transcribe_service.constants import MAX_SIZE
+from transcribe_service.executors import run_metadata
+from transcribe_service.services.admission import (
+    AdmissionResult,
+    AdmissionService,
+)
+from transcribe_service.telemetry.metrics import uploads_counter
+
+# Upload paths and the key used for the error message in their responses
+UPLOAD_PATHS = {
+    "/file/transcribe": "detail",
+    "/transcribe_file/": "error",
+}
+
+TOO_LARGE = "El fitxer és massa gran"
+QUEUE_FULL = "Hi ha massa fitxers a la cua. Proveu-ho en una estona."
+MAX_PER_EMAIL = "Ja teniu massa fitxers a la cua. Espereu-vos que es processin per enviar-ne de nous."
+
+
+class PreBodyAdmissionMiddleware:
+    """
+    Rejects uploads before their body is received.
+
+    The checks only use what arrives before the body: the content-length
+    header, and the email when the client sends it in the X-Email header.
+    The response is sent without reading the body, so a client that waits
+    for 100-continue never sends it.
+    Uploads without the email are checked later by the upload route.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:  # noqa: D107
+        self.app = app
+
+    async def __call__(
+        self, scope: Scope, receive: Receive, send: Send
+    ) -> None:
+        """Check upload requests, pass everything else through."""
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] not in UPLOAD_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        key = UPLOAD_PATHS[scope["path"]]
+        rejected = await self._check(scope, legacy=key == "error")
+        if rejected is None:
+            await self.app(scope, receive, send)
+            return
+
+        status, result, message = rejected
+        query = parse_qs(scope.get("query_string", b"").decode())
+        model_name = query.get("model_name", [""])[0]
+        uploads_counter.add(1, {"model": model_name, "result": result})
+
+        body = json.dumps({key: message}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"connection", b"close"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    @staticmethod
+    async def _check(
+        scope: Scope, *, legacy: bool
+    ) -> tuple[int, str, str] | None:
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length", b"0")
+        if content_length.isdigit() and int(content_length) >= MAX_SIZE:
+            return 413, "too_large", TOO_LARGE
+
+        email = headers.get(b"x-email", b"").decode()
+        if not email:
+            return None
+
+        match await run_metadata(AdmissionService.check, email):
+            case AdmissionResult.QueueFull, _:
+                return 429, "queue_full", QUEUE_FULL
+
+            case AdmissionResult.MaxPerEmailReached, _:
+                status = 429 if legacy else 403
+                return status, "max_per_email_reached", MAX_PER_EMAIL
+
+        return None
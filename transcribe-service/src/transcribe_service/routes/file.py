@@ -13,11 +13,21 @@ from fastapi import (
 from fastapi.responses import FileResponse
 
 from transcribe_service.constants import MAX_SIZE
+from transcribe_service.executors import run_metadata
+from transcribe_service.services.admission import (
+    AdmissionResult,
+    AdmissionService,
+)
 from transcribe_service.services.file import (
     FileService,
     GetFileResult,
     UploadFileResult,
 )
+from transcribe_service.services.upload_session import (
+    UploadSession,
+    UploadSessionResult,
+    UploadSessionService,
+)
 from transcribe_service.telemetry.metrics import (
     downloads_counter,
     uploaded_file_size_histogram,
@@ -76,6 +86,36 @@ def get_file(
             )
 
 
+@router.get(path="/transcribe/admission")
+async def check_admission(
+    email: Annotated[str, Query(description="Email of the user uploading")],
+) -> dict:
+    """
+    Check if an upload from email would be accepted, before sending it.
+
+    Answers the same errors as /file/transcribe for a full queue or too
+    many files for the email.
+    """
+    if email == "":
+        raise HTTPException(status_code=400, detail="Email cannot be empty")
+
+    match await run_metadata(AdmissionService.check, email):
+        case AdmissionResult.QueueFull, _:
+            raise HTTPException(
+                status_code=429,
+                detail="Hi ha massa fitxers a la cua. Proveu-ho en una estona.",
+            )
+
+        case AdmissionResult.MaxPerEmailReached, _:
+            raise HTTPException(
+                status_code=403,
+                detail="Ja teniu massa fitxers a la cua. Espereu-vos que es processin per enviar-ne de nous.",
+            )
+
+        case AdmissionResult.Ok, waiting_queue_len:
+            return {"waiting_queue": str(waiting_queue_len)}
+
+
 @router.post(path="/transcribe")
 async def upload_file(
     request: Request,
@@ -97,7 +137,7 @@ async def upload_file(
             status_code=400, detail="Form fields cannot be empty"
         )
 
-    if int(request.headers.get("content-length")) >= MAX_SIZE:
+    if int(request.headers.get("content-length", 0)) >= MAX_SIZE:
         raise HTTPException(status_code=413, detail="El fitxer és massa gran")
 
     match await FileService.upload_file(
@@ -138,6 +178,25 @@ async def upload_file(
                 detail="Ja teniu massa fitxers a la cua. Espereu-vos que es processin per enviar-ne de nous.",
             )
 
+        case UploadFileResult.TooLarge, _:
+            uploads_counter.add(
+                1,
+                {"model": model_name, "result": "too_large"},
+            )
+            raise HTTPException(
+                status_code=413, detail="El fitxer és massa gran"
+            )
+
+        case UploadFileResult.NotDecodable, _:
+            uploads_counter.add(
+                1,
+                {"model": model_name, "result": "not_decodable"},
+            )
+            raise HTTPException(
+                status_code=415,
+                detail="El fitxer no conté àudio que es pugui processar",
+            )
+
         case UploadFileResult.Ok, waiting_queue_len:
             uploads_counter.add(
                 1, {"model": model_name, "result": "ok"}
@@ -147,3 +206,168 @@ async def upload_file(
                 {"model": model_name},
             )
             return {"waiting_queue": str(waiting_queue_len)}
+
+
+def _upload_session_error(
+    result: UploadSessionResult, session: UploadSession | None
+) -> HTTPException:
+    match result:
+        case UploadSessionResult.NotFound:
+            return HTTPException(
+                status_code=404, detail="No existeix aquesta pujada"
+            )
+
+        case UploadSessionResult.TypeNotAllowed:
+            return HTTPException(
+                status_code=415, detail="Tipus de fitxer no vàlid"
+            )
+
+        case UploadSessionResult.TooLarge:
+            return HTTPException(
+                status_code=413, detail="El fitxer és massa gran"
+            )
+
+        case UploadSessionResult.QueueFull:
+            return HTTPException(
+                status_code=429,
+                detail="Hi ha massa fitxers a la cua. Proveu-ho en una estona.",
+            )
+
+        case UploadSessionResult.MaxPerEmailReached:
+            return HTTPException(
+                status_code=403,
+                detail="Ja teniu massa fitxers a la cua. Espereu-vos que es processin per enviar-ne de nous.",
+            )
+
+        case UploadSessionResult.NotDecodable:
+            return HTTPException(
+                status_code=415,
+                detail="El fitxer no conté àudio que es pugui processar",
+            )
+
+        case UploadSessionResult.Busy:
+            return HTTPException(
+                status_code=409,
+                detail="Ja s'està enviant una part d'aquesta pujada",
+            )
+
+        case UploadSessionResult.OffsetMismatch:
+            return HTTPException(
+                status_code=409,
+                detail="La posició no correspon a les dades rebudes",
+                headers={"Upload-Offset": str(session.offset)},
+            )
+
+        case UploadSessionResult.Incomplete:
+            return HTTPException(
+                status_code=409,
+                detail="Encara no s'ha rebut tot el fitxer",
+                headers={"Upload-Offset": str(session.offset)},
+            )
+
+
+def _upload_session_response(session: UploadSession) -> dict:
+    return {
+        "upload_id": session.upload_id,
+        "offset": session.offset,
+        "size": session.size,
+    }
+
+
+@router.post(path="/uploads")
+async def create_upload(
+    filename: Annotated[str, Form()],
+    size: Annotated[int, Form(description="Size of the file in bytes")],
+    email: Annotated[str, Form()],
+    model_name: Annotated[str, Form()],
+    highlight_words: Annotated[bool | None, Form()] = None,
+    num_chars: Annotated[str | None, Form()] = None,
+    num_sentences: Annotated[str | None, Form()] = None,
+) -> dict:
+    """
+    Start a resumable upload.
+
+    The file is then sent with PUT /file/uploads/{upload_id} in one or
+    more chunks and queued with POST /file/uploads/{upload_id}/finalize.
+    """
+    if (
+        filename == ""
+        or email == ""
+        or model_name == ""
+        or num_chars == ""
+        or num_sentences == ""
+    ):
+        raise HTTPException(
+            status_code=400, detail="Form fields cannot be empty"
+        )
+
+    result, session = await UploadSessionService.create(
+        filename,
+        size,
+        email,
+        model_name,
+        highlight_words,
+        num_chars,
+        num_sentences,
+    )
+    if result != UploadSessionResult.Ok:
+        raise _upload_session_error(result, session)
+
+    return _upload_session_response(session)
+
+
+@router.get(path="/uploads/{upload_id}")
+async def get_upload(upload_id: UUID) -> dict:
+    """Return how many bytes of the upload have been received."""
+    result, session = await UploadSessionService.get(upload_id)
+    if result != UploadSessionResult.Ok:
+        raise _upload_session_error(result, session)
+
+    return _upload_session_response(session)
+
+
+@router.put(path="/uploads/{upload_id}")
+async def put_upload_chunk(
+    request: Request,
+    upload_id: UUID,
+    offset: Annotated[
+        int, Query(description="Position of the chunk in the file")
+    ],
+) -> dict:
+    """
+    Send the raw bytes of the file starting at offset.
+
+    On 409 the Upload-Offset header tells where to resume from.
+    """
+    result, session = await UploadSessionService.put_chunk(
+        upload_id, offset, request.stream()
+    )
+    if result != UploadSessionResult.Ok:
+        raise _upload_session_error(result, session)
+
+    return _upload_session_response(session)
+
+
+_FINALIZE_RESULTS = {
+    UploadSessionResult.QueueFull: "queue_full",
+    UploadSessionResult.MaxPerEmailReached: "max_per_email_reached",
+    UploadSessionResult.NotDecodable: "not_decodable",
+}
+
+
+@router.post(path="/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: UUID) -> dict:
+    """Queue a complete upload for transcription."""
+    result, session = await UploadSessionService.finalize(upload_id)
+    model_name = session.model_name if session else ""
+    if result != UploadSessionResult.Ok:
+        if result in _FINALIZE_RESULTS:
+            uploads_counter.add(
+                1, {"model": model_name, "result": _FINALIZE_RESULTS[result]}
+            )
+
+        raise _upload_session_error(result, session)
+
+    uploads_counter.add(1, {"model": model_name, "result": "ok"})
+    uploaded_file_size_histogram.record(session.size, {"model": model_name})
+    return {"waiting_queue": str(session.waiting_queue)}
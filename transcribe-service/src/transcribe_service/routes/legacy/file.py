@@ -88,7 +88,7 @@ upload_file_router = APIRouter(prefix="/transcribe_file")
 
 
 @upload_file_router.post(path="/")
-async def upload_file(
+async def upload_file(  # noqa: C901
     request: Request,
     email: Annotated[str | None, Form()] = None,
     model_name: Annotated[str | None, Form()] = None,
@@ -116,7 +116,7 @@ async def upload_file(
             status_code=404, content={"error": "No s'ha especificat el model"}
         )
 
-    if int(request.headers.get("content-length")) >= MAX_SIZE:
+    if int(request.headers.get("content-length", 0)) >= MAX_SIZE:
         return JSONResponse(
             status_code=413, content={"error": "El fitxer és massa gran"}
         )
@@ -163,6 +163,25 @@ async def upload_file(
                 },
             )
 
+        case UploadFileResult.TooLarge, _:
+            uploads_counter.add(
+                1,
+                {"model": model_name, "result": "too_large"},
+            )
+            return JSONResponse(
+                status_code=413, content={"error": "El fitxer és massa gran"}
+            )
+
+        case UploadFileResult.NotDecodable, _:
+            uploads_counter.add(
+                1,
+                {"model": model_name, "result": "not_decodable"},
+            )
+            return JSONResponse(
+                status_code=415,
+                content={"error": "El fitxer no conté àudio que es pugui processar"},
+            )
+
         case UploadFileResult.Ok, waiting_queue_len:
             uploads_counter.add(
                 1, {"model": model_name, "result": "ok"}
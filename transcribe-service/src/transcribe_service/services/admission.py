@@ -0,0 +1,39 @@
+import logging
+from enum import Enum
+
+from transcribe_service.constants import MAX_PER_EMAIL, QUEUE_CAPACITY
+from transcribe_service.services.queue_snapshot import QueueSnapshotService
+
+
+class AdmissionResult(Enum):  # noqa: D101
+    QueueFull = 1
+    MaxPerEmailReached = 2
+    Ok = 3
+
+
+class AdmissionService:
+    """
+    Decides if a new upload can enter the queue.
+
+    Both checks use the shared queue snapshot, which also counts the
+    uploads accepted by this process since it was taken.
+    """
+
+    @staticmethod
+    def check(email: str) -> tuple[AdmissionResult, int]:
+        """Return the admission result and the current queue length."""
+        snapshot = QueueSnapshotService.get()
+        waiting_queue = snapshot.count()
+        if waiting_queue >= QUEUE_CAPACITY:
+            logging.info(
+                f"POST /file/transcribe - masses fitxers a la cua - {email}"
+            )
+            return AdmissionResult.QueueFull, waiting_queue
+
+        if snapshot.count(email=email) >= MAX_PER_EMAIL:
+            logging.info(
+                f"POST /file/transcribe - masses fitxers per email - {email}"
+            )
+            return AdmissionResult.MaxPerEmailReached, waiting_queue
+
+        return AdmissionResult.Ok, waiting_queue
@@ -1,18 +1,35 @@
+import asyncio
+import hashlib
 import logging
+from collections.abc import AsyncIterator
 from enum import Enum
 from pathlib import Path
+from typing import Any, BinaryIO
 from uuid import UUID
 
 from fastapi import UploadFile
-from transcribe_core.batchfilesdb import BatchFilesDB
+from transcribe_core.batchfilesdb import (
+    NOTIFICATIONS,
+    BatchFile,
+    BatchFilesDB,
+)
+from transcribe_core.mediaprobe import MediaInfo, MediaProbeError, probe
 from transcribe_core.processedfiles import ProcessedFiles
 
 from transcribe_service.constants import (
-    MAX_PER_EMAIL,
+    MAX_SIZE,
+    PROBE_TIMEOUT,
     PROCESSED_FOLDER,
-    QUEUE_CAPACITY,
+    UPLOAD_CHUNK_SIZE,
     UPLOAD_FOLDER,
+    UPLOAD_WRITE_BUFFER,
+)
+from transcribe_service.executors import run_data, run_metadata
+from transcribe_service.services.admission import (
+    AdmissionResult,
+    AdmissionService,
 )
+from transcribe_service.services.queue_snapshot import QueueSnapshotService
 from transcribe_service.utils import (
     _allowed_file,
     _get_download_names,
@@ -33,11 +50,171 @@ class UploadFileResult(Enum):  # noqa: D101
     QueueFull = 2
     MaxPerEmailReached = 3
     Ok = 4
+    TooLarge = 5
+    NotDecodable = 6
 
 
 class FileService:
     """TODO: Docstring this class."""
 
+    @staticmethod
+    def _write(output: BinaryIO, chunk: bytes, hasher: Any | None) -> None:
+        output.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+
+    @staticmethod
+    async def write_chunks(
+        output: BinaryIO,
+        chunks: AsyncIterator[bytes],
+        max_size: int,
+        hasher: Any | None = None,
+    ) -> int | None:
+        """
+        Write chunks to output, each one while the next is being received.
+
+        The writes, and updating hasher with the chunks if given, run in
+        the data thread pool. Returns the number of bytes written, or None
+        as soon as the total goes over max_size.
+        """
+        written = 0
+        pending: asyncio.Future | None = None
+        try:
+            async for chunk in chunks:
+                written += len(chunk)
+                if written > max_size:
+                    return None
+
+                if pending is not None:
+                    await pending
+
+                pending = run_data(FileService._write, output, chunk, hasher)
+
+            if pending is not None:
+                await pending
+        finally:
+            if pending is not None and not pending.done():
+                await asyncio.wait([pending])
+
+        return written
+
+    @staticmethod
+    async def _read_chunks(file: UploadFile) -> AsyncIterator[bytes]:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+    @staticmethod
+    def hash_file(fullname: Path) -> str:
+        """Return the sha256 of a file, reading it in chunks."""
+        hasher = hashlib.sha256()
+        with fullname.open("rb") as input_file:
+            while chunk := input_file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+
+        return hasher.hexdigest()
+
+    @staticmethod
+    async def _save_upload(
+        file: UploadFile, fullname: Path, hasher: Any | None = None
+    ) -> int | None:
+        """
+        Copy the upload to fullname in chunks.
+
+        Returns the number of bytes written, or None if the upload is
+        larger than MAX_SIZE, in which case nothing is left on disk.
+        The body has already been spooled by UploadFile, stopping at
+        MAX_SIZE only saves the copy. Large uploads are cut off before
+        being received by the content-length check of the middleware.
+        """
+        output = await run_metadata(
+            fullname.open, "wb", buffering=UPLOAD_WRITE_BUFFER
+        )
+        file_size = None
+        try:
+            file_size = await FileService.write_chunks(
+                output, FileService._read_chunks(file), MAX_SIZE, hasher
+            )
+        finally:
+            await run_data(output.close)
+            # Too large, or the copy failed, do not leave a partial file
+            if file_size is None:
+                await run_metadata(fullname.unlink, missing_ok=True)
+
+        return file_size
+
+    @staticmethod
+    async def probe_upload(fullname: Path) -> MediaInfo:
+        """
+        Read the duration and audio layout of an uploaded file.
+
+        Raises MediaProbeError if the file has no audio that can be
+        decoded. If the file cannot be probed here the fields are None.
+        """
+        media = await run_data(probe, fullname, PROBE_TIMEOUT)
+        return media or MediaInfo()
+
+    @staticmethod
+    def finish_cached(
+        fullname: Path,
+        content_hash: str,
+        email: str,
+        model_name: str,
+        original_filename: str,
+        highlight_words: bool,  # noqa: FBT001
+        num_chars: str,
+        num_sentences: str,
+        file_size: int,
+    ) -> str | None:
+        """
+        Finish an upload with the outputs of an identical one, if any.
+
+        The upload goes straight to the processed files and its record to
+        NOTIFICATIONS, where a worker sends the email. Returns the uuid
+        whose outputs were reused, or None if the upload has to be queued.
+        """
+        key = ProcessedFiles.get_content_key(
+            content_hash,
+            model_name,
+            highlight_words,
+            BatchFile._safe_int(num_chars),
+            BatchFile._safe_int(num_sentences),
+        )
+        cached_uuid = ProcessedFiles.find_by_content(key)
+        if cached_uuid is None:
+            return None
+
+        _uuid = fullname.name
+        processed = ProcessedFiles(_uuid)
+        if not processed.reuse_outputs(cached_uuid):
+            return None
+
+        db = BatchFilesDB(PROCESSED_FOLDER, backend="files")
+        db.create(
+            fullname,
+            email=email,
+            model_name=model_name,
+            original_filename=original_filename,
+            highlight_words=highlight_words,
+            num_chars=num_chars,
+            num_sentences=num_sentences,
+            record_uuid=_uuid,
+            file_size=file_size,
+            content_hash=content_hash,
+        )
+        extension = Path(original_filename).suffix or ".bin"
+        processed.move_file_bin(str(fullname), extension)
+        processed.register_content(key)
+
+        # Last, so the email is only sent once everything is in place
+        filename_dbrecord = db.get_record_file_from_uuid(_uuid)
+        notifications = BatchFilesDB(NOTIFICATIONS, backend="files")
+        notifications.put(
+            notifications.get_record_file_from_uuid(_uuid),
+            Path(filename_dbrecord).read_text(),
+            email,
+        )
+        return cached_uuid
+
     @staticmethod
     async def upload_file(
         file: UploadFile,
@@ -51,25 +228,58 @@ class FileService:
         if not _allowed_file(file.filename):
             return UploadFileResult.TypeNotAllowed, None
 
+        match await run_metadata(AdmissionService.check, email):
+            case AdmissionResult.QueueFull, _:
+                return UploadFileResult.QueueFull, None
+
+            case AdmissionResult.MaxPerEmailReached, _:
+                return UploadFileResult.MaxPerEmailReached, None
+
+            case AdmissionResult.Ok, waiting_queue:
+                pass
+
         db = BatchFilesDB()
-        if db.count() >= QUEUE_CAPACITY:
+        _uuid = await run_metadata(db.get_new_uuid)
+        fullname = Path(UPLOAD_FOLDER) / _uuid
+        hasher = hashlib.sha256()
+        file_size = await FileService._save_upload(file, fullname, hasher)
+        if file_size is None:
             logging.info(
-                f"POST /file/transcribe - masses fitxers a la cua - {email}"
+                f"Rejected file {file.filename} for user {email}, larger than {MAX_SIZE} bytes"
             )
-            return UploadFileResult.QueueFull, None
+            return UploadFileResult.TooLarge, None
 
-        if len(db.select(email=email)) >= MAX_PER_EMAIL:
+        # An identical upload with the same options is already transcribed,
+        # it is finished right away without taking a place in the queue
+        cached_uuid = await run_metadata(
+            FileService.finish_cached,
+            fullname,
+            hasher.hexdigest(),
+            email,
+            model_name,
+            file.filename,
+            highlight_words,
+            num_chars,
+            num_sentences,
+            file_size,
+        )
+        if cached_uuid is not None:
             logging.info(
-                f"POST /file/transcribe - masses fitxers per email - {email}"
+                f"Finished file {file.filename} for user {email} with the transcription of {cached_uuid}"
             )
-            return UploadFileResult.MaxPerEmailReached, None
+            return UploadFileResult.Ok, 0
 
-        waiting_queue = len(db.select())
-        _uuid = db.get_new_uuid()
-        fullname = Path(UPLOAD_FOLDER) / _uuid
-        contents = await file.read()
-        fullname.write_bytes(contents)
-        db.create(
+        try:
+            media = await FileService.probe_upload(fullname)
+        except MediaProbeError as exception:
+            logging.info(
+                f"Rejected file {file.filename} for user {email}, cannot be decoded: {exception}"
+            )
+            await run_metadata(fullname.unlink, missing_ok=True)
+            return UploadFileResult.NotDecodable, None
+
+        await run_metadata(
+            db.create,
             fullname,
             email=email,
             model_name=model_name,
@@ -78,9 +288,17 @@ class FileService:
             num_chars=num_chars,
             num_sentences=num_sentences,
             record_uuid=_uuid,
+            file_size=file_size,
+            duration=media.duration,
+            sample_rate=media.sample_rate,
+            channels=media.channels,
+            channel_layout=media.channel_layout,
+            codec=media.codec,
+            content_hash=hasher.hexdigest(),
         )
+        QueueSnapshotService.record_added(email)
 
-        size_mb = fullname.stat().st_size / 1024 / 1024
+        size_mb = file_size / 1024 / 1024
         logging.info(
             f"Saved file {file.filename} to {fullname} (size: {size_mb:.2f}MB) for user {email}, waiting_queue: {waiting_queue}"
         )
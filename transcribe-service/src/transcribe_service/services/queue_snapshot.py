@@ -0,0 +1,84 @@
+import threading
+import time
+from dataclasses import dataclass, field, replace
+
+from transcribe_core.batchfilesdb import BatchFilesDB
+
+from transcribe_service.constants import QUEUE_SNAPSHOT_TTL
+
+
+@dataclass(frozen=True)
+class QueueSnapshot:
+    """State of the queue at a given time."""
+
+    items: int = 0
+    processing: int = 0
+    # Keyed by the lowercase email, as the queue store counts them
+    per_email: dict[str, int] = field(default_factory=dict)
+    taken: float = 0
+
+    def count(self, email: str | None = None) -> int:
+        """Return the number of entries in the queue, or for one email."""
+        if email is None:
+            return self.items
+
+        return self.per_email.get(email.lower(), 0)
+
+
+class QueueSnapshotService:
+    """
+    One in-process view of the queue shared by stats, admission and gauges.
+
+    The queue is read at most once every QUEUE_SNAPSHOT_TTL seconds, the
+    callers within that interval get the same snapshot. Uploads accepted
+    by this process are added to the snapshot right away so admission
+    does not fall behind between refreshes.
+    """
+
+    _lock = threading.Lock()
+    _snapshot: QueueSnapshot | None = None
+
+    @staticmethod
+    def _take() -> QueueSnapshot:
+        db = BatchFilesDB()
+        return QueueSnapshot(
+            items=db.count(),
+            processing=db.count_processing(),
+            per_email=db.count_per_email(),
+            taken=time.monotonic(),
+        )
+
+    @classmethod
+    def get(cls) -> QueueSnapshot:
+        """Return the current snapshot, refreshing it if it has expired."""
+        with cls._lock:
+            snapshot = cls._snapshot
+            if (
+                snapshot is None
+                or time.monotonic() - snapshot.taken >= QUEUE_SNAPSHOT_TTL
+            ):
+                snapshot = cls._take()
+                cls._snapshot = snapshot
+
+            return snapshot
+
+    @classmethod
+    def record_added(cls, email: str) -> None:
+        """Account for an entry created by this process."""
+        with cls._lock:
+            snapshot = cls._snapshot
+            if snapshot is None:
+                return
+
+            per_email = dict(snapshot.per_email)
+            email = email.lower()
+            per_email[email] = per_email.get(email, 0) + 1
+            cls._snapshot = replace(
+                snapshot, items=snapshot.items + 1, per_email=per_email
+            )
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Force the next call to read the queue again."""
+        with cls._lock:
+            cls._snapshot = None
@@ -1,9 +1,10 @@
 from datetime import date
 
-from transcribe_core.batchfilesdb import BatchFilesDB
 from transcribe_core.processedfiles import ProcessedFiles
 from transcribe_core.usage import Usage
 
+from transcribe_service.services.queue_snapshot import QueueSnapshotService
+
 
 class StatsService:
     """TODO: Docstring this class."""
@@ -13,14 +14,10 @@ class StatsService:
         """TODO: Docstring this."""
         result = Usage().get_stats(date)
         queue = {}
-        records = BatchFilesDB().select()
-        who = {
-            record.email: sum(1 for r in records if r.email == record.email)
-            for record in records
-        }
+        snapshot = QueueSnapshotService.get()
         print_who = {
             "".join(["-" if c in ["a"] else c for c in key]): value
-            for key, value in who.items()
+            for key, value in snapshot.per_email.items()
         }
         result["files_stored"] = ProcessedFiles.get_num_of_files_stored()
         result["files_stored_size"] = (
@@ -29,7 +26,7 @@ class StatsService:
         result["free_storage_space"] = (
             ProcessedFiles.get_free_space_in_directory()
         )
-        queue["items"] = len(records)
+        queue["items"] = snapshot.items
         queue["who"] = print_who
         result["queue"] = queue
         return result
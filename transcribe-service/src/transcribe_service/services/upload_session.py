@@ -0,0 +1,310 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from collections.abc import AsyncIterator
+from dataclasses import asdict, dataclass
+from enum import Enum
+from pathlib import Path
+from typing import BinaryIO
+from uuid import UUID
+
+from transcribe_core.batchfilesdb import BatchFilesDB
+from transcribe_core.mediaprobe import MediaProbeError
+
+from transcribe_service.constants import (
+    MAX_SIZE,
+    UPLOAD_FOLDER,
+    UPLOAD_SESSION_TTL,
+    UPLOAD_SESSIONS_FOLDER,
+    UPLOAD_WRITE_BUFFER,
+)
+from transcribe_service.executors import run_data, run_metadata
+from transcribe_service.services.admission import (
+    AdmissionResult,
+    AdmissionService,
+)
+from transcribe_service.services.file import FileService
+from transcribe_service.services.queue_snapshot import QueueSnapshotService
+from transcribe_service.utils import _allowed_file
+
+
+class UploadSessionResult(Enum):  # noqa: D101
+    NotFound = 1
+    TypeNotAllowed = 2
+    TooLarge = 3
+    QueueFull = 4
+    MaxPerEmailReached = 5
+    OffsetMismatch = 6
+    Busy = 7
+    Incomplete = 8
+    Ok = 9
+    NotDecodable = 10
+
+
+@dataclass
+class UploadSession:
+    """A resumable upload and the form fields of its transcription."""
+
+    upload_id: str
+    filename: str
+    size: int
+    email: str
+    model_name: str
+    highlight_words: bool | None = None
+    num_chars: str | None = None
+    num_sentences: str | None = None
+    offset: int = 0
+    waiting_queue: int | None = None
+
+
+_ADMISSION_RESULTS = {
+    AdmissionResult.QueueFull: UploadSessionResult.QueueFull,
+    AdmissionResult.MaxPerEmailReached: UploadSessionResult.MaxPerEmailReached,
+}
+
+
+class UploadSessionService:
+    """
+    Resumable uploads: create a session, send chunks at an offset, finalize.
+
+    The partial data is kept in UPLOAD_SESSIONS_FOLDER next to a json file
+    with the form fields. Writing a chunk or finalizing takes a lock on the
+    partial file, so two requests for the same session cannot interleave.
+    Sessions not touched for UPLOAD_SESSION_TTL seconds are purged.
+    """
+
+    @staticmethod
+    def _get_paths(upload_id: UUID | str) -> tuple[Path, Path]:
+        base = Path(UPLOAD_SESSIONS_FOLDER) / str(upload_id)
+        return base.with_suffix(".json"), base.with_suffix(".part")
+
+    @staticmethod
+    def _load(upload_id: UUID | str) -> UploadSession | None:
+        metadata, part = UploadSessionService._get_paths(upload_id)
+        try:
+            session = UploadSession(**json.loads(metadata.read_text()))
+            session.offset = part.stat().st_size
+        except (OSError, ValueError, TypeError):
+            return None
+
+        return session
+
+    @staticmethod
+    def _save(session: UploadSession) -> None:
+        metadata, part = UploadSessionService._get_paths(session.upload_id)
+        metadata.parent.mkdir(parents=True, exist_ok=True)
+        part.touch()
+        fields = asdict(session)
+        del fields["offset"], fields["waiting_queue"]
+        metadata.write_text(json.dumps(fields))
+
+    @staticmethod
+    def _open_locked(part: Path) -> BinaryIO | None:
+        """Open part for appending, or None if another request holds it."""
+        try:
+            output = part.open("r+b", buffering=UPLOAD_WRITE_BUFFER)
+        except FileNotFoundError:
+            return None
+
+        try:
+            fcntl.flock(output.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            output.close()
+            return None
+
+        output.seek(0, os.SEEK_END)
+        return output
+
+    @staticmethod
+    async def create(
+        filename: str,
+        size: int,
+        email: str,
+        model_name: str,
+        highlight_words: bool | None,  # noqa: FBT001
+        num_chars: str | None,
+        num_sentences: str | None,
+    ) -> tuple[UploadSessionResult, UploadSession | None]:
+        """Start a session for an upload of size bytes."""
+        if not _allowed_file(filename):
+            return UploadSessionResult.TypeNotAllowed, None
+
+        if size <= 0 or size > MAX_SIZE:
+            return UploadSessionResult.TooLarge, None
+
+        result, _ = await run_metadata(AdmissionService.check, email)
+        if result in _ADMISSION_RESULTS:
+            return _ADMISSION_RESULTS[result], None
+
+        session = UploadSession(
+            upload_id=BatchFilesDB().get_new_uuid(),
+            filename=filename,
+            size=size,
+            email=email,
+            model_name=model_name,
+            highlight_words=highlight_words,
+            num_chars=num_chars,
+            num_sentences=num_sentences,
+        )
+        await run_metadata(UploadSessionService._save, session)
+        logging.info(
+            f"Upload session {session.upload_id} for {filename} ({size} bytes) for user {email}"
+        )
+        return UploadSessionResult.Ok, session
+
+    @staticmethod
+    async def get(
+        upload_id: UUID,
+    ) -> tuple[UploadSessionResult, UploadSession | None]:
+        """Return the session, its offset is the number of bytes received."""
+        session = await run_metadata(UploadSessionService._load, upload_id)
+        if session is None:
+            return UploadSessionResult.NotFound, None
+
+        return UploadSessionResult.Ok, session
+
+    @staticmethod
+    async def put_chunk(
+        upload_id: UUID, offset: int, chunks: AsyncIterator[bytes]
+    ) -> tuple[UploadSessionResult, UploadSession | None]:
+        """
+        Append chunks to the session, they must start at offset.
+
+        If the connection drops, the bytes already written are kept and
+        the client resumes from the offset returned by get.
+        """
+        session = await run_metadata(UploadSessionService._load, upload_id)
+        if session is None:
+            return UploadSessionResult.NotFound, None
+
+        _, part = UploadSessionService._get_paths(upload_id)
+        output = await run_metadata(UploadSessionService._open_locked, part)
+        if output is None:
+            return UploadSessionResult.Busy, session
+
+        try:
+            session.offset = output.tell()
+            if offset != session.offset:
+                return UploadSessionResult.OffsetMismatch, session
+
+            written = await FileService.write_chunks(
+                output, chunks, session.size - session.offset
+            )
+            if written is None:
+                await run_data(output.truncate, session.offset)
+                return UploadSessionResult.TooLarge, session
+
+            session.offset += written
+        finally:
+            await run_data(output.close)
+
+        return UploadSessionResult.Ok, session
+
+    @staticmethod
+    async def finalize(
+        upload_id: UUID,
+    ) -> tuple[UploadSessionResult, UploadSession | None]:
+        """Queue the uploaded file for transcription once it is complete."""
+        session = await run_metadata(UploadSessionService._load, upload_id)
+        if session is None:
+            return UploadSessionResult.NotFound, None
+
+        metadata, part = UploadSessionService._get_paths(upload_id)
+        output = await run_metadata(UploadSessionService._open_locked, part)
+        if output is None:
+            return UploadSessionResult.Busy, session
+
+        fullname = Path(UPLOAD_FOLDER) / session.upload_id
+        try:
+            session.offset = output.tell()
+            if session.offset != session.size:
+                return UploadSessionResult.Incomplete, session
+
+            result, waiting_queue = await run_metadata(
+                AdmissionService.check, session.email
+            )
+            if result in _ADMISSION_RESULTS:
+                return _ADMISSION_RESULTS[result], session
+
+            try:
+                media = await FileService.probe_upload(part)
+            except MediaProbeError as exception:
+                logging.info(
+                    f"Rejected upload session {session.upload_id} for user {session.email}, cannot be decoded: {exception}"
+                )
+                await run_metadata(part.unlink, missing_ok=True)
+                await run_metadata(metadata.unlink, missing_ok=True)
+                return UploadSessionResult.NotDecodable, session
+
+            content_hash = await run_data(FileService.hash_file, part)
+            await run_metadata(part.rename, fullname)
+        finally:
+            await run_data(output.close)
+
+        await run_metadata(
+            BatchFilesDB().create,
+            fullname,
+            email=session.email,
+            model_name=session.model_name,
+            original_filename=session.filename,
+            highlight_words=session.highlight_words,
+            num_chars=session.num_chars,
+            num_sentences=session.num_sentences,
+            record_uuid=session.upload_id,
+            file_size=session.size,
+            duration=media.duration,
+            sample_rate=media.sample_rate,
+            channels=media.channels,
+            channel_layout=media.channel_layout,
+            codec=media.codec,
+            content_hash=content_hash,
+        )
+        await run_metadata(metadata.unlink, missing_ok=True)
+        QueueSnapshotService.record_added(session.email)
+
+        session.waiting_queue = waiting_queue
+        logging.info(
+            f"Saved file {session.filename} to {fullname} from upload session for user {session.email}, waiting_queue: {waiting_queue}"
+        )
+        return UploadSessionResult.Ok, session
+
+    @staticmethod
+    def purge(older_than: float = UPLOAD_SESSION_TTL) -> int:
+        """Delete the sessions not written to in older_than seconds."""
+        directory = Path(UPLOAD_SESSIONS_FOLDER)
+        if not directory.is_dir():
+            return 0
+
+        last_used: dict[str, float] = {}
+        for path in directory.iterdir():
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            last_used[path.stem] = max(last_used.get(path.stem, 0), mtime)
+
+        limit = time.time() - older_than
+        purged = 0
+        for upload_id, mtime in last_used.items():
+            if mtime >= limit:
+                continue
+
+            for path in UploadSessionService._get_paths(upload_id):
+                path.unlink(missing_ok=True)
+
+            purged += 1
+
+        return purged
+
+
+async def _purge_upload_sessions(interval: float = 10 * 60) -> None:
+    while True:
+        purged = await run_metadata(UploadSessionService.purge)
+        if purged:
+            logging.info(f"Purged {purged} abandoned upload sessions")
+
+        await asyncio.sleep(interval)
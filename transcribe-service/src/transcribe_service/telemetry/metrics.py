@@ -1,5 +1,5 @@
 import asyncio
-from pathlib import Path
+import time
 
 from opentelemetry import metrics
 from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
@@ -11,7 +11,9 @@ from opentelemetry.sdk.metrics.view import (
     View,
 )
 from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from transcribe_core.batchfilesdb import BatchFilesDB
+
+from transcribe_service.executors import run_metadata
+from transcribe_service.services.queue_snapshot import QueueSnapshotService
 
 reader = PeriodicExportingMetricReader(
     OTLPMetricExporter(), export_interval_millis=5000
@@ -43,7 +45,28 @@ file_size_buckets = View(
     ),
 )
 
-provider = MeterProvider(metric_readers=[reader], views=[file_size_buckets])
+event_loop_lag_buckets = View(
+    instrument_name="event_loop_lag_seconds",
+    aggregation=ExplicitBucketHistogramAggregation(
+        boundaries=[
+            0.001,
+            0.005,
+            0.01,
+            0.025,
+            0.05,
+            0.1,
+            0.25,
+            0.5,
+            1,
+            2.5,
+            5,
+        ],
+    ),
+)
+
+provider = MeterProvider(
+    metric_readers=[reader], views=[file_size_buckets, event_loop_lag_buckets]
+)
 
 metrics.set_meter_provider(provider)
 meter = metrics.get_meter("transcribe-service")
@@ -81,19 +104,34 @@ queue_depth_gauge = meter.create_gauge(
 currently_processing_transcriptions_gauge = meter.create_gauge(
     "in_process_transcriptions",
     unit="1",
-    description="Current transcriptions being processed (active lock files)",
+    description="Current transcriptions being processed (claimed by a worker)",
+)
+
+event_loop_lag_histogram = meter.create_histogram(
+    "event_loop_lag_seconds",
+    unit="s",
+    description="Delay of the event loop waking up a sleeping task",
 )
 
 
 async def _update_queue_depth() -> None:
     while True:
-        queue_depth_gauge.set(BatchFilesDB().count())
+        snapshot = await run_metadata(QueueSnapshotService.get)
+        queue_depth_gauge.set(snapshot.items)
         await asyncio.sleep(5)
 
 
 async def _reconcile_in_process() -> None:
-    ENTRIES_DIR = Path("/srv/data/entries")
     while True:
-        processing = len(list(ENTRIES_DIR.glob("*.lock")))  # noqa: ASYNC240
+        snapshot = await run_metadata(QueueSnapshotService.get)
+        processing = snapshot.processing
         currently_processing_transcriptions_gauge.set(processing)
         await asyncio.sleep(4)
+
+
+async def _measure_event_loop_lag(interval: float = 0.5) -> None:
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0, time.monotonic() - start - interval)
+        event_loop_lag_histogram.record(lag)